@@ -23,23 +23,31 @@
 
 import bpy
 import mathutils,  math, os
+from array import array
 from bpy.props import FloatProperty, FloatVectorProperty, IntProperty, BoolProperty, EnumProperty, StringProperty
-from random import random
+from . import sim_kernel
+from . import keyframe_writer
+from . import sim_school
+from . import trajectory_sampler
+from . import sim_pool
+from . import result_cache
+from . import swim_cycles
+from . import swim_cache
+from . import rig_profiles
+from . import fish_registry
+from . import sim_lod
+from . import sim_crowd
+from . import crowd_cache
+from . import swim_gaits
+from . import gait_cache
 
+#Rotation used to measure how far each spine control swings the tail fin
+TAIL_PROBE = math.radians(15.0)
 
 
 
 
 class FSimProps(bpy.types.PropertyGroup):
-    
-    #State Variables
-    sVelocity : FloatVectorProperty(name="Velocity", description="Speed", subtype='XYZ', default=(0.0,0.0,0.0), min=-5.0, max=5.0)
-    sEffort : FloatProperty(name="Effort", description="The effort going into swimming", default=1.0, min=0)
-    sTurn : FloatProperty(name="Turn", description="The intent to go left of right (positive is right)", default=0.0)
-    sRise : FloatProperty(name="Rise", description="The intent to go up or down (positive is up", default=0.0)
-    sFreq : FloatProperty(name="Frequency", description="Current frequency of tail movement in frames per cycle", default=0.0)
-    sTailAngle : FloatProperty(name="Tail Angle", description="Current max tail angle in degrees", default=0.0)
-    sTailAngleOffset : FloatProperty(name="Tail Angle Offset", description="Offset angle for turning in degrees", default=0.0)
 
     #Property declaration
     pMass : FloatProperty(name="Mass", description="Total Mass", default=30.0, min=0, max=3000.0)
@@ -90,546 +98,752 @@ class FSimProps(bpy.types.PropertyGroup):
     pHoverTwitchTime : FloatProperty(name="Hover Twitch Time", description="The time between twitching while in hover mode in frames", default=40.0, min=0.0)
     pPecSynch : BoolProperty(name="Pec Synch", description="If true then fins beat together, otherwise fins act out of phase", default=False)
     
+def SwimFolder(sFPM):
+    #Folder for swim, crowd and gait cache files
+    folder = bpy.path.abspath(sFPM.fsim_swim_dir) if sFPM.fsim_swim_dir else ""
+    if not folder:
+        folder = bpy.path.abspath("//fsim_swim") if bpy.data.filepath else os.path.join(bpy.app.tempdir, "fsim_swim")
+    return folder
+
+
+def GaitPath(sFPM, species):
+    #Gait cache file of a species
+    return os.path.join(SwimFolder(sFPM), bpy.path.clean_name("{} Gaits".format(species)) + gait_cache.FILE_SUFFIX)
+
+
+def StoredPath(path):
+    #Relative to the .blend once it has been saved
+    return bpy.path.relpath(path) if bpy.data.filepath else path
+
+
+class SimFish:
+    """One armature taking part in a simulation run"""
+    __slots__ = ("rig", "bones", "goldfish", "proxy", "trajectory", "tail", "state", "bake", "row", "checkpoints", "checkpointKey",
+                 "resultKey", "fromCache", "euler", "lod")
+
+    def __init__(self, rig, bones, goldfish, proxy, trajectory=None):
+        self.rig = rig
+        self.bones = bones
+        self.goldfish = goldfish
+        self.proxy = proxy
+        self.trajectory = trajectory
+        self.tail = None
+        self.state = None
+        self.bake = None
+        self.row = None
+        self.checkpoints = None
+        self.checkpointKey = ""
+        self.resultKey = ""
+        self.fromCache = False
+        self.euler = False
+        self.lod = sim_lod.LOD_FULL
+
+
+class SchoolGroup:
+    """Armatures of a school stepped together with NumPy - the root motion tier apart from the others,
+    as it is stepped without its bones"""
+    __slots__ = ("fish", "rootOnly", "state", "tail", "rows", "matrices", "sizes", "hasProxy")
+
+    def __init__(self, school, rootOnly, startFrame, endFrame):
+        np = sim_school.np
+        self.fish = school
+        self.rootOnly = rootOnly
+        self.state = sim_school.SchoolState.FromFish([fish.state for fish in school])
+        self.tail = None if rootOnly else sim_school.SchoolTail.FromFish([fish.tail for fish in school])
+        self.rows = {name: np.array([fish.row[name] for fish in school]) for name in sim_kernel.BODY_TRACKS}
+
+        #Target matrices and sizes as (fish, frame) arrays
+        frames = endFrame - startFrame + 1
+        self.matrices = np.zeros((len(school), frames, 16), dtype=np.float32)
+        self.sizes = np.zeros((len(school), frames), dtype=np.float32)
+        self.hasProxy = np.array([fish.trajectory is not None for fish in school], dtype=bool)
+        for i, fish in enumerate(school):
+            if fish.trajectory is not None:
+                self.matrices[i] = np.frombuffer(fish.trajectory.matrices, dtype=np.float32).reshape(-1, 16)[:frames]
+                self.sizes[i] = np.frombuffer(fish.trajectory.sizes, dtype=np.float32)[:frames]
+
+
+class SimRun:
+    """State of one simulation run, owned by the operator running it"""
+    __slots__ = (
+        "sTargetRig", "sArmatures", "nArmature", "sParams", "sSim", "sSchool", "sSchoolGroups", "sSchoolVector",
+        "sCheckpoints",
+        "sResumeFrame", "sFirstFrame", "sCache", "sResults", "sTolerances", "sMinimalKeys", "sCycles", "sSwimDir", "sSwimHalf",
+        "sFollowers", "sLeaders", "sLeaderBakes", "sKeysWritten", "sKeysDropped", "sStartFrame", "sEndFrame",
+        "sRange", "sTrajectories", "sLod", "sCamera", "sCameraFrame", "sTiers",
+    )
+
+    def __init__(self, targetRig, sFPM):
+        self.sTargetRig = targetRig
+        self.sArmatures = []
+        self.nArmature = 0
+        #Simulation kernel parameters, the current armature for scalar runs, and the whole school for vector runs
+        self.sParams = None
+        self.sSim = None
+        self.sSchool = None
+        self.sSchoolGroups = None
+        self.sSchoolVector = False
+        #Stored checkpoints by armature name, and the frame this run carries on from (None to start afresh)
+        self.sCheckpoints = {}
+        self.sResumeFrame = None
+        self.sFirstFrame = 1
+        #Result cache of this run (None when disabled), the armatures looked up in it, how the results are written,
+        #and the range being simulated
+        self.sCache = None
+        self.sResults = {}
+        self.sTolerances = None
+        self.sMinimalKeys = False
+        self.sCycles = None
+        self.sSwimDir = None
+        self.sSwimHalf = False
+        #Followers as (name, leader name), the leaders they need, and the finished leader bakes
+        self.sFollowers = []
+        self.sLeaders = set()
+        self.sLeaderBakes = {}
+        self.sKeysWritten = 0
+        self.sKeysDropped = 0
+        #The range being simulated - with sRange, only part of the animation is simulated again
+        self.sRange = sFPM.fsim_range
+        if self.sRange:
+            self.sStartFrame = sFPM.fsim_range_start
+            self.sEndFrame = sFPM.fsim_range_end
+        else:
+            self.sStartFrame = sFPM.fsim_start_frame
+            self.sEndFrame = sFPM.fsim_end_frame
+        #Pre-sampled target trajectories by proxy name
+        self.sTrajectories = {}
+        #Camera level of detail - (near, far, key step) with the camera's trajectory and frame, or None
+        self.sLod = None
+        self.sCamera = None
+        self.sCameraFrame = None
+        self.sTiers = [0] * len(sim_lod.TIER_NAMES)
+
+
 class ARMATURE_OT_FSimulate(bpy.types.Operator):
     """Simulate all armatures with a similar name to selected"""
     bl_idname = "armature.fsimulate"
     bl_label = "Simulate"
     bl_options = {'REGISTER', 'UNDO', 'PRESET'}
-    
+
     _timer = None
-    sRoot = None
-    sTorso = None
-    sSpine_master = None
-    sBack_fin1 = None
-    sBack_fin2 = None
-    sBack_fin_middle = None
-    sChest = None
-    sSideFinL = None
-    sSideFinR = None
-    #pecs
-    sPecFinTopL = None
-    sPecFinTopR = None
-    sPecFinBottomL = None
-    sPecFinBottomR = None
-    sPecFinPalmL = None
-    sPecFinPalmR = None
-    sState = 0.0
-    sPecState = 0.0
-    sPec_scale = 1.0
-    sAngularForceV = 0.0
-    sTargetProxy = None
-    rMaxTailAngle = 0.0
-    rMaxFreq = 0.0
-    sTargetRig = None
-    sOldRqdEffort = 0.0
-    sOld_back_fin = None
-    sArmatures = []
-    nArmature = 0
-    sHoverMode = 1.0
-    sHoverTurn = 0.0
-    sRestFrame = 0.0
-    sRestartFrame = 0.0
-    sRestAmount = 0.0
-    sGoldfish = True
-    sStartAngle = 0.0
-    sTwitchFrame = 0.0
-    sTwitchAngle = 0.0
-    sTwitchTarget = 0.0
-    
-    def SetInitialKeyframe(self, TargetRig, nFrame):
-        TargetRig.keyframe_insert(data_path='location',  frame=(nFrame))
-        TargetRig.keyframe_insert(data_path='rotation_euler',  frame=(nFrame))
-        self.sSpine_master.keyframe_insert(data_path='rotation_quaternion',  frame=(nFrame))
-        self.sChest.keyframe_insert(data_path='rotation_quaternion',  frame=(nFrame))
-        self.sTorso.keyframe_insert(data_path='rotation_quaternion',  frame=(nFrame))
-        self.sBack_fin1.keyframe_insert(data_path='scale',  frame=(nFrame))
-        self.sBack_fin2.keyframe_insert(data_path='scale',  frame=(nFrame))
-        self.sSideFinL.keyframe_insert(data_path='rotation_quaternion',  frame=(nFrame))
-        self.sSideFinR.keyframe_insert(data_path='rotation_quaternion',  frame=(nFrame))
-        self.sSideFinR.keyframe_insert(data_path='rotation_quaternion',  frame=(nFrame))
-        self.sRoot.keyframe_insert(data_path='rotation_quaternion',  frame=(nFrame))
-        if self.sGoldfish:
-            self.sPecFinPalmL.keyframe_insert(data_path='rotation_quaternion',  frame=(nFrame))
-            self.sPecFinPalmR.keyframe_insert(data_path='rotation_quaternion',  frame=(nFrame))
-            self.sPecFinTopL.keyframe_insert(data_path='scale',  frame=(nFrame))
-            self.sPecFinBottomL.keyframe_insert(data_path='scale',  frame=(nFrame))
-            self.sPecFinTopR.keyframe_insert(data_path='scale',  frame=(nFrame))
-            self.sPecFinBottomR.keyframe_insert(data_path='scale',  frame=(nFrame))
-   
-    
+    #State of the run in progress, a SimRun
+    run = None
+
+    def ResolveBones(self, TargetRig):
+        #The bones the simulation drives, by role, from the rig's profile
+        bones = rig_profiles.PoseBones(TargetRig)
+        if bones is None:
+            self.report({'ERROR'}, "Sorry, this addon needs a Rigify rig generated from a Shark Metarig")
+            print("Not an Suitable Rigify Armature")
+            return None
+        goldfish = "pec_top_l" in bones
+
+        #Get TargetProxy object details
+        try:
+            TargetProxyName = bones["root"]["TargetProxy"]
+            # print("TargetProxyName: ", TargetProxyName)
+            TargetProxy = bpy.data.objects[TargetProxyName]
+        except:
+            TargetProxy = None
+
+        trajectory = self.run.sTrajectories.get(TargetProxy.name) if TargetProxy is not None else None
+        fish = SimFish(TargetRig, bones, goldfish, TargetProxy, trajectory)
+        if self.run.sLod is not None:
+            near, far, step = self.run.sLod
+            points = sim_lod.Positions(trajectory, TargetRig.location, self.run.sStartFrame, self.run.sEndFrame)
+            fish.lod = sim_lod.ChooseTier(self.run.sCamera, self.run.sCameraFrame, points, max(TargetRig.dimensions) / 2.0, near, far)
+            self.run.sTiers[fish.lod] += 1
+        return fish
+
+    def KeyStep(self, fish):
+        #Frames between keys - every frame for full detail fish
+        return 1 if fish.lod == sim_lod.LOD_FULL else self.run.sLod[2]
+
+    def WriteKeyframes(self, fish):
+        #Write the whole bake of an armature in one go
+        if fish is not None and fish.bake is not None:
+            #Only a whole run from the start frame counts as the result for its key, or can be cycled
+            complete = fish.bake.startFrame == self.run.sStartFrame and len(fish.bake) == self.run.sEndFrame - self.run.sStartFrame + 1
+            cycles = None
+            if self.run.sCycles is not None and complete and not self.run.sRange and fish.lod == sim_lod.LOD_FULL:
+                tolerance, repeats = self.run.sCycles
+                maxPeriod = int(math.ceil(4.0 * self.run.sParams.pMaxFreq * (1.0 + self.run.sParams.pRandom))) + 1
+                cycles = swim_cycles.FindCycles(fish.bake, tolerance, repeats, maxPeriod=maxPeriod)
+            if self.run.sSwimDir is not None:
+                self.WriteSwimCache(fish)
+            elif self.run.sRange:
+                written, dropped = keyframe_writer.WriteBake(fish.rig, fish.bones, fish.bake, replaceRange=True,
+                                                            tolerances=self.run.sTolerances, minimal=fish.euler,
+                                                            roles=sim_lod.TIER_ROLES[fish.lod], step=self.KeyStep(fish))
+                self.run.sKeysWritten += written
+                self.run.sKeysDropped += dropped
+            else:
+                written, dropped = keyframe_writer.WriteBake(fish.rig, fish.bones, fish.bake, keepBefore=True,
+                                                            tolerances=self.run.sTolerances, minimal=fish.euler, cycles=cycles,
+                                                            roles=sim_lod.TIER_ROLES[fish.lod], step=self.KeyStep(fish))
+                self.run.sKeysWritten += written
+                self.run.sKeysDropped += dropped
+            if complete and fish.rig.name in self.run.sLeaders:
+                self.run.sLeaderBakes[fish.rig.name] = fish.bake
+            #A fish carried on from a checkpoint holds the same keys as a whole run
+            resumed = (self.run.sResumeFrame is not None and fish.bake.startFrame == self.run.sFirstFrame
+                       and len(fish.bake) == self.run.sEndFrame - self.run.sFirstFrame + 1)
+            if fish.resultKey and (complete or resumed):
+                fish.rig["fsim_result_key"] = self.RigKey(fish)
+                if complete and self.run.sCache is not None and not fish.fromCache:
+                    packed = sim_kernel.PackState(fish.state, fish.row)
+                    self.run.sCache.Put(fish.resultKey, result_cache.CachedResult(fish.bake, packed, dict(fish.checkpoints.frames)))
+            elif "fsim_result_key" in fish.rig:
+                del fish.rig["fsim_result_key"]
+            fish.bake = None
+            if self.run.sRange:
+                #The stored checkpoints no longer match the keys from the range on
+                stored = fish.rig.get("fsim_checkpoints")
+                if stored is not None:
+                    fish.rig["fsim_checkpoints"] = {nFrame: values for nFrame, values in stored.to_dict().items() if int(nFrame) < self.run.sStartFrame}
+            elif fish.checkpoints is not None:
+                fish.rig["fsim_checkpoint_key"] = fish.checkpointKey
+                fish.rig["fsim_checkpoints"] = {str(nFrame): list(values) for nFrame, values in fish.checkpoints.frames.items()}
+
+    def WriteSwimCache(self, fish):
+        #Write the bake to the swim cache file of the armature instead of keyframes
+        path = os.path.join(self.run.sSwimDir, bpy.path.clean_name(fish.rig.name) + swim_cache.FILE_SUFFIX)
+        bones = {role: bone for role, bone in fish.bones.items() if role != "back_fin_middle"}
+        try:
+            swim_cache.Write(path, fish.bake, bones, fish.euler, self.run.sSwimHalf)
+        except OSError as err:
+            self.report({'ERROR'}, "Swim cache not written: {}".format(err))
+            return
+        fish.rig["fsim_swim_cache"] = StoredPath(path)
+        swim_cache.Track(fish.rig)
+
+    def SetPose(self, fish, row):
+        #Copy one frame of kernel output onto the rig so the scene evaluates it
+        swim_cache.ApplyPose(fish.rig, fish.bones, row, fish.euler)
+
     def armature_list(self, scene, sFPM):
-        self.sArmatures = []
-        for obj in scene.objects:
-            if obj.type == "ARMATURE" and obj.name[:3] == self.sTargetRig.name[:3]:
-                root = obj.pose.bones.get("root")
-                if root != None:
-                    if 'TargetProxy' in root:
-                        self.sArmatures.append(obj.name)
-        self.nArmature = len(self.sArmatures) - 1
-        # print("List: ", self.sArmatures)
+        #The rigs of the same species as the active one, from the registry
+        species = fish_registry.Species(scene, self.run.sTargetRig)
+        if fish_registry.IsRig(self.run.sTargetRig):
+            fish_registry.Register(scene, self.run.sTargetRig, species)
+        self.run.sArmatures = fish_registry.Rigs(scene, species)
+        self.run.nArmature = len(self.run.sArmatures) - 1
+        # print("List: ", self.run.sArmatures)
 
     
     def RemoveKeyframes(self, armature, bones):
-        dispose_paths = []
-        #print("Bones:")
-        #dispose_paths.append('pose.bones["{}"].rotation_quaternion'.format(bone.name))
-        for fcurve in armature.animation_data.action.fcurves:
-            if (fcurve.data_path == "location" or fcurve.data_path == "rotation_euler"):
-                armature.animation_data.action.fcurves.remove(fcurve)
+        #A swim cache would pose the armature over its keys
+        if "fsim_swim_cache" in armature:
+            del armature["fsim_swim_cache"]
+        dispose_paths = {"location", "rotation_euler"}
         for bone in bones:
             #bone.rotation_mode='XYZ'
-            #dispose_paths.append('pose.bones["{}"].rotation_euler'.format(bone.name))
-            dispose_paths.append('pose.bones["{}"].rotation_quaternion'.format(bone.name))
-            dispose_paths.append('pose.bones["{}"].scale'.format(bone.name))
-        dispose_curves = [fcurve for fcurve in armature.animation_data.action.fcurves if fcurve.data_path in dispose_paths]
+            dispose_paths.add('pose.bones["{}"].rotation_quaternion'.format(bone.name))
+            dispose_paths.add('pose.bones["{}"].rotation_euler'.format(bone.name))
+            dispose_paths.add('pose.bones["{}"].scale'.format(bone.name))
+        fcurves = armature.animation_data.action.fcurves
+        dispose_curves = [fcurve for fcurve in fcurves if fcurve.data_path in dispose_paths]
         for fcurve in dispose_curves:
-            armature.animation_data.action.fcurves.remove(fcurve)
+            fcurves.remove(fcurve)
 
-    #Set Effort and Direction properties to try and reach the target.
-    def Target(self, TargetRig, TargetProxy, pFS):
+    def ValidateRun(self, scene):
+        #Check the settings, and resolve the bones of every armature before starting, leaving out those that don't fit a rig profile
+        if self.run.sRange:
+            if self.run.sEndFrame <= self.run.sStartFrame:
+                self.report({'ERROR'}, "The range to simulate again must end after it starts")
+                return False
+            if scene.FSimMainProps.fsim_output != 'KEYS':
+                self.report({'ERROR'}, "Only keyframes can be simulated again over a range")
+                return False
+        failed = rig_profiles.Validate([scene.objects[name] for name in self.run.sArmatures])
+        if self.run.sRange:
+            #Keys over a range can't be mixed with swim cycles on the NLA
+            failed += [name for name in self.run.sArmatures if name not in failed and keyframe_writer.HasCycles(scene.objects[name])]
+        if failed:
+            reason = "don't match a FishSim rig or have swim cycles" if self.run.sRange else "don't match a FishSim rig"
+            self.report({'WARNING'}, "Skipping {} armatures that {}: {}".format(len(failed), reason, ", ".join(failed[:5])))
+            self.run.sArmatures = [name for name in self.run.sArmatures if name not in failed]
+            self.run.nArmature = len(self.run.sArmatures) - 1
+        if not self.run.sArmatures:
+            self.report({'ERROR'}, "Sorry, this addon needs a Rigify rig generated from a Shark Metarig")
+            return False
+        return True
 
-        RigDirn = mathutils.Vector((0,-1,0)) @ TargetRig.matrix_world.inverted()
-        #print("RigDirn: ", RigDirn)
-        
-        #distance to target
-        if TargetProxy != None:
-            TargetDirn = (TargetProxy.matrix_world.to_translation() - TargetRig.location)
-            # print("TargetDirn1: ", TargetDirn)
-        else:
-            TargetDirn = mathutils.Vector((0,-10,0))
-            # print("TargetDirn2: ", TargetDirn)
-        DifDot = TargetDirn.dot(RigDirn)
-        
-        #horizontal angle to target - limit max turning effort at 90 deg
-        RigDirn2D = mathutils.Vector((RigDirn.x, RigDirn.y))
-        TargetDirn2D = mathutils.Vector((TargetDirn.x, TargetDirn.y))
-        AngleToTarget = math.degrees(RigDirn2D.angle_signed(TargetDirn2D, math.radians(180)))
-        DirectionEffort = AngleToTarget/90.0
-        DirectionEffort = min(1.0,DirectionEffort)
-        DirectionEffort = max(-1.0,DirectionEffort)
-        
-        #vertical angle to target - limit max turning effort at 20 deg
-        RigDirn2DV = mathutils.Vector(((RigDirn.y**2 + RigDirn.x**2)**0.5, RigDirn.z))
-        TargetDirn2DV = mathutils.Vector(((TargetDirn.y**2 + TargetDirn.x**2)**0.5, TargetDirn.z))
-        AngleToTargetV = math.degrees(RigDirn2DV.angle_signed(TargetDirn2DV, math.radians(180)))
-        DirectionEffortV = AngleToTargetV/20.0
-        DirectionEffortV = min(1.0,DirectionEffortV)
-        DirectionEffortV = max(-1.0,DirectionEffortV)
-        
-        #Hover Mode Detection (Close to target and slow)
-        if not self.sGoldfish:
-            self.sHoverMode = 0.0
-        elif TargetDirn.length < (TargetProxy.dimensions[1] * pFS.pHoverDist):# and pFS.sVelocity.length < pFS.pHoverVel:
-            self.sHoverMode = min(1.0, self.sHoverMode + pFS.pSTransTime / 25.0)
-        else:
-            self.sHoverMode = max(0.0, self.sHoverMode - pFS.pHTransTime / 25.0)
-        # print("Hover %.2f, %.2f, %.2f, %.2f" % (self.sHoverMode, TargetDirn.length, TargetProxy.dimensions[1] * 3.0, pFS.sVelocity.length))
-        
-        #Return normalised required effort, turning factor, and ascending factor
-        return DifDot,DirectionEffort,DirectionEffortV
-        
-    #Handle the object movement for swimming
-    def ObjectMovment(self, TargetRig, ForwardForce, AngularForce, AngularForceV, nFrame, TargetProxy, pFS):
-        # print("MovementSwim")
-        #RigDirn = mathutils.Vector((0,-1,0)) * TargetRig.matrix_world.inverted()
-        #Total force is tail force - drag
-        # DragForce = pFS.pDrag * pFS.sVelocity ** 2.0
-        pFS.sVelocity[0] += -(pFS.pDrag * pFS.sVelocity[0] * math.fabs(pFS.sVelocity[0])) / pFS.pMass
-        pFS.sVelocity[1] += (-ForwardForce + -pFS.pDrag * pFS.sVelocity[1] * math.fabs(pFS.sVelocity[1])) / pFS.pMass
-        pFS.sVelocity[2] += -(pFS.pDrag * pFS.sVelocity[2] * math.fabs(pFS.sVelocity[2])) / pFS.pMass
-        # print("Velocity", pFS.sVelocity,pFS.pDrag,pFS.pMass)
-        #print("Fwd, Drag: ", ForwardForce, DragForce)
-        TargetRig.location += pFS.sVelocity @ TargetRig.matrix_world.inverted()
-        TargetRig.keyframe_insert(data_path='location',  frame=(nFrame))
-        
-        #Let's be simplistic - just rotate object based on angluar force
-        TargetRig.rotation_euler.z += math.radians(AngularForce)
-        TargetRig.rotation_euler.x += math.radians(AngularForceV)
-        TargetRig.keyframe_insert(data_path='rotation_euler',  frame=(nFrame))
-        self.sHoverTurn = 0.0
-        
-        #Forward/Backward Tilt based on force
-        if self.sHoverMode <= 0.1:
-            self.sRoot.rotation_quaternion = mathutils.Quaternion((1,0,0), math.radians(0))
-            self.sRoot.keyframe_insert(data_path='rotation_quaternion',  frame=(nFrame))
-        
-    #Handle the object movement for hovering
-    def ObjectMovmentHover(self, TargetRig, nFrame, TargetProxy, pFS):
-        # print("MovementHover")
-        RigForce = self.sHoverMode * pFS.pPecEffortGain * (TargetProxy.matrix_world.to_translation() - TargetRig.location) @ TargetRig.matrix_world
-        
-        #Limit the force available
-        xHoverMaxForce = pFS.pHoverMaxForce * (1-self.sRestAmount*0.6)
-        RigForce[1] = max(RigForce[1], -xHoverMaxForce)
-        RigForce[1] = min(RigForce[1], xHoverMaxForce * pFS.pHoverDerate)
-        RigForce[2] = max(RigForce[2], -xHoverMaxForce * pFS.pHoverDerate)
-        RigForce[2] = min(RigForce[2], xHoverMaxForce * pFS.pHoverDerate)
-        RigForce[0] = max(RigForce[0], -xHoverMaxForce * pFS.pHoverDerate)
-        RigForce[0] = min(RigForce[0], xHoverMaxForce * pFS.pHoverDerate)
-
-        #Calculate velocity
-        pFS.sVelocity[0] += (RigForce[0] - pFS.pDrag * pFS.sVelocity[0] * math.fabs(pFS.sVelocity[0])) / pFS.pMass
-        pFS.sVelocity[1] += (RigForce[1] - pFS.pDrag * pFS.sVelocity[1] * math.fabs(pFS.sVelocity[1])) / pFS.pMass
-        pFS.sVelocity[2] += (RigForce[2] - pFS.pDrag * pFS.sVelocity[2] * math.fabs(pFS.sVelocity[2])) / pFS.pMass
-        TargetRig.location += pFS.sVelocity @ TargetRig.matrix_world.inverted()
-        TargetRig.keyframe_insert(data_path='location',  frame=(nFrame))
-        # print("sVelocity", pFS.sVelocity)
-        
-        #Rotate model direction to match target
-        # TargetRig.rotation_mode = 'QUATERNION'
-        xTargetQuat = TargetProxy.matrix_world.to_quaternion() @ mathutils.Quaternion((0,0,1),math.radians(self.sStartAngle))
-        xRigQuat = TargetRig.rotation_euler.to_quaternion()
-        xRigQuat = xRigQuat.slerp(xTargetQuat,pFS.pPecTurnAssist/100.0)
-        TargetRig.rotation_euler = xRigQuat.to_euler('XYZ', TargetRig.rotation_euler)
-        # TargetRig.rotation_mode = 'XYZ'
-        TargetRig.keyframe_insert(data_path='rotation_euler',  frame=(nFrame))
-        
-        #Forward/Backward Tilt based on force
-        if RigForce[1] < 0:
-            rf = RigForce[1] * pFS.pHoverDerate
-        else:
-            rf = RigForce[1] 
-        TiltAngle = math.radians(pFS.pHoverTilt * rf / (pFS.pHoverMaxForce * pFS.pHoverDerate))
-        # self.sRoot.rotation_quaternion = mathutils.Quaternion((-1,0,0), math.radians(0))
-        self.sRoot.rotation_quaternion = self.sRoot.rotation_quaternion.slerp(mathutils.Quaternion((1,0,0), TiltAngle),0.03)
-        self.sRoot.keyframe_insert(data_path='rotation_quaternion',  frame=(nFrame))
-        
-        #Get left or right turn
-        xTurnQuat = TargetRig.rotation_quaternion @ TargetProxy.matrix_world.to_quaternion().inverted()
-        self.sHoverTurn = math.degrees(xTurnQuat.to_euler()[2])
-        # print("TurnQuat:", self.sHoverTurn)
-        
-    #Handle the movement of the bones within the armature        
-    def BoneMovement(self, context):
-    
-        
-        scene = context.scene
-        pFS = scene.FSimProps
+    def SampleTargets(self, scene):
+        #Extract every target trajectory for the whole range up front
         pFSM = scene.FSimMainProps
-        startFrame = pFSM.fsim_start_frame
-        endFrame = pFSM.fsim_end_frame
-        self.sStartAngle = pFSM.fsim_startangle
-        
-        #Get the current Target Rig
-        # try:
-        # print("nArmature, sAmartures: ", self.nArmature, self.sArmatures)
-        TargetRig = scene.objects.get(self.sArmatures[self.nArmature])
-        # except IndexError:
-            # TargetRig = None
-        self.sTargetRig = TargetRig
-    
-        #Check the required Rigify bones are present
-        self.sRoot = TargetRig.pose.bones.get("root")
-        self.sTorso = TargetRig.pose.bones.get("torso")
-        self.sSpine_master = TargetRig.pose.bones.get("spine_master")
-        if self.sSpine_master is None:
-            self.sSpine_master = TargetRig.pose.bones.get("spine_master.002")
-        self.sBack_fin1 = TargetRig.pose.bones.get("back_fin_masterBk.001")
-        if self.sBack_fin1 is None:
-            self.sBack_fin1 = TargetRig.pose.bones.get("back_fin.T.Bk_master")
-        self.sBack_fin2 = TargetRig.pose.bones.get("back_fin_masterBk")
-        if self.sBack_fin2 is None:
-            self.sBack_fin2 = TargetRig.pose.bones.get("back_fin.B.Bk_master")
-        self.sBack_fin_middle = TargetRig.pose.bones.get("DEF-back_fin.T.001.Bk")
-        self.sChest = TargetRig.pose.bones.get("chest")
-        self.sSideFinL = TargetRig.pose.bones.get("side_fin.L")
-        self.sSideFinR = TargetRig.pose.bones.get("side_fin.R")
-        print("Shark Bone Types:", self.sTorso, self.sChest, self.sBack_fin1, self.sBack_fin2)
-        if (self.sSpine_master is None) or (self.sTorso is None) or (self.sChest is None) or (self.sBack_fin1 is None) or (self.sBack_fin2 is None) or (self.sBack_fin_middle is None) or (self.sSideFinL is None) or (self.sSideFinR is None):
-            self.report({'ERROR'}, "Sorry, this addon needs a Rigify rig generated from a Shark Metarig")
-            print("Not an Suitable Rigify Armature")
-            return 0,0
-            
-        # Pectoral fins if they exist
-        self.sPecFinTopL = TargetRig.pose.bones.get("tpec_master.L")
-        if self.sPecFinTopL is None:
-            self.sPecFinTopL = TargetRig.pose.bones.get("t_master.L")
-        self.sPecFinTopR = TargetRig.pose.bones.get("tpec_master.R")
-        if self.sPecFinTopR is None:
-            self.sPecFinTopR = TargetRig.pose.bones.get("t_master.R")
-        self.sPecFinBottomL = TargetRig.pose.bones.get("bpec_master.L")
-        if self.sPecFinBottomL is None:
-            self.sPecFinBottomL = TargetRig.pose.bones.get("b_master.L")
-        self.sPecFinBottomR = TargetRig.pose.bones.get("bpec_master.R")
-        if self.sPecFinBottomR is None:
-            self.sPecFinBottomR = TargetRig.pose.bones.get("b_master.R")
-        self.sPecFinPalmL = TargetRig.pose.bones.get("pec_palm.L")
-        self.sPecFinPalmR = TargetRig.pose.bones.get("pec_palm.R")
-        if (self.sPecFinTopL is None) or (self.sPecFinTopR is None) or (self.sPecFinBottomL is None) or (self.sPecFinBottomR is None) or (self.sPecFinPalmL is None) or (self.sPecFinPalmR is None):
-            print("Not a Goldfish Armature")
-            self.sGoldfish = False
-            self.sHoverMode = 0.0
-            
-        #initialise state variabiles
-        self.sState = 0.0
-        self.AngularForceV = 0.0
-        self.sPecState = 0.0
-        pFS.sVelocity[0] = pFS.sVelocity[1] = pFS.sVelocity[2] = 0.0
-        # print("Init SVelocity", pFS.sVelocity)
-            
-        #Get TargetProxy object details
-        try:
-            TargetProxyName = self.sRoot["TargetProxy"]
-            # print("TargetProxyName: ", TargetProxyName)
-            self.sTargetProxy = bpy.data.objects[TargetProxyName]
-        except:
-            self.sTargetProxy = None
+        proxies = []
+        for name in self.run.sArmatures:
+            root = scene.objects[name].pose.bones.get("root")
+            if root is not None:
+                proxies.append(bpy.data.objects.get(root.get("TargetProxy", "")))
+        #The camera is sampled in the same sweep for the level of detail
+        camera = scene.camera
+        if pFSM.fsim_lod and camera is not None and not self.run.sRange:
+            proxies.append(camera)
+        self.run.sTrajectories = trajectory_sampler.SampleTrajectories(scene, proxies, self.run.sStartFrame, self.run.sEndFrame)
+        if pFSM.fsim_lod and camera is not None and not self.run.sRange:
+            corners = camera.data.view_frame(scene=scene)
+            depth = 1.0 if camera.data.type == 'ORTHO' else -corners[0].z
+            self.run.sCameraFrame = sim_lod.CameraFrame(max(c.x for c in corners) / depth, max(c.y for c in corners) / depth, camera.data.type == 'ORTHO')
+            self.run.sCamera = self.run.sTrajectories[camera.name]
+            self.run.sLod = (pFSM.fsim_lod_near, max(pFSM.fsim_lod_near, pFSM.fsim_lod_far), pFSM.fsim_lod_step)
+
+    def SplitFollowers(self, scene):
+        #With followers on, only armatures marked 'fsim_leader' are simulated.  The rest follow the
+        #leader named by their 'fsim_follow' property, or else the nearest one
+        self.run.sFollowers = []
+        self.run.sLeaders = set()
+        self.run.sLeaderBakes = {}
+        if not scene.FSimMainProps.fsim_followers or self.run.sRange:
+            return
+        leaders = [name for name in self.run.sArmatures if scene.objects[name].get("fsim_leader")]
+        if not leaders:
+            return
+        for name in self.run.sArmatures:
+            if name in leaders:
+                continue
+            rig = scene.objects[name]
+            leader = rig.get("fsim_follow")
+            if leader not in leaders:
+                leader = min(leaders, key=lambda other: (scene.objects[other].location - rig.location).length)
+            self.run.sFollowers.append((name, leader))
+        self.run.sLeaders = {leader for name, leader in self.run.sFollowers}
+        self.run.sArmatures = leaders
+        self.run.nArmature = len(self.run.sArmatures) - 1
+
+    def FollowLeaders(self, context):
+        #Derive the followers from the finished bakes of their leaders
+        scene = context.scene
+        sFPM = scene.FSimMainProps
+        for name, leader in self.run.sFollowers:
+            bake = self.run.sLeaderBakes.get(leader)
+            fish = self.ResolveBones(scene.objects[name])
+            if bake is None or fish is None:
+                continue
+            rig = fish.rig
+            fish.state = sim_kernel.FishState(rig.location, rig.rotation_euler, rig.scale, fish.goldfish, self.FishSeed(scene, rig))
+            try:
+                self.RemoveKeyframes(rig, [bone for role, bone in fish.bones.items() if role != "back_fin_middle"])
+            except AttributeError:
+                pass
+            keyframe_writer.SetRotationModes(fish.bones, self.run.sMinimalKeys)
+            fish.euler = self.run.sMinimalKeys
+            fish.bake = sim_kernel.FollowLeader(fish.state, bake, fish.trajectory, self.run.sStartFrame, self.run.sEndFrame,
+                                                sFPM.fsim_follow_offset, sFPM.fsim_follow_jitter)
+            self.WriteKeyframes(fish)
+        self.run.sLeaderBakes = {}
+
+    def FishSeed(self, scene, rig):
+        #Seed of the armature's random stream - from the scene seed and either its own 'fsim_seed' or its name
+        own = rig.get("fsim_seed")
+        return sim_kernel.FishSeed(scene.FSimMainProps.fsim_seed, "id:{}".format(own) if own is not None else rig.name)
+
+    def FindResume(self, scene):
+        #Load the checkpoints of every armature, and find the latest frame all of them can carry on from.
+        #Armatures that are unchanged or in the result cache don't need one
+        sFPM = scene.FSimMainProps
+        startFrame = self.run.sStartFrame
+        self.run.sCheckpoints = {}
+        self.run.sResumeFrame = None
+        common = None
+        for name in self.run.sArmatures:
+            rig = scene.objects[name]
+            proxyName = rig.pose.bones["root"].get("TargetProxy", "")
+            key = sim_kernel.RunKey(self.run.sParams, startFrame, proxyName, self.FishSeed(scene, rig),
+                                    sFPM.fsim_minimal_keys, sFPM.fsim_cycles, sFPM.fsim_output)
+            frames = {}
+            stored = rig.get("fsim_checkpoints")
+            if stored is not None and rig.get("fsim_checkpoint_key") == key:
+                frames = {int(nFrame): array('d', values) for nFrame, values in stored.items()}
+            checkpoints = sim_kernel.Checkpoints(sFPM.fsim_checkpoint_every, self.run.sTrajectories.get(proxyName), frames)
+            self.run.sCheckpoints[name] = (key, checkpoints)
+            #Cycles are found and swim caches written for whole runs only, followers need the whole bake of their leader,
+            #and level of detail tiers can change with the camera
+            resume = (sFPM.fsim_resume and not sFPM.fsim_cycles and sFPM.fsim_output == 'KEYS' and not self.run.sFollowers
+                      and not self.run.sRange and self.run.sLod is None)
+            if resume and self.run.sCache is not None:
+                fish = self.ResolveBones(rig)
+                if fish is not None and self.LookUp(scene, fish)[2] is not None:
+                    continue
+            valid = set(checkpoints.Valid(startFrame, self.run.sEndFrame)) if resume else set()
+            common = valid if common is None else common & valid
+        if common:
+            self.run.sResumeFrame = max(common)
+            print("Resuming from frame", self.run.sResumeFrame)
+        self.run.sFirstFrame = self.run.sResumeFrame + 1 if self.run.sResumeFrame is not None else startFrame
+
+    def PrepareFish(self, context, TargetRig):
+        #Clear the old simulation from an armature and set up its kernel state.  The scene must be on the start frame
+        startFrame = self.run.sStartFrame
+        fish = self.ResolveBones(TargetRig)
+        if fish is None:
+            return None
+        fish.checkpointKey, fish.checkpoints = self.run.sCheckpoints[TargetRig.name]
+
+        if self.run.sRange:
+            #Carry on from the existing animation at the start of the range, keeping the keys outside it
+            fish.euler = fish.bones["spine"].rotation_mode != 'QUATERNION'
+            fish.state = self.AnimatedState(context.scene, fish, startFrame)
+            row = sim_kernel.InitialRow(fish.state)
+            fish.bake = sim_kernel.FishBake(startFrame, fish.goldfish)
+            fish.bake.Append(row)
+            fish.row = row
+            fish.tail = self.MeasureTail(context, fish, row)
+            return fish
+        keyframe_writer.SetRotationModes(fish.bones, self.run.sMinimalKeys)
+        fish.euler = self.run.sMinimalKeys
+
+        #An unchanged fish keeps its keys, or comes back from the result cache
+        fish.state, fish.resultKey, cached = self.LookUp(context.scene, fish)
+        if cached is True:
+            self.run.sCache.hits += 1
+            return None
+
+        if self.run.sResumeFrame is not None and cached is None:
+            #Carry on from the checkpoint, keeping the keys up to it
+            fish.state, fish.row = fish.checkpoints.Restore(self.run.sResumeFrame)
+            fish.bake = sim_kernel.FishBake(self.run.sFirstFrame, fish.goldfish)
+            restRow = sim_kernel.InitialRow(sim_kernel.FishState(fish.state.sLocation, fish.state.sRotation))
+            fish.tail = self.MeasureTail(context, fish, restRow)
+            self.SetPose(fish, fish.row)
+            return fish
+        fish.checkpoints.frames.clear()
 
-        print("TargetProxyName: ", self.sTargetProxy.name)
-        #Go back to the start before removing keyframes to remember starting point
-        context.scene.frame_set(startFrame)
-       
         #Delete existing keyframes
         try:
-            self.RemoveKeyframes(TargetRig, [self.sSpine_master, self.sBack_fin1, self.sBack_fin2, self.sChest, self.sSideFinL, self.sSideFinR, self.sPecFinPalmL, self.sPecFinPalmR, self.sPecFinTopL, self.sPecFinBottomL, self.sPecFinTopR, self.sPecFinBottomR, self.sRoot, self.sTorso])
+            self.RemoveKeyframes(TargetRig, [bone for role, bone in fish.bones.items() if role != "back_fin_middle"])
         except AttributeError:
             pass
             # print("info: no keyframes")
-        
-        #record to previous tail position
+
+        if cached is not None:
+            fish.fromCache = True
+            fish.bake = cached.bake
+            fish.state, fish.row = sim_kernel.UnpackState(cached.state)
+            fish.checkpoints.frames.update(cached.checkpoints)
+            self.WriteKeyframes(fish)
+            return None
+
+        #Start from the rest pose, keys are collected and written when the armature is finished
+        row = sim_kernel.InitialRow(fish.state)
+        fish.bake = sim_kernel.FishBake(startFrame, fish.goldfish)
+        fish.bake.Append(row)
+        fish.row = row
+        #Root motion fish swim without their bones, so there is no tail to measure
+        if fish.lod != sim_lod.LOD_ROOT:
+            fish.tail = self.MeasureTail(context, fish, row)
+        return fish
+
+    def LookUp(self, scene, fish):
+        #(start state, result key, found) of an armature, worked out once per run.  found is True when the
+        #armature already holds the result, the CachedResult when the cache has it, or None
+        entry = self.run.sResults.get(fish.rig.name)
+        if entry is None:
+            rig = fish.rig
+            #initialise state variables, and randomise parameters
+            state = sim_kernel.FishState(rig.location, rig.rotation_euler, rig.scale, fish.goldfish, self.FishSeed(scene, rig))
+            state.Randomise(self.run.sParams)
+            key = None
+            found = None
+            if self.run.sCache is not None:
+                key = sim_kernel.ResultKey(self.run.sParams, state, fish.trajectory, self.run.sStartFrame, self.run.sEndFrame,
+                                           self.RestGeometry(fish), fish.lod, self.KeyStep(fish))
+                fish.resultKey = key
+                found = True if self.Unchanged(fish) else self.run.sCache.Get(key)
+            entry = self.run.sResults[rig.name] = (state, key, found)
+        return entry
+
+    def AnimatedState(self, scene, fish, nFrame):
+        #Kernel state of an armature from its existing animation at nFrame - where it is, which way it faces
+        #and how fast it was moving over the frame before
+        rig = fish.rig
+        action = rig.animation_data.action if rig.animation_data is not None else None
+
+        def Value(data_path, index, frame, current):
+            fcurve = action.fcurves.find(data_path, index=index) if action is not None else None
+            return fcurve.evaluate(frame) if fcurve is not None else current
+
+        location = [Value("location", i, nFrame, rig.location[i]) for i in range(3)]
+        before = [Value("location", i, nFrame - 1, rig.location[i]) for i in range(3)]
+        rotation = [Value("rotation_euler", i, nFrame, rig.rotation_euler[i]) for i in range(3)]
+        root = fish.bones["root"]
+        rootPath = 'pose.bones["{}"].rotation_quaternion'.format(root.name)
+        state = sim_kernel.FishState(location, rotation, rig.scale, fish.goldfish, self.FishSeed(scene, rig))
+        state.Randomise(self.run.sParams)
+        state.sVelocity = sim_kernel.WorldToRig(state, [a - b for a, b in zip(location, before)])
+        state.sRootQuat = [Value(rootPath, i, nFrame, root.rotation_quaternion[i]) for i in range(4)]
+
+        #Hovering if it is already close to its target
+        if fish.goldfish and fish.trajectory is not None:
+            matrix, size = fish.trajectory.Sample(nFrame)
+            dist = math.sqrt(sum((matrix[4 * i + 3] - location[i]) ** 2 for i in range(3)))
+            state.sHoverMode = 1.0 if dist < size * self.run.sParams.pHoverDist else 0.0
+        return state
+
+    def RestGeometry(self, fish):
+        #Rest positions and orientations of the simulated bones, for the result key
+        geometry = []
+        for role in sorted(fish.bones):
+            bone = fish.bones[role].bone
+            geometry.append((role, bone.name, tuple(round(v, 6) for row in bone.matrix_local for v in row)))
+        return tuple(geometry)
+
+    def OpenCache(self, scene):
+        #Set up the result cache for this run
+        sFPM = scene.FSimMainProps
+        self.run.sCache = None
+        if sFPM.fsim_cache and not self.run.sRange:
+            folder = bpy.path.abspath(sFPM.fsim_cache_dir) if sFPM.fsim_cache_dir else ""
+            if not folder:
+                folder = bpy.path.abspath("//fsim_cache") if bpy.data.filepath else os.path.join(bpy.app.tempdir, "fsim_cache")
+            self.run.sCache = result_cache.ResultCache(folder, sFPM.fsim_cache_size * 1024 * 1024)
+
+        #Keyframe decimation tolerances and channels, the cache keeps the full bakes
+        self.run.sMinimalKeys = sFPM.fsim_minimal_keys
+        self.run.sCycles = (sFPM.fsim_cycle_tolerance, sFPM.fsim_cycle_repeats) if sFPM.fsim_cycles else None
+        self.run.sSwimDir = None
+        self.run.sSwimHalf = sFPM.fsim_swim_half
+        if sFPM.fsim_output == 'CACHE':
+            self.run.sSwimDir = SwimFolder(sFPM)
+        self.run.sTolerances = None
+        self.run.sKeysWritten = 0
+        self.run.sKeysDropped = 0
+        if sFPM.fsim_decimate:
+            self.run.sTolerances = {"location": sFPM.fsim_tol_location, "rotation": sFPM.fsim_tol_rotation, "scale": sFPM.fsim_tol_scale}
+
+    def Unchanged(self, fish):
+        #Whether the armature already holds the result of this run
+        rig = fish.rig
+        if rig.get("fsim_result_key") != self.RigKey(fish) or rig.name in self.run.sLeaders:
+            return False
+        if self.run.sSwimDir is not None:
+            path = rig.get("fsim_swim_cache")
+            return path is not None and os.path.exists(bpy.path.abspath(path))
+        return rig.animation_data is not None and rig.animation_data.action is not None
+
+    def RigKey(self, fish):
+        #The result key stored on the rig also records which channels were keyed and how they were decimated
+        key = fish.resultKey + (":minimal" if self.run.sMinimalKeys else "")
+        if self.run.sSwimDir is not None:
+            return key + (":swim16" if self.run.sSwimHalf else ":swim")
+        if self.run.sCycles is not None:
+            key += ":cycles{:g},{}".format(*self.run.sCycles)
+        if self.run.sTolerances is None:
+            return key
+        return "{}:{location:g},{rotation:g},{scale:g}".format(key, **self.run.sTolerances)
+
+    def Report(self):
+        #Summarise the run in the status bar
+        if self.run.sCache is not None and self.run.sCache.hits:
+            self.report({'INFO'}, "{} of {} armatures unchanged or restored from the cache".format(self.run.sCache.hits, len(self.run.sArmatures)))
+        if self.run.sTolerances is not None and self.run.sKeysDropped:
+            self.report({'INFO'}, "Decimation kept {} keys and dropped {} ({:.0%})".format(
+                self.run.sKeysWritten, self.run.sKeysDropped, self.run.sKeysDropped / (self.run.sKeysWritten + self.run.sKeysDropped)))
+        if self.run.sFollowers:
+            self.report({'INFO'}, "{} followers derived from {} leaders".format(len(self.run.sFollowers), len(self.run.sLeaders)))
+        if self.run.sLod is not None:
+            self.report({'INFO'}, "Level of detail: " + ", ".join("{} {}".format(count, name) for count, name in zip(self.run.sTiers, sim_lod.TIER_NAMES)))
+
+    def MeasureTail(self, context, fish, row):
+        #Cache the rest geometry of the tail, then measure how much of each spine control reaches the fin.
+        #This is the only pose evaluation the simulation needs
+        bones = fish.bones
+        fin = bones["back_fin_middle"]
+        pivots = {joint: bones[joint].bone.head_local for joint in sim_kernel.TAIL_JOINTS}
+        bases = {joint: bones[joint].bone.matrix_local.to_3x3() for joint in sim_kernel.TAIL_JOINTS}
+        self.SetPose(fish, row)
+        context.view_layer.update()
+        tail = sim_kernel.TailGeometry(fin.matrix.translation, pivots, bases)
+        for joint, track in (("chest", "chest_z"), ("spine", "spine_z"), ("torso", "torso_y")):
+            probe = dict(row)
+            probe[track] = TAIL_PROBE
+            self.SetPose(fish, probe)
+            context.view_layer.update()
+            tail.gains[joint] = sim_kernel.CalibrateGain(tail, joint, TAIL_PROBE, fin.matrix.translation.x)
+        self.SetPose(fish, row)
+        return tail
+
+    #Handle the movement of the bones within the armature
+    def BoneMovement(self, context):
+        startFrame = self.run.sStartFrame
+
+        #Get the current Target Rig
+        TargetRig = context.scene.objects.get(self.run.sArmatures[self.run.nArmature])
+        self.run.sTargetRig = TargetRig
+
+        #Go back to the start before removing keyframes to remember starting point
         context.scene.frame_set(startFrame)
-        # context.scene.update()
-        self.SetInitialKeyframe(TargetRig, startFrame)
-        
-        #randomise parameters
-        rFact = pFS.pRandom
-        self.rMaxTailAngle = pFS.pMaxTailAngle * (1 + (random() * 2.0 - 1.0) * rFact)
-        self.rMaxFreq = pFS.pMaxFreq * (1 + (random() * 2.0 - 1.0) * rFact)
-        
-    def PecSimulation(self, nFrame, pFS, startFrame):
-        # print("Pecs")
-        if self.sPecFinTopL == None or self.sPecFinTopR == None:
+        self.run.sSim = self.PrepareFish(context, TargetRig)
+        if self.run.sSim is not None:
+            print("TargetProxyName: ", self.run.sSim.proxy.name if self.run.sSim.proxy else None)
+        context.scene.frame_set(self.run.sFirstFrame)
+
+    def SchoolMovement(self, context, vector=True):
+        #Set up every armature at once so they are all stepped in a single sweep of the timeline,
+        #either together with NumPy (vector) or one after another on each frame
+        startFrame = self.run.sStartFrame
+        context.scene.frame_set(startFrame)
+        self.run.sSchool = []
+        for name in self.run.sArmatures:
+            fish = self.PrepareFish(context, context.scene.objects.get(name))
+            if fish is not None:
+                self.run.sSchool.append(fish)
+        self.run.sSchoolVector = vector
+        if not vector:
+            context.scene.frame_set(self.run.sFirstFrame)
             return
-        
-        #Update State and main angle
-        self.sPecState = self.sPecState + 360.0 / pFS.pMaxPecFreq
-        xPecAngle = math.sin(math.radians(self.sPecState))*math.radians(pFS.pMaxPecAngle)
-        yPecAngle = math.sin(math.radians(self.sPecState+90.0))*math.radians(pFS.pMaxPecAngle * 2)
-        
-        #Rest Period Calculations
-
-        if nFrame >= self.sRestartFrame:
-            self.sRestAmount = max(0.0, self.sRestAmount - pFS.pPecTransition)
-            if self.sRestAmount < 0.1:
-                self.sRestFrame = nFrame + pFS.pPecDuration
-                self.sRestartFrame = self.sRestFrame + pFS.pPecDuty * pFS.pPecDuration 
-            
-        if (nFrame >= self.sRestFrame and nFrame < self.sRestartFrame and self.sRestAmount < 1.0):
-            self.sRestAmount = min(1.0, self.sRestAmount + pFS.pPecTransition)
-            
-        # print("RestAmount: ", self.sRestAmount, self.sRestFrame, self.sRestartFrame)
-        
-        #Add the same side fin wobble to the pec fins to stop them looking boring when not flapping
-        SideFinRot = math.radians(math.sin(math.radians(self.sState + pFS.pSideFinPhase)) * pFS.pMaxSideFinAngle)
-
-        #Slerp between oscillating angle and rest angle depending on hover status and reset periods
-        # xRestAmount = 1 means no flapping due to either resting or not hovering
-        xRestAmount = (1.0 - (1.0 - self.sRestAmount) * self.sHoverMode)
-        # print("xRestAmaount: ", xRestAmount)
-        # print("RestAmount: ", self.sRestAmount, self.sRestFrame, self.sRestartFrame)
-        # print("HoverMode: ", self.sHoverMode)
-        yAng = mathutils.Quaternion((0.0, 1.0, 0.0), yPecAngle)
-        # yAng = mathutils.Quaternion((0.0, 1.0, 0.0), 0)
-        xAng = yAng @ mathutils.Quaternion((1.0, 0.0, 0.0), -xPecAngle)
-        xAng = xAng.slerp(mathutils.Quaternion((1.0, 0.0, 0.0), math.radians(pFS.pPecOffset)), xRestAmount)
-        self.sPecFinPalmL.rotation_quaternion = xAng @ mathutils.Quaternion((1.0, 0.0, 0.0), SideFinRot)
-        self.sPecFinPalmL.keyframe_insert(data_path='rotation_quaternion',  frame=(nFrame))
-        # print("Palm Animate: ", nFrame)
-
-        #Tip deflection based on phase offset
-        xMaxPecScale = pFS.pMaxPecAngle * ( 1.0 / pFS.pPecStiffness) * 0.2 / 30.0
-        
-        self.sPec_scale = 1.0 + math.sin(math.radians(self.sPecState - pFS.pPecPhase)) * xMaxPecScale * (1.0 - xRestAmount)
-        
-        self.sPecFinTopL.scale[1] = self.sPec_scale
-        self.sPecFinBottomL.scale[1] = 1 - (1 - self.sPec_scale) * pFS.pPecStubRatio
-        self.sPecFinTopL.keyframe_insert(data_path='scale',  frame=(nFrame))
-        self.sPecFinBottomL.keyframe_insert(data_path='scale',  frame=(nFrame))
+        self.run.sSchoolGroups = []
+        for rootOnly in (False, True):
+            group = [fish for fish in self.run.sSchool if (fish.lod == sim_lod.LOD_ROOT) == rootOnly]
+            if group:
+                self.run.sSchoolGroups.append(SchoolGroup(group, rootOnly, startFrame, self.run.sEndFrame))
+        context.scene.frame_set(self.run.sFirstFrame)
 
-        #copy to the right fin
-        
-        #If fins are opposing
-        if not pFS.pPecSynch:
-            yAng = mathutils.Quaternion((0.0, 1.0, 0.0), yPecAngle)
-            xAng = yAng @ mathutils.Quaternion((1.0, 0.0, 0.0), xPecAngle)
-            xAng = xAng.slerp(mathutils.Quaternion((1.0, 0.0, 0.0), math.radians(pFS.pPecOffset)), xRestAmount)
-            self.sPecFinPalmR.rotation_quaternion = xAng @ mathutils.Quaternion((1.0, 0.0, 0.0), SideFinRot)
-            self.sPecFinTopR.scale[1] = 1/self.sPec_scale
-            self.sPecFinBottomR.scale[1] = 1 - (1 - 1/self.sPec_scale) * pFS.pPecStubRatio
-        else:
-            yAng = mathutils.Quaternion((0.0, 1.0, 0.0), -yPecAngle)
-            xAng = yAng @ mathutils.Quaternion((1.0, 0.0, 0.0), -xPecAngle)
-            xAng = xAng.slerp(mathutils.Quaternion((1.0, 0.0, 0.0), math.radians(pFS.pPecOffset)), xRestAmount)
-            self.sPecFinPalmR.rotation_quaternion = xAng @ mathutils.Quaternion((1.0, 0.0, 0.0), SideFinRot)
-            self.sPecFinTopR.scale[1] = self.sPec_scale
-            self.sPecFinBottomR.scale[1] = 1 - (1 - self.sPec_scale) * pFS.pPecStubRatio
-        self.sPecFinPalmR.keyframe_insert(data_path='rotation_quaternion',  frame=(nFrame))
-        self.sPecFinTopR.keyframe_insert(data_path='scale',  frame=(nFrame))
-        self.sPecFinBottomR.keyframe_insert(data_path='scale',  frame=(nFrame))
-        
-       
-        
     def ModalMove(self, context):
         scene = context.scene
-        pFS = scene.FSimProps
-        pFSM = scene.FSimMainProps
-        startFrame = pFSM.fsim_start_frame
-        endFrame = pFSM.fsim_end_frame
-        
+        startFrame = self.run.sStartFrame
+        endFrame = self.run.sEndFrame
+
         nFrame = scene.frame_current
         # print("nFrame: ", nFrame)
-        
-        
-        #Get the effort and direction change to head toward the target
-        RqdEffort, RqdDirection, RqdDirectionV = self.Target(self.sTargetRig, self.sTargetProxy, pFS)
-        if nFrame == startFrame:
-            self.sOldRqdEffort = RqdEffort
+        fish = self.run.sSim
+        if fish is None:
+            return 0
+
+        row = self.StepOne(fish, nFrame, startFrame)
+        if row is None:
             context.scene.frame_set(nFrame + 1)
-            self.sOld_back_fin = self.sBack_fin_middle.matrix.decompose()[0]
             return 1
-        TargetEffort = pFS.pEffortGain * (pFS.pEffortIntegral * RqdEffort + (RqdEffort - self.sOldRqdEffort))
-        self.sOldRqdEffort = RqdEffort
-        pFS.sEffort = pFS.pEffortGain * RqdEffort * pFS.pEffortRamp + pFS.sEffort * (1.0-pFS.pEffortRamp)
-        pFS.sEffort = min(pFS.sEffort, 1.0)
-        #print("Required, Effort:", RqdEffort, pFS.sEffort)
-        
-        #Pec fin simulation
-        self.PecSimulation(nFrame, pFS, startFrame)
-        
-        #Convert effort into tail frequency and amplitude (Fades to a low value if in hover mode)
-        pFS.pFreq = self.rMaxFreq * ((1-self.sHoverMode) * (1.0/(pFS.sEffort+ 0.01)) + self.sHoverMode * 2.0)
-        pFS.pTailAngle = self.rMaxTailAngle * ((1-self.sHoverMode) * pFS.sEffort + self.sHoverMode * pFS.pHoverTailFrc)
-        #print("rMax, Frc: %.2f, %.2f" % (self.rMaxTailAngle, pFS.pHoverTailFrc))
-        
-        #Convert direction into Tail Offset angle (Work out swim turn angle and Hover turn angle and mix)
-        xSwimTailAngleOffset = RqdDirection * pFS.pMaxSteeringAngle
-        xHoverTailAngleOffset = pFS.pMaxSteeringAngle * self.sHoverTurn / 30.0
-        xHoverTailAngleOffset = 0.0
-        # xHoverFactor = max(0,(1.0 - self.sHoverMode * 4.0))
-        pFS.sTailAngleOffset = pFS.sTailAngleOffset * (1 - pFS.pEffortRamp) + pFS.pEffortRamp * max(0,(1.0 - self.sHoverMode*2.0)) * xSwimTailAngleOffset + pFS.pEffortRamp * self.sHoverMode * xHoverTailAngleOffset
-        # pFS.sTailAngleOffset = pFS.sTailAngleOffset * (1 - pFS.pEffortRamp) + pFS.pEffortRamp * xSwimTailAngleOffset
-        # print("xHoverOffset, TailOffset: ", xHoverTailAngleOffset, pFS.sTailAngleOffset)
-        # print("HoverMode, xSwimTailAngleOffset: ", self.sHoverMode, xSwimTailAngleOffset)
-        
-        #Hover 'Twitch' calculations (Make the fish do some random twisting during hover mode)
-        if self.sHoverMode < 0.5:
-            #Not hovering so reset
-            self.sTwitchTarget = 0.0
-            self.sTwitchFrame = 0.0
-        else:
-            #Hovering, so check if the twitch frame has been reached
-            if nFrame >= self.sTwitchFrame:
-                #set new twitch frame
-                self.sTwitchFrame = nFrame + pFS.pHoverTwitchTime * (random() - 0.5)
-                #Only twitch while not resting
-                if self.sTwitchFrame < self.sRestartFrame and self.sTwitchFrame > self.sRestFrame:
-                    self.sTwitchFrame = self.sRestartFrame + 5
-                #set a new twitch target angle
-                self.sTwitchTarget = pFS.pHoverTwitch * 2.0 * (random() - 0.5)
-        self.sTwitchAngle = self.sTwitchAngle * 0.9 + 0.1 * self.sTwitchTarget
-        #print("Twitch Angle: ", self.sTwitchAngle)
-            
-        
-        
-        #Spine Movement
-        self.sState = self.sState + 360.0 / pFS.pFreq
-        xTailAngle = math.sin(math.radians(self.sState))*math.radians(pFS.pTailAngle) + math.radians(pFS.sTailAngleOffset) + math.radians(self.sTwitchAngle)
-        #print("Components: %.2f, %.2f, %.2f" % (math.sin(math.radians(self.sState))*math.radians(pFS.pTailAngle),math.radians(pFS.sTailAngleOffset),math.radians(self.sTwitchAngle)))
-        #print("TailAngle", math.degrees(xTailAngle))
-        self.sSpine_master.rotation_quaternion = mathutils.Quaternion((0.0, 0.0, 1.0), xTailAngle)
-        self.sSpine_master.keyframe_insert(data_path='rotation_quaternion',  frame=(nFrame))
-        ChestRot = mathutils.Quaternion((0.0, 0.0, 1.0), -xTailAngle * pFS.pChestRatio)# - math.radians(pFS.sTailAngleOffset))
-        self.sChest.rotation_quaternion = ChestRot @ mathutils.Quaternion((1.0, 0.0, 0.0), -math.fabs(math.radians(pFS.sTailAngleOffset))*pFS.pChestRaise * (1.0 - self.sHoverMode))
-        #print("Torso:", pFS.sTailAngleOffset)
-        self.sTorso.rotation_quaternion = mathutils.Quaternion((0.0, 1.0, 0.0), -math.radians(pFS.sTailAngleOffset)*pFS.pLeanIntoTurn * (1.0 - self.sHoverMode))
-        self.sChest.keyframe_insert(data_path='rotation_quaternion',  frame=(nFrame))
-        self.sTorso.keyframe_insert(data_path='rotation_quaternion',  frame=(nFrame))
-        #context.scene.update()
-        
-        # #Tail Movment
-        if (nFrame == startFrame):
-            back_fin_dif = 0
-        else:
-            back_fin_dif = (self.sBack_fin_middle.matrix.decompose()[0].x - self.sOld_back_fin.x)
-        self.sOld_back_fin = self.sBack_fin_middle.matrix.decompose()[0]
-        
-        #Tailfin bending based on phase offset
-        pMaxTailScale = pFS.pMaxTailFinAngle * ( 1.0 / pFS.pTailFinStiffness) * 0.2 / 30.0
-        
-        self.sBack_fin1_scale = 1.0 + math.sin(math.radians(self.sState + pFS.pTailFinPhase)) * pMaxTailScale * (pFS.pTailAngle / self.rMaxTailAngle)
-        # print("Bend Factor: ", (pFS.pTailAngle / self.rMaxTailAngle))
-        
-        self.sBack_fin1.scale[1] = self.sBack_fin1_scale
-        self.sBack_fin2.scale[1] = 1 - (1 - self.sBack_fin1_scale) * pFS.pTailFinStubRatio
-        self.sBack_fin1.keyframe_insert(data_path='scale',  frame=(nFrame))
-        self.sBack_fin2.keyframe_insert(data_path='scale',  frame=(nFrame))
-        
-        
-        SideFinRot = math.sin(math.radians(self.sState + pFS.pSideFinPhase)) * pFS.pMaxSideFinAngle
-        
-       
-        self.sSideFinL.rotation_quaternion = mathutils.Quaternion((1,0,0), math.radians(-SideFinRot))
-        self.sSideFinR.rotation_quaternion = mathutils.Quaternion((1,0,0), math.radians(SideFinRot))
-       
-        self.sSideFinL.keyframe_insert(data_path='rotation_quaternion',  frame=(nFrame))
-        self.sSideFinR.keyframe_insert(data_path='rotation_quaternion',  frame=(nFrame))
-        
-        #Do Object movment with Forward force and Angular force
-        TailFinAngle = (self.sBack_fin1_scale - 1.0) * 30.0 / 0.4
-        TailFinAngleForce = math.sin(math.radians(TailFinAngle))
-        # ForwardForce = -back_fin_dif * TailFinAngleForce * pFS.pPower
-        ForwardForce =  math.fabs(math.cos(math.radians(self.sState))) * math.radians(pFS.pTailAngle) * 15.0 * pFS.pPower / pFS.pMaxFreq
-        # print("Force", ForwardForce, math.fabs(math.cos(math.radians(self.sState))), math.radians(pFS.pTailAngle))
-        
-        #Angular force due to 'swish'
-        AngularForce = back_fin_dif  / pFS.pAngularDrag
-        
-        #Angular force due to rudder effect
-        AngularForce += xTailAngle * pFS.sVelocity[1] / pFS.pAngularDrag
-        
-        #Fake Angular force to make turning more effective
-        AngularForce += -(pFS.sTailAngleOffset/pFS.pMaxSteeringAngle) * pFS.pTurnAssist
-        
-        #Angular force for vertical movement
-        self.sAngularForceV = self.sAngularForceV * (1 - pFS.pEffortRamp) + RqdDirectionV * pFS.pMaxVerticalAngle
-        
-        
-        #print("TailFinAngle, AngularForce", xTailAngle, AngularForce)
-        if self.sHoverMode < 0.1:
-            self.ObjectMovment(self.sTargetRig, ForwardForce, AngularForce, self.sAngularForceV, nFrame, self.sTargetProxy, pFS)
-        else:
-            self.ObjectMovmentHover(self.sTargetRig, nFrame, self.sTargetProxy, pFS)
-        
-        
+        if fish.lod == sim_lod.LOD_FULL:
+            self.SetPose(fish, row)
+
         #Go to next frame, or finish
         wm = context.window_manager
         # print("Frame: ", nFrame)
         if nFrame == endFrame:
             return 0
         else:
-            wm.progress_update((len(self.sArmatures) - self.nArmature)*99.0/len(self.sArmatures))
+            wm.progress_update((len(self.run.sArmatures) - self.run.nArmature)*99.0/len(self.run.sArmatures))
             context.scene.frame_set(nFrame + 1)
             return 1
-        
+
+    def StepOne(self, fish, nFrame, startFrame):
+        #Step one armature by a frame with its target and the tail fin position of its last pose, and add the
+        #result to its bake.  Root motion fish are stepped without their bones, and aren't checkpointed
+        proxy = fish.trajectory.Sample(nFrame) if fish.trajectory is not None else None
+        rootOnly = fish.lod == sim_lod.LOD_ROOT
+        if rootOnly:
+            row = sim_kernel.StepRoot(fish.state, self.run.sParams, nFrame, startFrame, proxy)
+        else:
+            row = sim_kernel.StepFish(fish.state, self.run.sParams, nFrame, startFrame, proxy, sim_kernel.TailFinX(fish.tail, fish.row))
+        if row is not None:
+            fish.row = row
+            fish.bake.Append(row)
+            if not rootOnly:
+                fish.checkpoints.Save(nFrame, fish.state, row)
+        return row
+
+    def SchoolStep(self, nFrame, startFrame):
+        #Step every armature of the school by one frame, and add the results to their bakes
+        if not self.run.sSchoolVector:
+            stepped = False
+            for fish in self.run.sSchool:
+                if self.StepOne(fish, nFrame, startFrame) is not None:
+                    stepped = True
+            return stepped
+
+        index = nFrame - startFrame
+        stepped = False
+        for group in self.run.sSchoolGroups:
+            matrices = group.matrices[:, index].astype(float)
+            sizes = group.sizes[:, index].astype(float)
+            back_fin_x = group.state.sOldBackFin if group.rootOnly else sim_school.TailFinX(group.tail, group.rows)
+            rows = sim_school.StepSchool(group.state, self.run.sParams, nFrame, startFrame, matrices, sizes, group.hasProxy, back_fin_x,
+                                         rootOnly=group.rootOnly)
+            if rows is None:
+                continue
+            stepped = True
+            group.rows = rows
+            for i, fish in enumerate(group.fish):
+                if group.rootOnly:
+                    fish.row = sim_kernel.InitialRow(fish.state)
+                    fish.row.update((name, float(values[i])) for name, values in rows.items())
+                else:
+                    fish.row = {name: float(rows[name][i]) for name in fish.bake.tracks}
+                fish.bake.Append(fish.row)
+            every = group.fish[0].checkpoints.every
+            if not group.rootOnly and every > 0 and nFrame % every == 0:
+                group.state.ToFish([fish.state for fish in group.fish])
+                for fish in group.fish:
+                    fish.checkpoints.Save(nFrame, fish.state, fish.row)
+        return stepped
+
+    def SchoolMove(self, context):
+        scene = context.scene
+        startFrame = self.run.sStartFrame
+        endFrame = self.run.sEndFrame
+        nFrame = scene.frame_current
+        if not self.run.sSchool:
+            return 0
+
+        if self.SchoolStep(nFrame, startFrame):
+            #Only full detail fish are shown swimming while they are simulated
+            for fish in self.run.sSchool:
+                if fish.lod == sim_lod.LOD_FULL:
+                    self.SetPose(fish, fish.row)
+
+        if nFrame == endFrame:
+            return 0
+        context.window_manager.progress_update((nFrame - startFrame) * 99.0 / max(1, endFrame - startFrame))
+        context.scene.frame_set(nFrame + 1)
+        return 1
+
+    def FinishSchool(self, context):
+        if self.run.sSchoolVector:
+            for group in self.run.sSchoolGroups:
+                group.state.ToFish([fish.state for fish in group.fish])
+        for fish in self.run.sSchool:
+            self.WriteKeyframes(fish)
+        self.run.sSchool = None
+        self.run.sSchoolGroups = None
+        context.scene.frame_set(self.run.sStartFrame)
 
     def modal(self, context, event):
         if event.type in {'RIGHTMOUSE', 'ESC'}:
+            if self.run.sSchool is not None:
+                self.FinishSchool(context)
+            self.WriteKeyframes(self.run.sSim)
             self.cancel(context)
             return {'CANCELLED'}
 
         if event.type == 'TIMER':
+            if self.run.sSchool is not None:
+                if self.SchoolMove(context) == 0:
+                    self.FinishSchool(context)
+                    self.FollowLeaders(context)
+                    context.window_manager.progress_end()
+                    self.Report()
+                    self.cancel(context)
+                    return {'CANCELLED'}
+                return {'PASS_THROUGH'}
+
             modal_rtn = self.ModalMove(context)
             if modal_rtn == 0:
-                # print("nArmature:", self.nArmature)
+                # print("nArmature:", self.run.nArmature)
+                self.WriteKeyframes(self.run.sSim)
                 #Go to the next rig if applicable
-                context.scene.frame_set(context.scene.FSimMainProps.fsim_start_frame)
-                if self.nArmature > 0:
-                    self.nArmature -= 1
-                    self.BoneMovement(context) 
+                context.scene.frame_set(self.run.sStartFrame)
+                if self.run.nArmature > 0:
+                    self.run.nArmature -= 1
+                    self.BoneMovement(context)
 
                 else:
+                    self.FollowLeaders(context)
                     wm = context.window_manager
                     wm.progress_end()
+                    self.Report()
+                    self.cancel(context)
                     return {'CANCELLED'}
 
         return {'PASS_THROUGH'}
@@ -640,18 +854,32 @@ class ARMATURE_OT_FSimulate(bpy.types.Operator):
         # try:
             # self.sTargetRig = scene.objects.get(sFPM.fsim_targetrig)
         # except:
-        self.sTargetRig = context.object
+        self.run = SimRun(context.object, sFPM)
         scene = context.scene
-        
+
         #Load a list of the relevant armatures
         self.armature_list(scene, sFPM)
-        
+        if not self.ValidateRun(scene):
+            return {'CANCELLED'}
+        self.SampleTargets(scene)
+        self.SplitFollowers(scene)
+        self.run.sParams = sim_kernel.SimParams.FromProps(scene.FSimProps, sFPM.fsim_startangle)
+        self.OpenCache(scene)
+        self.FindResume(scene)
+
         #Progress bar
         wm = context.window_manager
         wm.progress_begin(0.0,100.0)
 
-        scene.frame_set(sFPM.fsim_start_frame)
-        self.BoneMovement(context) 
+        #Large schools are stepped together with NumPy, small ones one armature at a time,
+        #either all in one sweep of the timeline or with a sweep per armature
+        if sim_school.PickBackend(len(self.run.sArmatures), sFPM.fsim_backend) == 'VECTOR':
+            self.SchoolMovement(context)
+        elif sFPM.fsim_single_sweep:
+            self.SchoolMovement(context, vector=False)
+        else:
+            scene.frame_set(self.run.sStartFrame)
+            self.BoneMovement(context)
         wm = context.window_manager
         self._timer = wm.event_timer_add(0.001, window=context.window)
         wm.modal_handler_add(self)
@@ -662,11 +890,260 @@ class ARMATURE_OT_FSimulate(bpy.types.Operator):
         wm.event_timer_remove(self._timer)
 
 
+class ARMATURE_OT_FSimulateFast(ARMATURE_OT_FSimulate):
+    """Simulate all armatures with a similar name to selected in one go, without updating the viewport"""
+    bl_idname = "armature.fsimulate_fast"
+    bl_label = "Simulate (Fast)"
+    bl_options = {'REGISTER', 'UNDO'}
+
+    def execute(self, context):
+        scene = context.scene
+        sFPM = scene.FSimMainProps
+        self.run = SimRun(context.object, sFPM)
+        startFrame = self.run.sStartFrame
+        endFrame = self.run.sEndFrame
+
+        self.armature_list(scene, sFPM)
+        if not self.ValidateRun(scene):
+            return {'CANCELLED'}
+        self.SampleTargets(scene)
+        self.SplitFollowers(scene)
+        self.run.sParams = sim_kernel.SimParams.FromProps(scene.FSimProps, sFPM.fsim_startangle)
+        self.OpenCache(scene)
+        self.FindResume(scene)
+
+        wm = context.window_manager
+        wm.progress_begin(0.0, 100.0)
+        scene.frame_set(startFrame)
+
+        if sFPM.fsim_workers > 1 and len(self.run.sArmatures) > 1:
+            self.PoolMovement(context)
+        elif sim_school.PickBackend(len(self.run.sArmatures), sFPM.fsim_backend) == 'VECTOR':
+            self.SchoolMovement(context)
+            if self.run.sSchool:
+                firstFrame = self.run.sFirstFrame
+                frames = endFrame - firstFrame + 1
+                for nFrame in range(firstFrame, endFrame + 1):
+                    self.SchoolStep(nFrame, startFrame)
+                    wm.progress_update((nFrame - firstFrame + 1) * 99.0 / frames)
+            self.FinishSchool(context)
+        else:
+            self.LocalMovement(context)
+
+        self.FollowLeaders(context)
+        wm.progress_end()
+        self.Report()
+        return {'FINISHED'}
+
+    def FinishFish(self, context, fish):
+        #Write a finished armature
+        self.WriteKeyframes(fish)
+
+    def LocalMovement(self, context):
+        #One armature at a time, straight through the whole range
+        scene = context.scene
+        startFrame = self.run.sStartFrame
+        endFrame = self.run.sEndFrame
+        wm = context.window_manager
+        for nArmature, name in enumerate(self.run.sArmatures):
+            fish = self.PrepareFish(context, scene.objects.get(name))
+            if fish is not None:
+                sim_kernel.SimulateFish(self.run.sParams, fish.state, fish.trajectory, startFrame, endFrame, fish.tail,
+                                        bake=fish.bake, row=fish.row, firstFrame=self.run.sFirstFrame, checkpoints=fish.checkpoints,
+                                        rootOnly=fish.lod == sim_lod.LOD_ROOT)
+                self.FinishFish(context, fish)
+            wm.progress_update((nArmature + 1) * 99.0 / len(self.run.sArmatures))
+        scene.frame_set(startFrame)
+
+    def PoolMovement(self, context):
+        #Prepare every armature here, step them in worker processes, then write the returned channels.
+        #If the pool can't be used, the prepared armatures are stepped here instead
+        scene = context.scene
+        sFPM = scene.FSimMainProps
+        startFrame = self.run.sStartFrame
+        endFrame = self.run.sEndFrame
+        wm = context.window_manager
+        school = []
+        for name in self.run.sArmatures:
+            fish = self.PrepareFish(context, scene.objects.get(name))
+            if fish is not None:
+                school.append(fish)
+        scene.frame_set(startFrame)
+
+        jobs = [sim_pool.PackJob(self.run.sParams, fish.state, fish.trajectory, startFrame, endFrame, fish.tail,
+                                 fish.bake, fish.row, self.run.sFirstFrame, fish.checkpoints.every, fish.lod == sim_lod.LOD_ROOT)
+                for fish in school]
+        try:
+            results = sim_pool.SimulatePool(jobs, sFPM.fsim_workers)
+        except sim_pool.POOL_ERRORS as err:
+            self.report({'WARNING'}, "Worker processes unavailable (%s), simulating in Blender" % err)
+            results = None
+        for nArmature, fish in enumerate(school):
+            if results is None:
+                sim_kernel.SimulateFish(self.run.sParams, fish.state, fish.trajectory, startFrame, endFrame, fish.tail,
+                                        bake=fish.bake, row=fish.row, firstFrame=self.run.sFirstFrame, checkpoints=fish.checkpoints,
+                                        rootOnly=fish.lod == sim_lod.LOD_ROOT)
+            else:
+                state, tracks, frames = results[nArmature]
+                fish.state = sim_pool.StateFromValues(state)
+                fish.bake.tracks = tracks
+                fish.checkpoints.frames.update(frames)
+            self.FinishFish(context, fish)
+            wm.progress_update((nArmature + 1) * 99.0 / len(school))
+        scene.frame_set(startFrame)
+
+
+class ARMATURE_OT_FSim_Crowd(bpy.types.Operator):
+    """Simulate only the root motion of a fish on every target of the active rig's species, as the points of one crowd mesh with swim attributes for Geometry Nodes"""
+    bl_label = "Simulate Crowd"
+    bl_idname = "armature.fsim_crowd"
+    bl_options = {'REGISTER', 'UNDO'}
+
+    @classmethod
+    def poll(cls, context):
+        return context.object is not None and context.object.type == "ARMATURE"
+
+    def CrowdStates(self, scene, rig, proxies, params):
+        #A fish starting on each target, facing the same way as a rig copied there
+        sFPM = scene.FSimMainProps
+        profile = rig_profiles.Profile(rig)
+        goldfish = profile is not None and bool(profile.pecs)
+        states = []
+        for proxy in proxies:
+            rotation = list(proxy.rotation_euler)
+            rotation[2] += math.radians(sFPM.fsim_startangle)
+            state = sim_kernel.FishState(proxy.matrix_world.to_translation(), rotation, rig.scale, goldfish,
+                                         sim_kernel.FishSeed(sFPM.fsim_seed, proxy.name))
+            state.Randomise(params)
+            states.append(state)
+        return states
+
+    def Progress(self, wm, blocks, frames):
+        #Pass the blocks on, moving the progress bar
+        for n, block in enumerate(blocks):
+            wm.progress_update((n + 1) * 99.0 / frames)
+            yield block
+
+    def execute(self, context):
+        scene = context.scene
+        sFPM = scene.FSimMainProps
+        rig = context.object
+        species = fish_registry.Species(scene, rig)
+        proxies = [scene.objects[name] for name in fish_registry.Proxies(scene, species)]
+        if not proxies:
+            self.report({'ERROR'}, "No targets for {} - add targets to place the crowd".format(species))
+            return {'CANCELLED'}
+        startFrame = sFPM.fsim_start_frame
+        endFrame = sFPM.fsim_end_frame
+        scene.frame_set(startFrame)
+        params = sim_kernel.SimParams.FromProps(scene.FSimProps, sFPM.fsim_startangle)
+        states = self.CrowdStates(scene, rig, proxies, params)
+        trajectories = trajectory_sampler.SampleTrajectories(scene, proxies, startFrame, endFrame)
+        trajectories = [trajectories.get(proxy.name) for proxy in proxies]
+
+        name = "{} Crowd".format(species)
+        path = os.path.join(SwimFolder(sFPM), bpy.path.clean_name(name) + crowd_cache.FILE_SUFFIX)
+        wm = context.window_manager
+        wm.progress_begin(0.0, 100.0)
+        try:
+            blocks = sim_crowd.CrowdFrames(params, states, trajectories, startFrame, endFrame, sFPM.fsim_backend)
+            crowd_cache.Write(path, self.Progress(wm, blocks, endFrame - startFrame + 1), startFrame, len(states))
+        except OSError as err:
+            self.report({'ERROR'}, "Crowd cache not written: {}".format(err))
+            return {'CANCELLED'}
+        finally:
+            wm.progress_end()
+
+        #One mesh object holds the whole crowd, in world space
+        obj = bpy.data.objects.get(name)
+        if obj is None or obj.type != "MESH":
+            obj = bpy.data.objects.new(name, crowd_cache.CrowdMesh(name, len(states)))
+            context.collection.objects.link(obj)
+        elif len(obj.data.vertices) != len(states) or any(attribute not in obj.data.attributes for attribute, width in sim_crowd.ATTRIBUTES[1:]):
+            old = obj.data
+            obj.data = crowd_cache.CrowdMesh(name, len(states))
+            if old.users == 0:
+                bpy.data.meshes.remove(old)
+        obj.matrix_world.identity()
+        obj["fsim_crowd_cache"] = StoredPath(path)
+        crowd_cache.Track(obj)
+        cache = crowd_cache.Open(path)
+        if cache is not None:
+            crowd_cache.ApplyFrame(obj.data, cache.Frame(scene.frame_current))
+        if sFPM.fsim_crowd_bodies and cache is not None:
+            self.Bodies(context, rig, species, path, cache)
+        self.report({'INFO'}, "{} fish simulated in {}".format(len(states), name))
+        return {'FINISHED'}
+
+    def Bodies(self, context, rig, species, path, cache):
+        #One mesh with a body per fish of the crowd, posed from the species' gait cache
+        gaitPath = GaitPath(context.scene.FSimMainProps, species)
+        gaits = gait_cache.Open(gaitPath)
+        if gaits is None:
+            self.report({'WARNING'}, "No gait cache for {} - bake one for crowd bodies".format(species))
+            return
+        meshes = gait_cache.BodyMeshes(rig)
+        if sum(len(obj.data.vertices) for obj in meshes) != gaits.vertices:
+            self.report({'WARNING'}, "The gait cache of {} no longer fits its meshes - bake it again".format(species))
+            return
+        name = "{} Crowd Bodies".format(species)
+        mesh = gait_cache.BodiesMesh(name, meshes, cache.fish)
+        obj = bpy.data.objects.get(name)
+        if obj is None or obj.type != "MESH":
+            obj = bpy.data.objects.new(name, mesh)
+            context.collection.objects.link(obj)
+        else:
+            old = obj.data
+            obj.data = mesh
+            if old.users == 0:
+                bpy.data.meshes.remove(old)
+        obj.matrix_world.identity()
+        obj["fsim_gait_cache"] = StoredPath(gaitPath)
+        obj["fsim_gait_crowd"] = StoredPath(path)
+        gait_cache.Track(obj)
+        gait_cache.ApplyFrame(mesh, gaits, cache.Frame(context.scene.frame_current))
+
+
+class ARMATURE_OT_FSim_Gaits(bpy.types.Operator):
+    """Bake the meshes of the active rig over one tail beat of each gait - cruising, turning and hovering - into its species' gait cache, for crowd bodies without armatures"""
+    bl_label = "Bake Gait Cache"
+    bl_idname = "armature.fsim_gait_cache"
+    bl_options = {'REGISTER'}
+
+    @classmethod
+    def poll(cls, context):
+        return context.object is not None and context.object.type == "ARMATURE"
+
+    def execute(self, context):
+        scene = context.scene
+        sFPM = scene.FSimMainProps
+        rig = context.object
+        species = fish_registry.Species(scene, rig)
+        params = sim_kernel.SimParams.FromProps(scene.FSimProps, sFPM.fsim_startangle)
+        try:
+            rest, offsets = gait_cache.Bake(context, rig, params)
+        except ValueError as err:
+            self.report({'ERROR'}, "Gaits not baked: {}".format(err))
+            return {'CANCELLED'}
+        path = GaitPath(sFPM, species)
+        amplitudes = [swim_gaits.Amplitude(params, gait) for gait in swim_gaits.GAITS]
+        try:
+            gait_cache.Write(path, species, rest, offsets, amplitudes, math.radians(params.pMaxSteeringAngle))
+        except OSError as err:
+            self.report({'ERROR'}, "Gait cache not written: {}".format(err))
+            return {'CANCELLED'}
+        self.report({'INFO'}, "{} gaits of {} baked, {} vertices".format(len(swim_gaits.GAITS), species, len(rest)))
+        return {'FINISHED'}
+
+
 #Register
         
 classes = (
     FSimProps,
     ARMATURE_OT_FSimulate,
+    ARMATURE_OT_FSimulateFast,
+    ARMATURE_OT_FSim_Crowd,
+    ARMATURE_OT_FSim_Gaits,
 )
 
 def registerTypes():
@@ -36,10 +36,42 @@ bl_info = {
 
 if "bpy" in locals():
     import imp
+    imp.reload(sim_kernel)
+    imp.reload(sim_lod)
+    imp.reload(rig_profiles)
+    imp.reload(fish_registry)
+    imp.reload(key_fitting)
+    imp.reload(swim_cycles)
+    imp.reload(swim_cache)
+    imp.reload(sim_crowd)
+    imp.reload(crowd_cache)
+    imp.reload(swim_gaits)
+    imp.reload(gait_cache)
+    imp.reload(keyframe_writer)
+    imp.reload(sim_school)
+    imp.reload(trajectory_sampler)
+    imp.reload(sim_pool)
+    imp.reload(result_cache)
     imp.reload(FishSim)
     imp.reload(metarig_menu)
     # print("Reloaded multifiles")
 else:
+    from . import sim_kernel
+    from . import sim_lod
+    from . import rig_profiles
+    from . import fish_registry
+    from . import key_fitting
+    from . import swim_cycles
+    from . import swim_cache
+    from . import sim_crowd
+    from . import crowd_cache
+    from . import swim_gaits
+    from . import gait_cache
+    from . import keyframe_writer
+    from . import sim_school
+    from . import trajectory_sampler
+    from . import sim_pool
+    from . import result_cache
     from . import FishSim
     # print("Imported multifiles")
 
@@ -71,11 +103,67 @@ class FSimMainProps(bpy.types.PropertyGroup):
     fsim_targetrig : StringProperty(name="Name of the target rig", default="")  
     fsim_start_frame : IntProperty(name="Simulation Start Frame", default=1)  
     fsim_end_frame : IntProperty(name="Simulation End Frame", default=250)  
+    fsim_range : BoolProperty(name="Simulate Range", description="Simulate again only between the range frames, carrying on from the existing animation and keeping the keys outside the range",
+        default=False)
+    fsim_range_start : IntProperty(name="Range Start Frame", description="Frame the existing animation is carried on from", default=1)
+    fsim_range_end : IntProperty(name="Range End Frame", description="Last frame simulated again", default=250)
     fsim_maxnum : IntProperty(name="Maximum number of copies", default=250)  
     fsim_copyrigs : BoolProperty(name="Distribute multiple copies of the rig", default=True)
     fsim_copymesh : BoolProperty(name="Distribute multiple copies of meshes", default=True)
+    fsim_share_data : BoolProperty(name="Share Data", description="Copies use the armature and meshes of the source rig instead of their own duplicates, only the pose and action are their own. Edits to the rest pose or meshes change every copy",
+        default=False)
     fsim_multisim : BoolProperty(name="Simulate the multiple rigs", default=False)  
     fsim_startangle : FloatProperty(name="Angle to Target", default=0.0)
+    fsim_backend : EnumProperty(name="Backend", description="How the armatures of a school are stepped",
+        items=[('AUTO', "Auto", "Step large schools together with NumPy, and small ones one armature at a time"),
+               ('SCALAR', "Scalar", "Step one armature at a time"),
+               ('VECTOR', "Vector", "Step every armature of the school together with NumPy")],
+        default='AUTO')
+    fsim_seed : IntProperty(name="Random Seed", description="Seed for the random variation of every fish. Each armature's stream comes from this and its name, or its own 'fsim_seed' property", default=0)
+    fsim_single_sweep : BoolProperty(name="Single Sweep", description="Step all armatures together in one pass of the timeline instead of one pass per armature", default=True)
+    fsim_checkpoint_every : IntProperty(name="Checkpoint Every", description="Store the simulation state with each armature every this many frames, 0 for no checkpoints",
+        default=25, min=0)
+    fsim_resume : BoolProperty(name="Resume", description="Carry on from stored checkpoints when the settings are unchanged, e.g. after extending the end frame", default=True)
+    fsim_cache : BoolProperty(name="Cache Results", description="Skip armatures whose settings, seed and target are unchanged, and restore earlier results from the cache", default=True)
+    fsim_cache_dir : StringProperty(name="Cache Folder", description="Folder for cached results, blank for fsim_cache next to the .blend file", default="", subtype='DIR_PATH')
+    fsim_cache_size : IntProperty(name="Cache Size (MB)", description="Largest size of the cache folder, the least recently used results are deleted beyond this. 0 to keep results in memory only",
+        default=1024, min=0)
+    fsim_workers : IntProperty(name="Worker Processes", description="Simulate (Fast) spreads the armatures over this many processes, 0 or 1 to simulate inside Blender",
+        default=0, min=0, max=256, soft_max=64)
+    fsim_output : EnumProperty(name="Output", description="Where the simulation is stored",
+        items=[('KEYS', "Keyframes", "Key the armatures"),
+               ('CACHE', "Swim Cache", "Write a memory mapped cache file per armature, applied to the pose on every frame change instead of keys")],
+        default='KEYS')
+    fsim_swim_dir : StringProperty(name="Swim Cache Folder", description="Folder for swim cache files, blank for fsim_swim next to the .blend file", default="", subtype='DIR_PATH')
+    fsim_swim_half : BoolProperty(name="Half Precision", description="Store the swim cache as 16 bit floats, half the size", default=False)
+    fsim_minimal_keys : BoolProperty(name="Minimal Keys", description="Key only the channels the simulation changes: single axis bones get Euler rotation curves and fins only their y scale",
+        default=False)
+    fsim_lod : BoolProperty(name="Camera Level of Detail", description="Key fish that stay far from the scene camera or out of its view over the shot with fewer channels and sparser keys",
+        default=False)
+    fsim_lod_near : FloatProperty(name="Full Detail Distance", description="Fish that come this close to the camera while in view are keyed in full",
+        default=20.0, min=0.0, unit='LENGTH')
+    fsim_lod_far : FloatProperty(name="Reduced Detail Distance", description="Fish in view within this distance only have their body bones keyed, further or unseen fish only their root motion",
+        default=60.0, min=0.0, unit='LENGTH')
+    fsim_lod_step : IntProperty(name="Far Key Step", description="Frames between the keys of reduced and root motion fish", default=2, min=1, max=10)
+    fsim_crowd_bodies : BoolProperty(name="Crowd Bodies", description="Simulate Crowd also builds a mesh with a body per fish, posed from the species' gait cache without armatures",
+        default=False)
+    fsim_followers : BoolProperty(name="Followers", description="Only simulate the armatures marked as leaders. The others copy the tail and fins of their leader and swim after their own target",
+        default=False)
+    fsim_follow_offset : IntProperty(name="Follow Offset", description="Largest number of frames a follower's tail beat lags its leader's", default=12, min=0)
+    fsim_follow_jitter : FloatProperty(name="Follow Jitter", description="Largest random change of a follower's tail and fin amplitude from its leader's",
+        default=0.1, min=0.0, max=1.0)
+    fsim_cycles : BoolProperty(name="Swim Cycles", description="Play steady cruising from one cyclic action per gait on the NLA, repeated, instead of keying every frame. Root motion and leaning into turns stay as keys",
+        default=False)
+    fsim_cycle_tolerance : FloatProperty(name="Cycle Tolerance", description="Largest difference from the simulation allowed in a repeated swim cycle",
+        default=0.01, min=0.0001, precision=4)
+    fsim_cycle_repeats : IntProperty(name="Minimum Repeats", description="Fewest tail beats in a row worth turning into a swim cycle", default=3, min=1)
+    fsim_decimate : BoolProperty(name="Decimate Keys", description="Only keep the keys needed to follow the simulation within the tolerances below, with fitted Bezier handles", default=False)
+    fsim_tol_location : FloatProperty(name="Location Tolerance", description="Largest difference from the simulation allowed in location channels",
+        default=0.001, min=0.0, precision=4)
+    fsim_tol_rotation : FloatProperty(name="Rotation Tolerance", description="Largest difference from the simulation allowed in rotation channels (quaternion components and radians)",
+        default=0.001, min=0.0, precision=4)
+    fsim_tol_scale : FloatProperty(name="Scale Tolerance", description="Largest difference from the simulation allowed in scale channels",
+        default=0.001, min=0.0, precision=4)
     
 
 
@@ -131,6 +219,12 @@ class ARMATURE_OT_FSim_Add(bpy.types.Operator):
         bound_box.visible_diffuse = False
         bound_box.visible_shadow = False
         bound_box["FSim"] = "FSim_"+TargetRig.name[:3]
+        #A rig copied from a registered one keeps its species, any other starts its own
+        species = TargetRig.get(fish_registry.SPECIES, TargetRig.name)
+        fish_registry.Assign(TargetRig, species)
+        fish_registry.Assign(bound_box, species)
+        fish_registry.Register(context.scene, TargetRig, species)
+        fish_registry.Register(context.scene, bound_box, species)
         # if "FSim" in bound_box:
             # print("FSim Found")
         # bound_box.select = False
@@ -138,6 +232,39 @@ class ARMATURE_OT_FSim_Add(bpy.types.Operator):
         
         return {'FINISHED'}
 
+class ARMATURE_OT_FSim_Registry(bpy.types.Operator):
+    """Index the rigs and targets of every species in the scene again, e.g. after renaming them"""
+    bl_label = "Rebuild Fish Registry"
+    bl_idname = "armature.fsim_registry"
+    bl_options = {'REGISTER', 'UNDO'}
+
+    def execute(self, context):
+        fish_registry.Rebuild(context.scene)
+        registry = context.scene[fish_registry.PROPERTY]
+        self.report({'INFO'}, "{} species registered".format(len(registry)))
+        return {'FINISHED'}
+
+class ARMATURE_OT_FSim_Leaders(bpy.types.Operator):
+    """Mark the selected armatures as school leaders, which are fully simulated when Followers is on"""
+    bl_label = "Mark Leaders"
+    bl_idname = "armature.fsim_leaders"
+    bl_options = {'REGISTER', 'UNDO'}
+
+    clear : BoolProperty(name="Clear", description="Unmark the selected armatures instead", default=False)
+
+    def execute(self, context):
+        count = 0
+        for obj in context.selected_objects:
+            if obj.type == "ARMATURE":
+                if self.clear:
+                    if "fsim_leader" in obj:
+                        del obj["fsim_leader"]
+                else:
+                    obj["fsim_leader"] = True
+                count += 1
+        self.report({'INFO'}, "{} armatures {}".format(count, "unmarked" if self.clear else "marked as leaders"))
+        return {'FINISHED'}
+
 
 
 #UI Panels
@@ -223,126 +350,148 @@ class ARMATURE_OT_FSim_Run(bpy.types.Operator):
 
     
 
-    def CopyChildren(self, context, src_obj, new_obj):
+    def CopyChildren(self, context, src_obj, new_obj, selected, share=False):
         for childObj in src_obj.children:
             # print("Copying child: ", childObj.name)
             new_child = childObj.copy()
-            new_child.data = childObj.data.copy()
+            #A shared copy keeps using the source mesh
+            if not share:
+                new_child.data = childObj.data.copy()
             new_child.animation_data_clear()
 #            new_child.location = childObj.location - src_obj.location
             new_child.parent = new_obj
             new_child.matrix_parent_inverse = childObj.matrix_parent_inverse
             context.collection.objects.link(new_child)
-            new_child.select_set(True)
+            selected.append(new_child)
             for mod in new_child.modifiers:
                 if mod.type == "ARMATURE":
                     mod.object = new_obj
 
-    
+    def DriverRetargets(self, src_obj):
+        #For each driver of the rig, the (variable, target) indices pointing back at the rig itself.
+        #Copies keep the order of their drivers, so these are worked out once for every copy
+        retargets = []
+        if src_obj.data.animation_data is None:
+            return retargets
+        for dr in src_obj.data.animation_data.drivers:
+            targets = []
+            for v, v1 in enumerate(dr.driver.variables):
+                for t, target in enumerate(v1.targets):
+                    if target.id_type == 'OBJECT' and target.id == src_obj:
+                        targets.append((v, t))
+            retargets.append(targets)
+        return retargets
+
     def CopyRigs(self, context):
         # print("Populate")
         
         scene = context.scene
+        sFPM = scene.FSimMainProps
         src_obj = context.object
         if src_obj.type != 'ARMATURE':
             return {'CANCELLED'}
-        src_obj.select_set(True)
         
         #make a list of armatures
+        species = fish_registry.Species(scene, src_obj)
+        if fish_registry.IsRig(src_obj):
+            fish_registry.Register(scene, src_obj, species)
         armatures = {}
-        for obj in scene.objects:
-            if obj.type == "ARMATURE" and obj.name[:3] == src_obj.name[:3]:
-                root = obj.pose.bones.get("root")
-                if root != None:
-                    if 'TargetProxy' in root:
-                        proxyName = root['TargetProxy']
-                        if len(proxyName) > 1:
-                            armatures[proxyName] = obj.name
+        for name in fish_registry.Rigs(scene, species):
+            proxyName = scene.objects[name].pose.bones["root"]['TargetProxy']
+            if len(proxyName) > 1:
+                armatures[proxyName] = name
+
+        #Go back to the first frame once to make sure the rigs are placed correctly
+        scene.frame_set(sFPM.fsim_start_frame)
+        share = sFPM.fsim_share_data
+        #Drivers on a shared armature keep pointing at the source rig
+        retargets = self.DriverRetargets(src_obj) if sFPM.fsim_copyrigs and not share else []
+        startAngle = math.radians(sFPM.fsim_startangle)
+        selected = []
+        keyed = []
+        matched = False
+        new_obj = None
         
-        #for each target...
-        obj_count = 0
-        for obj in scene.objects:
-            if "FSim" in obj and (obj["FSim"][-3:] == src_obj.name[:3]):
-                #Limit the maximum copy number
-                if obj_count >= scene.FSimMainProps.fsim_maxnum:
-                    return  {'FINISHED'}
-                obj_count += 1
-                
-                #Go back to the first frame to make sure the rigs are placed correctly
-                scene.frame_set(scene.FSimMainProps.fsim_start_frame)
-                # scene.update()
-                
-                #if a rig hasn't already been paired with this target, and it's the right target type for this rig, then add a duplicated rig at this location if 'CopyRigs' is selected
-                if (obj.name not in armatures) and (obj["FSim"][-3:] == src_obj.name[:3]):
-                    # print("time to duplicate")
-
-                    if scene.FSimMainProps.fsim_copyrigs:
-                        #If there is not already a matching armature, duplicate the template and update the link field
-                        new_obj = src_obj.copy()
+        #for each target, up to the maximum copy number...
+        for proxyName in fish_registry.Proxies(scene, species)[:sFPM.fsim_maxnum]:
+            obj = scene.objects[proxyName]
+            
+            #if a rig hasn't already been paired with this target, add a duplicated rig at this location if 'CopyRigs' is selected
+            if obj.name not in armatures:
+                # print("time to duplicate")
+
+                if sFPM.fsim_copyrigs:
+                    #If there is not already a matching armature, duplicate the template and update the link field
+                    new_obj = src_obj.copy()
+                    if not share:
                         new_obj.data = src_obj.data.copy()
-                        # new_obj.animation_data_clear()
-                        context.collection.objects.link(new_obj)
-                        
-                        #Unlink from original action
-                        new_obj.animation_data.action = None
-                        
-                        #2.8 Issue Workout how to update drivers
-                        #Update drivers with new rig id
-                        for dr in new_obj.data.animation_data.drivers:                            
-                            for v1 in dr.driver.variables:
-                                # print("ID_name: ", v1.targets[0].id.name)
-                                # print("obj_name:", src_obj.name)
-                                if (v1.targets[0].id_type == 'OBJECT') and (v1.targets[0].id.name == src_obj.name):
-                                    # print("Update_p", v1.targets[0].id)
-                                    v1.targets[0].id = new_obj
-                                    # print("Update", v1.targets[0].id)
+                    # new_obj.animation_data_clear()
+                    context.collection.objects.link(new_obj)
+                    
+                    #Unlink from original action
+                    new_obj.animation_data.action = None
+                    
+                    #Update drivers with new rig id
+                    if retargets:
+                        for dr, targets in zip(new_obj.data.animation_data.drivers, retargets):
+                            for v, t in targets:
+                                dr.driver.variables[v].targets[t].id = new_obj
                                 
-                        new_obj.location = obj.matrix_world.to_translation()
-                        new_obj.rotation_euler = obj.rotation_euler
-                        new_obj.rotation_euler.z += math.radians(scene.FSimMainProps.fsim_startangle)
-                        new_root = new_obj.pose.bones.get('root')
-                        new_root['TargetProxy'] = obj.name
-                        new_root.scale = (new_root.scale.x * obj.scale.x, new_root.scale.y * obj.scale.y, new_root.scale.z * obj.scale.z)
-                        context.view_layer.objects.active = new_obj
-                        new_obj.select_set(True)
-                        src_obj.select_set(False)
-                        
-                        #if 'CopyMesh' is selected duplicate the dependents and re-link
-                        if scene.FSimMainProps.fsim_copymesh:
-                            self.CopyChildren(context, src_obj, new_obj)
-
-                #If there's already a matching rig, then just update it
-                elif obj["FSim"][-3:] == src_obj.name[:3]:
-                    # print("matching armature", armatures[obj.name])
-                    TargRig = scene.objects.get(armatures[obj.name])
-                    if TargRig is not None:
-                        #reposition if required
-                        if scene.FSimMainProps.fsim_copyrigs:
-                            # TargRig.animation_data_clear()
-                            TargRig.location = obj.matrix_world.to_translation()
-                            TargRig.rotation_euler = obj.rotation_euler
-                            TargRig.rotation_euler.z += math.radians(scene.FSimMainProps.fsim_startangle)
-                            TargRig.keyframe_insert(data_path='rotation_euler',  frame=(scene.FSimMainProps.fsim_start_frame))
-                            TargRig.keyframe_insert(data_path='location',  frame=(scene.FSimMainProps.fsim_start_frame))
-                        
-                        #if no children, and the 'copymesh' flag set, then copy the associated meshes
-                        if scene.FSimMainProps.fsim_copymesh and len(TargRig.children) < 1:
-                            self.CopyChildren(context, src_obj, TargRig)
-                        
-                        #Leave the just generated objects selected
-                        # scene.objects.active = TargRig
-                        TargRig.select_set(True)
-                        src_obj.select_set(False)
-                        for childObj in TargRig.children:
-                            childObj.select_set(True)
-                        for childObj in src_obj.children:
-                            childObj.select_set(True)
-
-                        # #Animate
-                        # if scene.FSimMainProps.fsim_multisim and TargRig.name != src_obj.name:
-                            # # self.BoneMovement(TargRig, scene.FSimMainProps.fsim_start_frame, scene.FSimMainProps.fsim_end_frame, context)
-                            # bpy.ops.armature.fsimulate()
-                
+                    new_obj.location = obj.matrix_world.to_translation()
+                    new_obj.rotation_euler = obj.rotation_euler
+                    new_obj.rotation_euler.z += startAngle
+                    new_root = new_obj.pose.bones.get('root')
+                    new_root['TargetProxy'] = obj.name
+                    new_root.scale = (new_root.scale.x * obj.scale.x, new_root.scale.y * obj.scale.y, new_root.scale.z * obj.scale.z)
+                    fish_registry.Register(scene, new_obj, species)
+                    selected.append(new_obj)
+                    
+                    #if 'CopyMesh' is selected duplicate the dependents and re-link
+                    if sFPM.fsim_copymesh:
+                        self.CopyChildren(context, src_obj, new_obj, selected, share)
+
+            #If there's already a matching rig, then just update it
+            else:
+                # print("matching armature", armatures[obj.name])
+                TargRig = scene.objects.get(armatures[obj.name])
+                if TargRig is not None:
+                    #reposition if required, the keys are written together at the end
+                    if sFPM.fsim_copyrigs:
+                        # TargRig.animation_data_clear()
+                        TargRig.location = obj.matrix_world.to_translation()
+                        TargRig.rotation_euler = obj.rotation_euler
+                        TargRig.rotation_euler.z += startAngle
+                        keyed.append(TargRig)
+                    
+                    #if no children, and the 'copymesh' flag set, then copy the associated meshes
+                    if sFPM.fsim_copymesh and len(TargRig.children) < 1:
+                        self.CopyChildren(context, src_obj, TargRig, selected, share)
+                    
+                    selected.append(TargRig)
+                    selected.extend(TargRig.children)
+                    matched = True
+
+        #Key the start frame of the repositioned rigs, recalculating each curve once
+        fcurves = []
+        for TargRig in keyed:
+            fcurves += keyframe_writer.InsertKey(TargRig, "rotation_euler", sFPM.fsim_start_frame, TargRig.rotation_euler)
+            fcurves += keyframe_writer.InsertKey(TargRig, "location", sFPM.fsim_start_frame, TargRig.location)
+        for fcurve in fcurves:
+            fcurve.update()
+
+        #Leave the just generated objects selected
+        if selected:
+            src_obj.select_set(False)
+            for sel in selected:
+                sel.select_set(True)
+            if matched:
+                for childObj in src_obj.children:
+                    childObj.select_set(True)
+        else:
+            src_obj.select_set(True)
+        if new_obj is not None:
+            context.view_layer.objects.active = new_obj
+            
             
 
 
@@ -434,6 +583,12 @@ class ARMATURE_OT_AddFish(bpy.types.Operator):
                         pass
             if ProxyName != "" and RigRootBone != None:
                 RigRootBone["TargetProxy"] = ProxyName
+                #Every fish added from the same library collection is one species
+                species = self.FishSelector
+                fish_registry.Assign(RigRootBone.id_data, species)
+                fish_registry.Assign(coll.objects[ProxyName], species)
+                fish_registry.Register(context.scene, RigRootBone.id_data, species)
+                fish_registry.Register(context.scene, coll.objects[ProxyName], species)
                           
 
         self.report({'INFO'}, f"Selected: {self.FishSelector}")
@@ -499,21 +654,66 @@ class ARMATURE_PT_FSim(bpy.types.Panel):
         layout.label(text="Simulation")
         # row = layout.row()
         layout.operator("armature.fsimulate")
+        layout.operator("armature.fsimulate_fast")
+        layout.operator("armature.fsim_crowd")
+        layout.prop(scene.FSimMainProps, "fsim_crowd_bodies")
+        layout.operator("armature.fsim_gait_cache")
         # row = layout.row()
         #layout.label(text="Animation Ranges")
         # row = layout.row()
         layout.prop(scene.FSimMainProps, "fsim_start_frame")
         # row = layout.row()
         layout.prop(scene.FSimMainProps, "fsim_end_frame")
+        layout.prop(scene.FSimMainProps, "fsim_range")
+        if scene.FSimMainProps.fsim_range:
+            layout.prop(scene.FSimMainProps, "fsim_range_start")
+            layout.prop(scene.FSimMainProps, "fsim_range_end")
+        layout.prop(scene.FSimMainProps, "fsim_backend")
+        layout.prop(scene.FSimMainProps, "fsim_seed")
+        layout.prop(scene.FSimMainProps, "fsim_single_sweep")
+        layout.prop(scene.FSimMainProps, "fsim_workers")
+        layout.prop(scene.FSimMainProps, "fsim_checkpoint_every")
+        layout.prop(scene.FSimMainProps, "fsim_resume")
+        layout.prop(scene.FSimMainProps, "fsim_cache")
+        layout.prop(scene.FSimMainProps, "fsim_cache_dir")
+        layout.prop(scene.FSimMainProps, "fsim_cache_size")
+        layout.prop(scene.FSimMainProps, "fsim_output")
+        if scene.FSimMainProps.fsim_output == 'CACHE':
+            layout.prop(scene.FSimMainProps, "fsim_swim_dir")
+            layout.prop(scene.FSimMainProps, "fsim_swim_half")
+        layout.prop(scene.FSimMainProps, "fsim_minimal_keys")
+        layout.prop(scene.FSimMainProps, "fsim_lod")
+        if scene.FSimMainProps.fsim_lod:
+            layout.prop(scene.FSimMainProps, "fsim_lod_near")
+            layout.prop(scene.FSimMainProps, "fsim_lod_far")
+            layout.prop(scene.FSimMainProps, "fsim_lod_step")
+        layout.prop(scene.FSimMainProps, "fsim_followers")
+        if scene.FSimMainProps.fsim_followers:
+            row = layout.row()
+            row.operator("armature.fsim_leaders")
+            row.operator("armature.fsim_leaders", text="Clear Leaders").clear = True
+            layout.prop(scene.FSimMainProps, "fsim_follow_offset")
+            layout.prop(scene.FSimMainProps, "fsim_follow_jitter")
+        layout.prop(scene.FSimMainProps, "fsim_cycles")
+        if scene.FSimMainProps.fsim_cycles:
+            layout.prop(scene.FSimMainProps, "fsim_cycle_tolerance")
+            layout.prop(scene.FSimMainProps, "fsim_cycle_repeats")
+        layout.prop(scene.FSimMainProps, "fsim_decimate")
+        if scene.FSimMainProps.fsim_decimate:
+            layout.prop(scene.FSimMainProps, "fsim_tol_location")
+            layout.prop(scene.FSimMainProps, "fsim_tol_rotation")
+            layout.prop(scene.FSimMainProps, "fsim_tol_scale")
         row = layout.row()
         layout.label(text="Add a Target to an existing rig")
         layout.operator("armature.fsim_add")
+        layout.operator("armature.fsim_registry")
         # box = layout.box()
         # box.label(text="Multi Sim Options")
         layout.label(text="Copy Models to multiple targets")
         layout.operator("armature.fsim_run")
         layout.prop(scene.FSimMainProps, "fsim_copyrigs")
         layout.prop(scene.FSimMainProps, "fsim_copymesh")
+        layout.prop(scene.FSimMainProps, "fsim_share_data")
         layout.prop(scene.FSimMainProps, "fsim_maxnum")
         layout.prop(scene.FSimMainProps, "fsim_startangle")
 
@@ -593,8 +793,8 @@ class ARMATURE_PT_FSimPecPanel(bpy.types.Panel):
     def poll(cls, context):
         if context.object != None:
             if (context.mode in {'OBJECT', 'POSE'}) and (context.object.type == "ARMATURE"):
-                PecFinTopL = context.object.pose.bones.get("t_master.L")
-                if PecFinTopL != None:
+                profile = rig_profiles.Profile(context.object)
+                if profile is not None and profile.pecs:
                     return True
         return False
 
@@ -642,6 +842,8 @@ class ARMATURE_PT_FSimPecPanel(bpy.types.Panel):
 classes = (
     FSimMainProps,
     ARMATURE_OT_FSim_Add,
+    ARMATURE_OT_FSim_Leaders,
+    ARMATURE_OT_FSim_Registry,
     ARMATURE_PT_FAdd,
     ARMATURE_PT_FSim,
     ARMATURE_PT_FSimPropPanel,
@@ -664,6 +866,14 @@ def register():
     # bpy.utils.register_class(ARMATURE_OT_FSim_Add)
     from . import FishSim
     FishSim.registerTypes()
+    from . import swim_cache
+    swim_cache.register()
+    from . import fish_registry
+    fish_registry.register()
+    from . import crowd_cache
+    crowd_cache.register()
+    from . import gait_cache
+    gait_cache.register()
     from . import metarig_menu
     metarig_menu.register()
     # bpy.utils.register_class(ARMATURE_PT_FSim)
@@ -684,6 +894,14 @@ def unregister():
     metarig_menu.unregister()
     from . import FishSim
     FishSim.unregisterTypes()
+    from . import swim_cache
+    swim_cache.unregister()
+    from . import fish_registry
+    fish_registry.unregister()
+    from . import crowd_cache
+    crowd_cache.unregister()
+    from . import gait_cache
+    gait_cache.unregister()
 
     # Classes.
     for cls in classes:
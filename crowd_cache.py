@@ -0,0 +1,209 @@
+# ##### BEGIN GPL LICENSE BLOCK #####
+#
+#  FishSim  -- a script to apply a fish swimming simulation to an armature
+#  by Ian Huish (nerk)
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License
+#  as published by the Free Software Foundation; either version 2
+#  of the License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software Foundation,
+#  Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+# ##### END GPL LICENSE BLOCK #####
+
+
+# version comment: V4.02.0 - Goldfish Version - Blender 4.20 Extensions
+
+# Crowd point cache.
+# The attribute blocks of a root motion crowd (see sim_crowd) are written
+# frame by frame to a binary file, laid out like a swim cache.  A crowd is
+# one mesh object with a vertex per fish, and a frame_change_pre handler
+# sets its vertex positions and point attributes from the current frame's
+# block, so Geometry Nodes can instance and animate fish on it.
+
+import json
+import mmap
+import os
+import struct
+from array import array
+
+import bpy
+from bpy.app.handlers import persistent
+
+from . import sim_crowd
+from .swim_cache import PREAMBLE, CacheUsers
+
+MAGIC = b"FSIMCRWD"
+VERSION = 1
+FILE_SUFFIX = ".fsimcrowd"
+
+#Open caches by absolute path - (modification time, CrowdCache)
+_open = {}
+_users = CacheUsers("fsim_crowd_cache", "MESH")
+
+
+class CrowdCache:
+    """A memory mapped crowd cache file"""
+
+    def __init__(self, path):
+        self.file = open(path, "rb")
+        try:
+            self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+            magic, length = PREAMBLE.unpack_from(self.map, 0)
+            if magic != MAGIC:
+                raise ValueError("not a crowd cache")
+            header = json.loads(self.map[PREAMBLE.size:PREAMBLE.size + length])
+            if header["version"] != VERSION:
+                raise ValueError("unsupported crowd cache version")
+        except (ValueError, struct.error):
+            self.Close()
+            raise
+        self.startFrame = header["startFrame"]
+        self.frames = header["frames"]
+        self.fish = header["fish"]
+        self.attributes = header["attributes"]
+        self.offset = header["offset"]
+        self.blockSize = 4 * self.fish * sum(width for name, width in self.attributes)
+
+    def Frame(self, nFrame):
+        #{attribute: float array} of one frame, frames outside the range hold the nearest one
+        i = min(max(int(nFrame) - self.startFrame, 0), self.frames - 1)
+        start = self.offset + i * self.blockSize
+        values = {}
+        for name, width in self.attributes:
+            end = start + 4 * self.fish * width
+            values[name] = array('f')
+            values[name].frombytes(self.map[start:end])
+            start = end
+        return values
+
+    def Close(self):
+        if getattr(self, "map", None) is not None:
+            self.map.close()
+            self.map = None
+        self.file.close()
+
+
+def Write(path, blocks, startFrame, fish):
+    """Write the attribute blocks of a crowd, one per frame from startFrame, returning the number of frames"""
+    Close(path)
+    header = {
+        "version": VERSION,
+        "startFrame": startFrame,
+        "frames": 0,
+        "fish": fish,
+        "attributes": [list(attribute) for attribute in sim_crowd.ATTRIBUTES],
+        "offset": 0,
+    }
+    #Room for the frame count, which is only known at the end
+    text = json.dumps(header)
+    offset = PREAMBLE.size + len(text) + 32
+    offset += -offset % 8
+    header["offset"] = offset
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temp = path + ".tmp"
+    frames = 0
+    with open(temp, "wb") as f:
+        f.seek(offset)
+        for block in blocks:
+            block.tofile(f)
+            frames += 1
+        header["frames"] = frames
+        text = json.dumps(header).encode()
+        f.seek(0)
+        f.write(PREAMBLE.pack(MAGIC, len(text)))
+        f.write(text)
+    os.replace(temp, path)
+    return frames
+
+
+def Open(path):
+    """The CrowdCache of a file, reopened when the file changes, or None if it can't be read"""
+    try:
+        mtime = os.stat(path).st_mtime
+    except OSError:
+        Close(path)
+        return None
+    entry = _open.get(path)
+    if entry is not None and entry[0] == mtime:
+        return entry[1]
+    Close(path)
+    try:
+        cache = CrowdCache(path)
+    except (OSError, ValueError) as err:
+        print("FishSim crowd cache not read:", path, err)
+        return None
+    _open[path] = (mtime, cache)
+    return cache
+
+
+def Close(path=None):
+    """Unmap one cache file, or all of them"""
+    for key in ([path] if path is not None else list(_open)):
+        entry = _open.pop(key, None)
+        if entry is not None:
+            entry[1].Close()
+
+
+def Track(obj):
+    """Note a crowd mesh that has just been given a crowd cache file"""
+    _users.Add(obj)
+
+
+def CrowdMesh(name, fish):
+    """A new mesh with a vertex and the point attributes for each fish"""
+    mesh = bpy.data.meshes.new(name)
+    mesh.vertices.add(fish)
+    for attribute, width in sim_crowd.ATTRIBUTES:
+        if attribute != "position":
+            mesh.attributes.new(attribute, 'FLOAT_VECTOR' if width == 3 else 'FLOAT', 'POINT')
+    return mesh
+
+
+def ApplyFrame(mesh, values):
+    """Set the vertices and point attributes of a crowd mesh to one frame"""
+    mesh.vertices.foreach_set("co", values["position"])
+    for attribute, width in sim_crowd.ATTRIBUTES:
+        if attribute != "position":
+            mesh.attributes[attribute].data.foreach_set("vector" if width == 3 else "value", values[attribute])
+    mesh.update()
+
+
+@persistent
+def FrameChangePre(scene, depsgraph=None):
+    #Move every crowd mesh with an 'fsim_crowd_cache' file to the new frame
+    for obj, path in _users.Objects(scene):
+        cache = Open(bpy.path.abspath(path))
+        if cache is None or len(obj.data.vertices) != cache.fish:
+            continue
+        if any(name not in obj.data.attributes for name, width in cache.attributes if name != "position"):
+            continue
+        ApplyFrame(obj.data, cache.Frame(scene.frame_current))
+
+
+@persistent
+def LoadPre(*args):
+    Close()
+    _users.Forget()
+
+
+def register():
+    bpy.app.handlers.frame_change_pre.append(FrameChangePre)
+    bpy.app.handlers.load_pre.append(LoadPre)
+
+
+def unregister():
+    for handlers, handler in ((bpy.app.handlers.frame_change_pre, FrameChangePre), (bpy.app.handlers.load_pre, LoadPre)):
+        if handler in handlers:
+            handlers.remove(handler)
+    Close()
+    _users.Forget()
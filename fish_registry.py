@@ -0,0 +1,174 @@
+# ##### BEGIN GPL LICENSE BLOCK #####
+#
+#  FishSim  -- a script to apply a fish swimming simulation to an armature
+#  by Ian Huish (nerk)
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License
+#  as published by the Free Software Foundation; either version 2
+#  of the License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software Foundation,
+#  Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+# ##### END GPL LICENSE BLOCK #####
+
+
+# version comment: V4.02.0 - Goldfish Version - Blender 4.20 Extensions
+
+# Fish registry.
+# Rigs and their target proxies are indexed by species in an ID property on
+# the scene, {species: {"rigs": {name: 1}, "proxies": {name: 1}}}, so a run or
+# Copy Models looks up the armatures and targets of one species directly
+# instead of scanning every object in the scene.  Each rig and proxy also
+# carries its species as 'fsim_species', which copies inherit, and a
+# depsgraph handler registers objects copied in the viewport.  Files from
+# before the registry are indexed once, by the old three letter name prefix.
+# After that a rig only ever joins a species explicitly: new rigs get their
+# species when they are set up, and any other rig starts its own, so one
+# named "Golem" is never taken for a "Goldfish".
+
+import bpy
+from bpy.app.handlers import persistent
+
+PROPERTY = "fsim_registry"
+SPECIES = "fsim_species"
+RIGS = "rigs"
+PROXIES = "proxies"
+
+
+def IsRig(obj):
+    """An armature with a root bone pointing at a target proxy"""
+    if obj.type != "ARMATURE":
+        return False
+    root = obj.pose.bones.get("root")
+    return root is not None and "TargetProxy" in root
+
+
+def Registry(scene):
+    """The index of a scene, built on first use"""
+    registry = scene.get(PROPERTY)
+    if registry is None:
+        Migrate(scene)
+        registry = scene[PROPERTY]
+    return registry
+
+
+def LegacySpecies(obj):
+    """The species of a rig or proxy from before the registry, or None"""
+    if IsRig(obj):
+        #Rigs and proxies were matched on the first three letters of the rig name
+        return obj.name[:3]
+    if "FSim" in obj:
+        return obj["FSim"][-3:]
+    return None
+
+
+def Assign(obj, species):
+    """Give a rig or proxy that is being set up its species, without touching the index.  Done before
+    anything builds the index, so the first build doesn't sort a new rig by its name prefix"""
+    obj[SPECIES] = species
+
+
+def Species(scene, obj):
+    """The species of a rig or proxy.  One without a species yet, such as an older rig appended to the
+    file, starts its own species named after it"""
+    species = obj.get(SPECIES)
+    if species is None:
+        #Indexing a file from before the registry gives its rigs their species
+        Registry(scene)
+        species = obj.get(SPECIES)
+    if species is None:
+        species = obj.name
+        Register(scene, obj, species)
+    return species
+
+
+def Register(scene, obj, species=None):
+    """Add a rig (armature) or proxy (anything else) to the index of its species"""
+    if species is None:
+        species = Species(scene, obj)
+    else:
+        obj[SPECIES] = species
+    registry = Registry(scene)
+    entry = registry.get(species)
+    if entry is None:
+        registry[species] = {RIGS: {}, PROXIES: {}}
+        entry = registry[species]
+    entry[RIGS if obj.type == "ARMATURE" else PROXIES][obj.name] = 1
+
+
+def Migrate(scene):
+    """Give the rigs and proxies of a scene from before the registry their species from the old name
+    prefix, and index them.  Only done while the scene has no registry"""
+    for obj in scene.objects:
+        if SPECIES not in obj and LegacySpecies(obj) is not None:
+            obj[SPECIES] = LegacySpecies(obj)
+    Rebuild(scene)
+
+
+def Rebuild(scene):
+    """Index every rig and proxy with a species in the scene from scratch"""
+    scene[PROPERTY] = {}
+    for obj in scene.objects:
+        if SPECIES in obj:
+            Register(scene, obj, obj[SPECIES])
+
+
+def Entries(scene, species, kind):
+    #Live names of one kind, dropping objects deleted, renamed or moved to another species since
+    entry = Registry(scene).get(species)
+    if entry is None:
+        return []
+    names = entry[kind]
+    live = []
+    stale = []
+    for name in names.keys():
+        obj = scene.objects.get(name)
+        if obj is not None and obj.get(SPECIES) == species:
+            live.append(name)
+        else:
+            stale.append(name)
+    for name in stale:
+        del names[name]
+    return live
+
+
+def Rigs(scene, species):
+    """Names of the registered rigs of a species"""
+    return [name for name in Entries(scene, species, RIGS) if IsRig(scene.objects[name])]
+
+
+def Proxies(scene, species):
+    """Names of the registered target proxies of a species"""
+    return Entries(scene, species, PROXIES)
+
+
+@persistent
+def DepsgraphUpdatePost(scene, depsgraph):
+    #Objects copied in the viewport come with the species of the original, but aren't in the index yet
+    registry = scene.get(PROPERTY)
+    if registry is None:
+        return
+    for update in depsgraph.updates:
+        obj = update.id.original if isinstance(update.id, bpy.types.Object) else None
+        if obj is None or SPECIES not in obj:
+            continue
+        entry = registry.get(obj[SPECIES])
+        if entry is None or obj.name not in entry[RIGS if obj.type == "ARMATURE" else PROXIES]:
+            Register(scene, obj, obj[SPECIES])
+
+
+def register():
+    bpy.app.handlers.depsgraph_update_post.append(DepsgraphUpdatePost)
+
+
+def unregister():
+    if DepsgraphUpdatePost in bpy.app.handlers.depsgraph_update_post:
+        bpy.app.handlers.depsgraph_update_post.remove(DepsgraphUpdatePost)
@@ -0,0 +1,291 @@
+# ##### BEGIN GPL LICENSE BLOCK #####
+#
+#  FishSim  -- a script to apply a fish swimming simulation to an armature
+#  by Ian Huish (nerk)
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License
+#  as published by the Free Software Foundation; either version 2
+#  of the License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software Foundation,
+#  Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+# ##### END GPL LICENSE BLOCK #####
+
+# version comment: V4.02.0 - Goldfish Version - Blender 4.20 Extensions
+
+# Gait cache.
+# The meshes of a species' rig are baked over one tail beat of each gait in
+# swim_gaits.GAITS into a small file of float16 vertex offsets.  A crowd's
+# bodies are one mesh with a copy of those meshes per fish, and a
+# frame_change_pre handler rebuilds every copy from the offsets and the
+# crowd cache's swim attributes for the frame, with no armature to evaluate.
+
+import json
+import math
+import os
+import struct
+
+import bpy
+import numpy as np
+from bpy.app.handlers import persistent
+from mathutils import Matrix
+
+from . import crowd_cache
+from . import rig_profiles
+from . import sim_kernel
+from . import swim_cache
+from . import swim_gaits
+from .swim_cache import PREAMBLE, CacheUsers
+
+MAGIC = b"FSIMGAIT"
+VERSION = 1
+FILE_SUFFIX = ".fsimgait"
+
+#Loaded caches by absolute path - (modification time, swim_gaits.Gaits)
+_open = {}
+_users = CacheUsers("fsim_gait_cache", "MESH")
+
+
+def BodyMeshes(rig):
+    """The mesh children of a rig, in the order their vertices are baked"""
+    return sorted((child for child in rig.children if child.type == "MESH"), key=lambda child: child.name)
+
+
+def FishSpace(rig, obj):
+    #4x4 array taking an object's local coordinates to the rig's location and rotation, keeping its scale
+    location, rotation, scale = rig.matrix_world.decompose()
+    frame = Matrix.Translation(location) @ rotation.to_matrix().to_4x4()
+    return np.array(frame.inverted() @ obj.matrix_world, dtype=np.float32)
+
+
+def Coordinates(data, matrix):
+    #(V, 3) vertex positions of a mesh data block in fish space
+    co = np.empty(len(data.vertices) * 3, dtype=np.float32)
+    data.vertices.foreach_get("co", co)
+    return co.reshape(-1, 3) @ matrix[:3, :3].T + matrix[:3, 3]
+
+
+def Bake(context, rig, params, phases=swim_gaits.PHASES):
+    """(rest, offsets) of a rig's meshes over swim_gaits.GAITS, see swim_gaits.Gaits.  The rig's pose is
+    put back afterwards"""
+    bones = rig_profiles.PoseBones(rig)
+    if bones is None:
+        raise ValueError("{} doesn't fit any rig profile".format(rig.name))
+    meshes = BodyMeshes(rig)
+    if not meshes:
+        raise ValueError("{} has no meshes".format(rig.name))
+    euler = bones["spine"].rotation_mode != 'QUATERNION'
+    matrices = [FishSpace(rig, obj) for obj in meshes]
+    rest = np.concatenate([Coordinates(obj.data, matrix) for obj, matrix in zip(meshes, matrices)])
+    state = sim_kernel.FishState(rig.location, rig.rotation_euler, rig.scale, "pec_top_l" in bones)
+    initial = sim_kernel.InitialRow(state)
+
+    saved = [(bone, bone.rotation_quaternion.copy(), bone.rotation_euler.copy(), bone.scale.copy()) for bone in bones.values()]
+    offsets = np.empty((len(swim_gaits.GAITS), phases) + rest.shape, dtype=np.float32)
+    try:
+        for g, gait in enumerate(swim_gaits.GAITS):
+            for p in range(phases):
+                row = swim_gaits.GaitRow(params, initial, gait, 2.0 * math.pi * p / phases)
+                swim_cache.ApplyPose(rig, bones, row, euler)
+                context.view_layer.update()
+                depsgraph = context.evaluated_depsgraph_get()
+                deformed = []
+                for obj, matrix in zip(meshes, matrices):
+                    evaluated = obj.evaluated_get(depsgraph)
+                    data = evaluated.to_mesh()
+                    try:
+                        if len(data.vertices) != len(obj.data.vertices):
+                            raise ValueError("the modifiers of {} change its vertex count".format(obj.name))
+                        deformed.append(Coordinates(data, matrix))
+                    finally:
+                        evaluated.to_mesh_clear()
+                offsets[g, p] = np.concatenate(deformed) - rest
+    finally:
+        for bone, quaternion, euler_angles, scale in saved:
+            bone.rotation_quaternion = quaternion
+            bone.rotation_euler = euler_angles
+            bone.scale = scale
+        context.view_layer.update()
+    return rest, offsets
+
+
+def Write(path, species, rest, offsets, amplitudes, turn):
+    """Write the baked gaits of a species, offsets as float16"""
+    Close(path)
+    header = {
+        "version": VERSION,
+        "species": species,
+        "gaits": list(swim_gaits.GAITS),
+        "phases": offsets.shape[1],
+        "vertices": len(rest),
+        "amplitudes": [float(amplitude) for amplitude in amplitudes],
+        "turn": float(turn),
+        "offset": 0,
+    }
+    text = json.dumps(header)
+    offset = PREAMBLE.size + len(text) + 32
+    offset += -offset % 8
+    header["offset"] = offset
+    text = json.dumps(header).encode()
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temp = path + ".tmp"
+    with open(temp, "wb") as f:
+        f.write(PREAMBLE.pack(MAGIC, len(text)))
+        f.write(text)
+        f.seek(offset)
+        f.write(np.ascontiguousarray(rest, dtype=np.float32).tobytes())
+        f.write(np.ascontiguousarray(offsets, dtype=np.float16).tobytes())
+    os.replace(temp, path)
+
+
+def Load(path):
+    """The swim_gaits.Gaits of a gait cache file"""
+    with open(path, "rb") as f:
+        data = f.read()
+    try:
+        magic, length = PREAMBLE.unpack_from(data, 0)
+    except struct.error:
+        raise ValueError("not a gait cache")
+    if magic != MAGIC:
+        raise ValueError("not a gait cache")
+    header = json.loads(data[PREAMBLE.size:PREAMBLE.size + length])
+    if header["version"] != VERSION or header["gaits"] != list(swim_gaits.GAITS):
+        raise ValueError("unsupported gait cache version")
+    vertices = header["vertices"]
+    start = header["offset"]
+    end = start + 12 * vertices
+    rest = np.frombuffer(data, dtype=np.float32, count=3 * vertices, offset=start)
+    offsets = np.frombuffer(data, dtype=np.float16, count=len(swim_gaits.GAITS) * header["phases"] * 3 * vertices, offset=end)
+    return swim_gaits.Gaits(rest, offsets, header["amplitudes"], header["turn"])
+
+
+def Open(path):
+    """The Gaits of a file, reloaded when the file changes, or None if it can't be read"""
+    try:
+        mtime = os.stat(path).st_mtime
+    except OSError:
+        Close(path)
+        return None
+    entry = _open.get(path)
+    if entry is not None and entry[0] == mtime:
+        return entry[1]
+    Close(path)
+    try:
+        gaits = Load(path)
+    except (OSError, ValueError) as err:
+        print("FishSim gait cache not read:", path, err)
+        return None
+    _open[path] = (mtime, gaits)
+    return gaits
+
+
+def Close(path=None):
+    """Forget one loaded cache file, or all of them"""
+    if path is None:
+        _open.clear()
+    else:
+        _open.pop(path, None)
+
+
+def Track(obj):
+    """Note a bodies mesh that has just been given a gait cache file"""
+    _users.Add(obj)
+
+
+def BodiesMesh(name, meshes, fish):
+    """A new mesh with a copy of the faces, materials and UVs of a rig's meshes for each fish"""
+    vertices = 0
+    loopVerts, starts, indices, smooth, uvs = [], [], [], [], []
+    materials = []
+    loops = 0
+    for obj in meshes:
+        data = obj.data
+        values = np.empty(len(data.loops), dtype=np.int32)
+        data.loops.foreach_get("vertex_index", values)
+        loopVerts.append(values + vertices)
+        values = np.empty(len(data.polygons), dtype=np.int32)
+        data.polygons.foreach_get("loop_start", values)
+        starts.append(values + loops)
+        #Material indices of this mesh into the bodies' materials
+        slots = [slot.material for slot in obj.material_slots]
+        for material in slots:
+            if material not in materials:
+                materials.append(material)
+        remap = np.array([materials.index(material) for material in slots] or [0], dtype=np.int32)
+        values = np.empty(len(data.polygons), dtype=np.int32)
+        data.polygons.foreach_get("material_index", values)
+        indices.append(remap[np.minimum(values, len(remap) - 1)])
+        values = np.empty(len(data.polygons), dtype=bool)
+        data.polygons.foreach_get("use_smooth", values)
+        smooth.append(values)
+        values = np.zeros(len(data.loops) * 2, dtype=np.float32)
+        if data.uv_layers.active is not None:
+            data.uv_layers.active.data.foreach_get("uv", values)
+        uvs.append(values)
+        vertices += len(data.vertices)
+        loops += len(data.loops)
+    loopVerts, starts = np.concatenate(loopVerts), np.concatenate(starts)
+    copies = np.arange(fish, dtype=np.int32)[:, None]
+
+    mesh = bpy.data.meshes.new(name)
+    mesh.vertices.add(fish * vertices)
+    mesh.loops.add(fish * loops)
+    mesh.polygons.add(fish * len(starts))
+    mesh.loops.foreach_set("vertex_index", (loopVerts + copies * vertices).ravel())
+    mesh.polygons.foreach_set("loop_start", (starts + copies * loops).ravel())
+    mesh.polygons.foreach_set("material_index", np.tile(np.concatenate(indices), fish))
+    mesh.polygons.foreach_set("use_smooth", np.tile(np.concatenate(smooth), fish))
+    mesh.uv_layers.new(name="UVMap").data.foreach_set("uv", np.tile(np.concatenate(uvs), fish))
+    for material in materials:
+        mesh.materials.append(material)
+    mesh.update(calc_edges=True)
+    return mesh
+
+
+def ApplyFrame(mesh, gaits, values):
+    """Pose every fish of a bodies mesh from one frame of crowd attributes"""
+    mesh.vertices.foreach_set("co", gaits.Frame(values))
+    mesh.update()
+
+
+@persistent
+def FrameChangePre(scene, depsgraph=None):
+    #Pose the bodies of every crowd with an 'fsim_gait_cache' file for the new frame
+    for obj, path in _users.Objects(scene):
+        if not obj.get("fsim_gait_crowd"):
+            continue
+        gaits = Open(bpy.path.abspath(path))
+        crowd = crowd_cache.Open(bpy.path.abspath(obj["fsim_gait_crowd"]))
+        if gaits is None or crowd is None or len(obj.data.vertices) != crowd.fish * gaits.vertices:
+            continue
+        if "tail_turn" not in (name for name, width in crowd.attributes):
+            continue
+        ApplyFrame(obj.data, gaits, crowd.Frame(scene.frame_current))
+
+
+@persistent
+def LoadPre(*args):
+    Close()
+    _users.Forget()
+
+
+def register():
+    bpy.app.handlers.frame_change_pre.append(FrameChangePre)
+    bpy.app.handlers.load_pre.append(LoadPre)
+
+
+def unregister():
+    for handlers, handler in ((bpy.app.handlers.frame_change_pre, FrameChangePre), (bpy.app.handlers.load_pre, LoadPre)):
+        if handler in handlers:
+            handlers.remove(handler)
+    Close()
+    _users.Forget()
@@ -0,0 +1,92 @@
+# ##### BEGIN GPL LICENSE BLOCK #####
+#
+#  FishSim  -- a script to apply a fish swimming simulation to an armature
+#  by Ian Huish (nerk)
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License
+#  as published by the Free Software Foundation; either version 2
+#  of the License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software Foundation,
+#  Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+# ##### END GPL LICENSE BLOCK #####
+
+# version comment: V4.02.0 - Goldfish Version - Blender 4.20 Extensions
+
+# Bezier key fitting for baked channels.
+# A channel sampled on a set of frames is thinned out to the keys needed to
+# stay within a tolerance of every sample, each with free handles along the
+# slope of the samples around it.  The frames need not be evenly spaced, as
+# when only every few frames are keyed, so slopes are per frame and handles
+# reach a third of the way to the neighbouring keys.
+
+import math
+from array import array
+
+
+def FitKeys(frames, values, tolerance):
+    """Indices and slopes (value per frame) of the keys of a Bezier curve through (frames, values)
+    that stays within tolerance of every value.
+
+    Each key takes the slope of the samples around it, and segments are split at their worst
+    sample until every sample is close enough.
+    """
+    count = len(values)
+    if count == 0:
+        return [], []
+    if max(values) - min(values) <= tolerance:
+        return [0], [0.0]
+    slopes = [0.0] * count
+    for k in range(1, count - 1):
+        slopes[k] = (values[k + 1] - values[k - 1]) / (frames[k + 1] - frames[k - 1])
+    slopes[0] = (values[1] - values[0]) / (frames[1] - frames[0])
+    slopes[-1] = (values[-1] - values[-2]) / (frames[-1] - frames[-2])
+
+    keys = {0, count - 1}
+    segments = [(0, count - 1)]
+    while segments:
+        a, b = segments.pop()
+        d = frames[b] - frames[a]
+        va, vb, ma, mb = values[a], values[b], slopes[a] * d, slopes[b] * d
+        worst, worstErr = -1, tolerance
+        for k in range(a + 1, b):
+            #Cubic Hermite - the same curve as a Bezier with handles a third of the way along
+            t = (frames[k] - frames[a]) / d
+            t2 = t * t
+            t3 = t2 * t
+            v = (2 * t3 - 3 * t2 + 1) * va + (t3 - 2 * t2 + t) * ma + (3 * t2 - 2 * t3) * vb + (t3 - t2) * mb
+            err = math.fabs(v - values[k])
+            if err > worstErr:
+                worst, worstErr = k, err
+        if worst >= 0:
+            keys.add(worst)
+            segments.append((a, worst))
+            segments.append((worst, b))
+    keys = sorted(keys)
+    return keys, [slopes[k] for k in keys]
+
+
+def FitCurve(frames, values, tolerance):
+    """Flat (frame, value) arrays of the co, handle_left and handle_right of the keys FitKeys finds.
+
+    The end keys get handles one frame long on their outer side.
+    """
+    co = array('f')
+    left = array('f')
+    right = array('f')
+    keys, slopes = FitKeys(frames, values, tolerance)
+    for n, (k, slope) in enumerate(zip(keys, slopes)):
+        before = (frames[k] - frames[keys[n - 1]]) / 3.0 if n > 0 else 1.0
+        after = (frames[keys[n + 1]] - frames[k]) / 3.0 if n < len(keys) - 1 else 1.0
+        co.extend((frames[k], values[k]))
+        left.extend((frames[k] - before, values[k] - slope * before))
+        right.extend((frames[k] + after, values[k] + slope * after))
+    return co, left, right
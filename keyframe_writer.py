@@ -0,0 +1,421 @@
+# ##### BEGIN GPL LICENSE BLOCK #####
+#
+#  FishSim  -- a script to apply a fish swimming simulation to an armature
+#  by Ian Huish (nerk)
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License
+#  as published by the Free Software Foundation; either version 2
+#  of the License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software Foundation,
+#  Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+# ##### END GPL LICENSE BLOCK #####
+
+# version comment: V4.02.0 - Goldfish Version - Blender 4.20 Extensions
+
+# Bulk F-Curve writer for simulated fish.
+# Instead of calling keyframe_insert for every channel on every frame, each
+# F-Curve is written in one go from flat arrays with foreach_set, and its
+# handles are recalculated once.  Optionally, channels are thinned out to
+# the keys needed to stay within a tolerance, with fitted Bezier handles
+# (see key_fitting).
+
+import bpy
+import bisect
+import math
+from array import array
+
+from . import key_fitting
+from . import swim_cycles
+
+#Per key vectors and enums kept when part of an F-Curve is replaced.  foreach_get/set see the
+#enums as their integer values, of which 'FREE' handles are 0
+KEY_VECTORS = ("co", "handle_left", "handle_right")
+KEY_ENUMS = ("handle_left_type", "handle_right_type", "interpolation")
+HANDLE_FREE = 0
+
+#NLA tracks holding the swim cycles of a fish
+SWIM_TRACK = "FSim Swim"
+CYCLE_TRACK = "FSim Cycles"
+
+OBJECT_GROUP = "Object Transforms"
+
+
+def EnsureAction(obj):
+    #Make sure the object has an action to write into
+    if obj.animation_data is None:
+        obj.animation_data_create()
+    if obj.animation_data.action is None:
+        obj.animation_data.action = bpy.data.actions.new(obj.name + "Action")
+    return obj.animation_data.action
+
+
+def InsertKey(obj, data_path, frame, values, group="Object Transforms"):
+    """Key every index of a property on one frame, returning the F-Curves to update() once all keys are in"""
+    action = EnsureAction(obj)
+    fcurves = []
+    for index, value in enumerate(values):
+        fcurve = action.fcurves.find(data_path, index=index)
+        if fcurve is None:
+            fcurve = action.fcurves.new(data_path, index=index, action_group=group)
+        fcurve.keyframe_points.insert(frame, value, options={'FAST'})
+        fcurves.append(fcurve)
+    return fcurves
+
+
+def WriteFCurve(action, data_path, index, group, frames, values, keepBefore=False, tolerance=0.0, spans=None):
+    """Replace the keys of one F-Curve with the given frames and values, returning the number of keys written.
+
+    With keepBefore, existing keys before the first new frame are kept, the rest are replaced.
+    With a tolerance, only the keys needed to stay within it of every value are written, with
+    fitted Bezier handles.  spans limits the keys to (first, last) index ranges of the values.
+    """
+    if spans is None:
+        spans = ((0, len(values) - 1),)
+    fcurve = action.fcurves.find(data_path, index=index)
+    kept = array('f')
+    keptLeft = array('f')
+    keptRight = array('f')
+    keptTypes = []
+    if fcurve is None:
+        fcurve = action.fcurves.new(data_path, index=index, action_group=group)
+    else:
+        points = fcurve.keyframe_points
+        if keepBefore and len(points) > 0 and len(frames) > 0:
+            old = array('f', bytes(8 * len(points)))
+            points.foreach_get("co", old)
+            keep = [i for i in range(len(points)) if old[2 * i] < frames[0]]
+            for i in keep:
+                kept.extend(old[2 * i:2 * i + 2])
+            if keep and tolerance > 0.0:
+                #Fitted keys have their own handles, so keep those too
+                oldLeft = array('f', bytes(8 * len(points)))
+                oldRight = array('f', bytes(8 * len(points)))
+                points.foreach_get("handle_left", oldLeft)
+                points.foreach_get("handle_right", oldRight)
+                for i in keep:
+                    keptLeft.extend(oldLeft[2 * i:2 * i + 2])
+                    keptRight.extend(oldRight[2 * i:2 * i + 2])
+                    keptTypes.append((points[i].handle_left_type, points[i].handle_right_type))
+        points.clear()
+
+    points = fcurve.keyframe_points
+    if tolerance <= 0.0:
+        co = array('f')
+        for first, last in spans:
+            part = array('f', bytes(8 * (last - first + 1)))
+            part[0::2] = frames[first:last + 1]
+            part[1::2] = values[first:last + 1]
+            co.extend(part)
+        count = len(co) // 2
+        points.add(len(kept) // 2 + count)
+        points.foreach_set("co", kept + co)
+        fcurve.update()
+        return count
+
+    co = array('f')
+    left = array('f')
+    right = array('f')
+    for first, last in spans:
+        fitted = key_fitting.FitCurve(frames[first:last + 1], values[first:last + 1], tolerance)
+        for buffer, part in zip((co, left, right), fitted):
+            buffer.extend(part)
+    count = len(co) // 2
+    points.add(len(kept) // 2 + count)
+    for i, (leftType, rightType) in enumerate(keptTypes):
+        points[i].handle_left_type = leftType
+        points[i].handle_right_type = rightType
+    for point in points[len(keptTypes):]:
+        point.handle_left_type = 'FREE'
+        point.handle_right_type = 'FREE'
+    points.foreach_set("co", kept + co)
+    points.foreach_set("handle_left", keptLeft + left)
+    points.foreach_set("handle_right", keptRight + right)
+    fcurve.update()
+    return count
+
+
+def WriteFCurveRange(action, data_path, index, group, frames, values, tolerance=0.0):
+    """Replace the keys of one F-Curve from frames[0] to frames[-1], keeping the keys either side.
+
+    Returns the number of keys written.
+    """
+    fcurve = action.fcurves.find(data_path, index=index)
+    if fcurve is None:
+        return WriteFCurve(action, data_path, index, group, frames, values, tolerance=tolerance)
+    points = fcurve.keyframe_points
+    total = len(points)
+    old = {name: array('f', bytes(8 * total)) for name in KEY_VECTORS}
+    oldTypes = {name: array('i', bytes(4 * total)) for name in KEY_ENUMS}
+    for name, buffer in list(old.items()) + list(oldTypes.items()):
+        points.foreach_get(name, buffer)
+    #Keys are sorted by frame, so the range is one slice of them
+    keyFrames = old["co"][0::2]
+    first = bisect.bisect_left(keyFrames, frames[0])
+    last = bisect.bisect_right(keyFrames, frames[-1])
+
+    if tolerance <= 0.0:
+        co = array('f', bytes(8 * len(values)))
+        co[0::2] = frames
+        co[1::2] = values
+        #Placeholders, automatic handles are worked out by fcurve.update()
+        new = {"co": co, "handle_left": co, "handle_right": co}
+    else:
+        new = dict(zip(KEY_VECTORS, key_fitting.FitCurve(frames, values, tolerance)))
+    count = len(new["co"]) // 2
+
+    #Rebuild the curve in one go - the kept keys with their own handles and types, the new ones in between
+    points.clear()
+    points.add(first + count + total - last)
+    types = {name: array('i', bytes(4 * len(points))) for name in KEY_ENUMS}
+    for name, buffer in types.items():
+        #New keys start with the default types
+        points.foreach_get(name, buffer)
+        buffer[:first] = oldTypes[name][:first]
+        buffer[first + count:] = oldTypes[name][last:]
+    if tolerance > 0.0:
+        for name in ("handle_left_type", "handle_right_type"):
+            types[name][first:first + count] = array('i', [HANDLE_FREE]) * count
+    for name in KEY_VECTORS:
+        points.foreach_set(name, old[name][:2 * first] + new[name] + old[name][2 * last:])
+    for name, buffer in types.items():
+        points.foreach_set(name, buffer)
+    fcurve.update()
+    return count
+
+
+def Constant(value, count):
+    return array('f', [value]) * count
+
+
+def AxisQuat(angles, axis):
+    #Quaternion components for rotations about a single axis (0=X, 1=Y, 2=Z)
+    count = len(angles)
+    comps = [array('f', (math.cos(a * 0.5) for a in angles)), Constant(0.0, count), Constant(0.0, count), Constant(0.0, count)]
+    comps[axis + 1] = array('f', (math.sin(a * 0.5) for a in angles))
+    return comps
+
+
+def ChestQuat(angles_z, angles_x):
+    #Quaternion(Z, a) @ Quaternion(X, b)
+    cz = [math.cos(a * 0.5) for a in angles_z]
+    sz = [math.sin(a * 0.5) for a in angles_z]
+    cx = [math.cos(b * 0.5) for b in angles_x]
+    sx = [math.sin(b * 0.5) for b in angles_x]
+    return [
+        array('f', map(lambda a, b: a * b, cz, cx)),
+        array('f', map(lambda a, b: a * b, cz, sx)),
+        array('f', map(lambda a, b: a * b, sz, sx)),
+        array('f', map(lambda a, b: a * b, sz, cx)),
+    ]
+
+
+#Bones only ever turned about one or two axes, keyed as Euler angles by minimal keying
+EULER_ROLES = ("spine", "chest", "torso", "side_fin_l", "side_fin_r")
+
+
+def SetRotationModes(bones, minimal):
+    """Switch the single axis bones to Euler rotation for minimal keying, or back to quaternions"""
+    mode = 'XYZ' if minimal else 'QUATERNION'
+    for role in EULER_ROLES:
+        bone = bones[role]
+        if bone.rotation_mode != mode:
+            bone.rotation_mode = mode
+        #Every axis the simulation doesn't key stays at rest
+        bone.rotation_euler = (0.0, 0.0, 0.0)
+        bone.rotation_quaternion = (1.0, 0.0, 0.0, 0.0)
+
+
+def BakeChannels(bake, bones, minimal=False, roles=None):
+    """List (data_path, index, group, values) for every F-Curve of a baked fish.
+
+    bones maps the kernel bone roles (spine, chest, root, pec_palm_l...) to pose bones.
+    With minimal, only the channels the simulation changes are listed - single axis Euler
+    rotations (see SetRotationModes) and the y scale of the fins.  roles limits the bones
+    listed, the object location and rotation are always there.
+    """
+    tracks = bake.tracks
+    count = len(bake)
+    channels = []
+
+    def Add(data_path, group, comps):
+        for index, values in enumerate(comps):
+            channels.append((data_path, index, group, values))
+
+    def AddBone(role, prop, comps):
+        if roles is not None and role not in roles:
+            return
+        bone = bones[role]
+        Add('pose.bones["{}"].{}'.format(bone.name, prop), bone.name, comps)
+
+    def AddAxis(role, prop, index, values):
+        if roles is not None and role not in roles:
+            return
+        bone = bones[role]
+        channels.append(('pose.bones["{}"].{}'.format(bone.name, prop), index, bone.name, values))
+
+    def AddScale(role, track):
+        #Only the y scale is simulated, the others keep their current value
+        if roles is not None and role not in roles:
+            return
+        bone = bones[role]
+        if minimal:
+            AddAxis(role, "scale", 1, tracks[track])
+        else:
+            AddBone(role, "scale", [Constant(bone.scale[0], count), tracks[track], Constant(bone.scale[2], count)])
+
+    Add("location", OBJECT_GROUP, [tracks["loc_x"], tracks["loc_y"], tracks["loc_z"]])
+    Add("rotation_euler", OBJECT_GROUP, [tracks["rot_x"], tracks["rot_y"], tracks["rot_z"]])
+    AddBone("root", "rotation_quaternion", [tracks["root_qw"], tracks["root_qx"], tracks["root_qy"], tracks["root_qz"]])
+    if minimal:
+        #XYZ Euler applies X first, the same as Quaternion(Z) @ Quaternion(X) for the chest
+        AddAxis("spine", "rotation_euler", 2, tracks["spine_z"])
+        AddAxis("chest", "rotation_euler", 0, tracks["chest_x"])
+        AddAxis("chest", "rotation_euler", 2, tracks["chest_z"])
+        AddAxis("torso", "rotation_euler", 1, tracks["torso_y"])
+        AddAxis("side_fin_l", "rotation_euler", 0, tracks["side_fin_l_x"])
+        AddAxis("side_fin_r", "rotation_euler", 0, tracks["side_fin_r_x"])
+    else:
+        AddBone("spine", "rotation_quaternion", AxisQuat(tracks["spine_z"], 2))
+        AddBone("chest", "rotation_quaternion", ChestQuat(tracks["chest_z"], tracks["chest_x"]))
+        AddBone("torso", "rotation_quaternion", AxisQuat(tracks["torso_y"], 1))
+        AddBone("side_fin_l", "rotation_quaternion", AxisQuat(tracks["side_fin_l_x"], 0))
+        AddBone("side_fin_r", "rotation_quaternion", AxisQuat(tracks["side_fin_r_x"], 0))
+    AddScale("back_fin1", "back_fin1_sy")
+    AddScale("back_fin2", "back_fin2_sy")
+    if "pec_top_l_sy" in tracks:
+        for side in ("l", "r"):
+            palm = "pec_palm_" + side
+            AddBone(palm, "rotation_quaternion", [tracks[palm + "_qw"], tracks[palm + "_qx"], tracks[palm + "_qy"], tracks[palm + "_qz"]])
+            AddScale("pec_top_" + side, "pec_top_" + side + "_sy")
+            AddScale("pec_bottom_" + side, "pec_bottom_" + side + "_sy")
+    return channels
+
+
+def Tolerance(data_path, tolerances):
+    #Tolerance of a channel from its kind - {"location": .., "rotation": .., "scale": ..}
+    if tolerances is None:
+        return 0.0
+    if data_path.endswith("location"):
+        return tolerances["location"]
+    if data_path.endswith("scale"):
+        return tolerances["scale"]
+    return tolerances["rotation"]
+
+
+def ClearCycles(obj):
+    """Remove the swim cycle NLA tracks of an earlier run, and their actions once unused"""
+    anim = obj.animation_data
+    if anim is None:
+        return
+    actions = set()
+    for track in [track for track in anim.nla_tracks if track.name in (SWIM_TRACK, CYCLE_TRACK)]:
+        actions.update(strip.action for strip in track.strips if strip.action is not None)
+        anim.nla_tracks.remove(track)
+    for action in actions:
+        if action.users == 0:
+            bpy.data.actions.remove(action)
+
+
+def HasCycles(obj):
+    """True if swim cycles on the NLA play some of the bones"""
+    anim = obj.animation_data
+    return anim is not None and any(track.name in (SWIM_TRACK, CYCLE_TRACK) for track in anim.nla_tracks)
+
+
+def WriteCycles(obj, bones, bake, gaits, cycles, tolerances=None, minimal=False):
+    """Put the cycled bones of a baked fish on the NLA - one cyclic action per gait, repeated over
+    each of its cycles, above an action with the keys between the cycles.
+
+    Returns the number of keys written and the names of the channels left to the active action.
+    """
+    groups = {bones[role].name for role in swim_cycles.CYCLE_ROLES}
+    anim = obj.animation_data
+    written = 0
+
+    spans = swim_cycles.KeySpans(cycles, len(bake))
+    if spans:
+        action = bpy.data.actions.new("FSim Swim " + obj.name)
+        frames = array('f', range(bake.startFrame, bake.startFrame + len(bake)))
+        for data_path, index, group, values in BakeChannels(bake, bones, minimal):
+            if group in groups:
+                written += WriteFCurve(action, data_path, index, group, frames, values,
+                                       tolerance=Tolerance(data_path, tolerances), spans=spans)
+        action.use_frame_range = True
+        action.frame_start = bake.startFrame
+        action.frame_end = bake.startFrame + len(bake) - 1
+        track = anim.nla_tracks.new()
+        track.name = SWIM_TRACK
+        track.strips.new(action.name, bake.startFrame, action)
+
+    #Gaits are keyed linearly, which is what the cycles were matched against
+    gaitActions = []
+    for n, gait in enumerate(gaits):
+        action = bpy.data.actions.new("FSim Gait {} {}".format(obj.name, n))
+        frames = array('f', range(len(gait)))
+        for data_path, index, group, values in BakeChannels(gait, bones, minimal):
+            if group in groups:
+                written += WriteFCurve(action, data_path, index, group, frames, values)
+                for point in action.fcurves[-1].keyframe_points:
+                    point.interpolation = 'LINEAR'
+        gaitActions.append(action)
+
+    track = anim.nla_tracks.new()
+    track.name = CYCLE_TRACK
+    for n, cycle in enumerate(cycles):
+        action = gaitActions[cycle.gait]
+        strip = track.strips.new("FSim Cycle {}".format(n), bake.startFrame + cycle.start, action)
+        strip.blend_type = 'REPLACE'
+        strip.extrapolation = 'NOTHING'
+        strip.scale = cycle.period / (len(gaits[cycle.gait]) - 1)
+        strip.repeat = cycle.repeats
+    return written, groups
+
+
+def Sparse(values, step):
+    #Every step'th value, always ending on the last one
+    if step <= 1:
+        return values
+    sparse = values[::step]
+    if (len(values) - 1) % step:
+        sparse.append(values[-1])
+    return sparse
+
+
+def WriteBake(obj, bones, bake, keepBefore=False, tolerances=None, minimal=False, cycles=None, replaceRange=False, roles=None, step=1):
+    """Write every F-Curve of a baked fish onto its armature object.
+
+    cycles is the (gaits, cycles) result of swim_cycles.FindCycles, to play the cycled bones from
+    the NLA instead.  With replaceRange, the first row only seeds the simulation, and the keys after
+    it are replaced leaving the rest of the animation alone.  roles limits the bones keyed (see
+    BakeChannels) and step keys only every step'th frame.  Returns the number of keys written
+    and the number dropped by the tolerances, the cycles or the step.
+    """
+    action = EnsureAction(obj)
+    frames = array('f', range(bake.startFrame, bake.startFrame + len(bake)))
+    channels = BakeChannels(bake, bones, minimal, roles)
+    if step > 1:
+        frames = Sparse(frames, step)
+        channels = [(data_path, index, group, Sparse(values, step)) for data_path, index, group, values in channels]
+    if replaceRange:
+        written = 0
+        for data_path, index, group, values in channels:
+            written += WriteFCurveRange(action, data_path, index, group, frames[1:], values[1:], Tolerance(data_path, tolerances))
+        return written, len(channels) * (len(bake) - 1) - written
+    ClearCycles(obj)
+    written = 0
+    cycled = ()
+    if cycles is not None and cycles[1]:
+        written, cycled = WriteCycles(obj, bones, bake, cycles[0], cycles[1], tolerances, minimal)
+    for data_path, index, group, values in channels:
+        if group not in cycled:
+            written += WriteFCurve(action, data_path, index, group, frames, values, keepBefore, Tolerance(data_path, tolerances))
+    return written, len(channels) * len(bake) - written
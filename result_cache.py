@@ -0,0 +1,189 @@
+# ##### BEGIN GPL LICENSE BLOCK #####
+#
+#  FishSim  -- a script to apply a fish swimming simulation to an armature
+#  by Ian Huish (nerk)
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License
+#  as published by the Free Software Foundation; either version 2
+#  of the License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software Foundation,
+#  Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+# ##### END GPL LICENSE BLOCK #####
+
+# version comment: V4.02.0 - Goldfish Version - Blender 4.20 Extensions
+
+# Simulation result cache.
+# Finished bakes are kept by the content hash of everything that went into
+# them (sim_kernel.ResultKey), first in an in-session LRU shared by every
+# run, then in a cache folder on disk whose total size is bounded by
+# deleting the least recently used files.  The folder is listed once per
+# run, after that its size is kept up to date as files are written and
+# deleted.
+
+import json
+import os
+from array import array
+from collections import OrderedDict
+
+try:
+    from . import sim_kernel
+except ImportError:
+    import sim_kernel
+
+#Bytes of channel data kept in memory between runs
+MEMORY_LIMIT = 256 * 1024 * 1024
+FILE_SUFFIX = ".fsim"
+
+#Shared by every run in this Blender session - key: CachedResult
+_session = OrderedDict()
+_sessionBytes = 0
+
+
+class CachedResult:
+    """A finished bake, the packed final state and the checkpoints of one fish"""
+    __slots__ = ("bake", "state", "checkpoints")
+
+    def __init__(self, bake, state, checkpoints):
+        self.bake = bake
+        self.state = state
+        self.checkpoints = checkpoints
+
+    def Size(self):
+        return 4 * len(self.bake) * len(self.bake.tracks)
+
+
+def Remember(key, result):
+    #Add to the session LRU, dropping the oldest entries beyond the memory limit
+    global _sessionBytes
+    if key in _session:
+        _sessionBytes -= _session.pop(key).Size()
+    _session[key] = result
+    _sessionBytes += result.Size()
+    while _sessionBytes > MEMORY_LIMIT and len(_session) > 1:
+        _sessionBytes -= _session.popitem(last=False)[1].Size()
+
+
+def Forget():
+    """Empty the session LRU"""
+    global _sessionBytes
+    _session.clear()
+    _sessionBytes = 0
+
+
+class ResultCache:
+    """The session LRU backed by a cache folder of at most diskLimit bytes (0 for no disk cache)"""
+
+    def __init__(self, folder, diskLimit):
+        self.folder = folder
+        self.diskLimit = diskLimit
+        self.hits = 0
+        #The cache files, least recently used first - name: size - and their total, see Files
+        self.files = None
+        self.size = 0
+
+    def Path(self, key):
+        return os.path.join(self.folder, key + FILE_SUFFIX)
+
+    def Get(self, key):
+        result = _session.get(key)
+        if result is not None:
+            _session.move_to_end(key)
+        elif self.diskLimit > 0:
+            result = self.Load(key)
+            if result is not None:
+                Remember(key, result)
+        if result is not None:
+            self.hits += 1
+        return result
+
+    def Put(self, key, result):
+        Remember(key, result)
+        if self.diskLimit > 0:
+            try:
+                self.Save(key, result)
+                self.Evict()
+            except OSError as err:
+                print("FishSim cache not written:", err)
+
+    def Load(self, key):
+        path = self.Path(key)
+        try:
+            with open(path, "rb") as f:
+                header = json.loads(f.readline())
+                data = f.read()
+                size = f.tell()
+        except (OSError, ValueError):
+            return None
+        if header.get("version") != sim_kernel.CHECKPOINT_VERSION:
+            return None
+        bake = sim_kernel.FishBake(header["startFrame"], header["goldfish"])
+        count = header["count"]
+        if len(data) != 4 * count * len(header["tracks"]):
+            return None
+        for i, name in enumerate(header["tracks"]):
+            bake.tracks[name] = array('f', data[4 * count * i:4 * count * (i + 1)])
+        #Mark as recently used for eviction
+        os.utime(path)
+        self.Used(os.path.basename(path), size)
+        checkpoints = {int(nFrame): array('d', values) for nFrame, values in header["checkpoints"].items()}
+        return CachedResult(bake, array('d', header["state"]), checkpoints)
+
+    def Save(self, key, result):
+        os.makedirs(self.folder, exist_ok=True)
+        bake = result.bake
+        header = {
+            "version": sim_kernel.CHECKPOINT_VERSION,
+            "startFrame": bake.startFrame,
+            "goldfish": "pec_top_l_sy" in bake.tracks,
+            "tracks": list(bake.tracks),
+            "count": len(bake),
+            "state": list(result.state),
+            "checkpoints": {str(nFrame): list(values) for nFrame, values in result.checkpoints.items()},
+        }
+        temp = self.Path(key) + ".tmp"
+        with open(temp, "wb") as f:
+            f.write(json.dumps(header).encode() + b"\n")
+            for values in bake.tracks.values():
+                f.write(values.tobytes())
+            size = f.tell()
+        os.replace(temp, self.Path(key))
+        self.Used(os.path.basename(self.Path(key)), size)
+
+    def Files(self):
+        #The cache files by last use, listed from the folder on first use - Load, Save and Evict keep them up to date
+        if self.files is None:
+            entries = []
+            names = os.listdir(self.folder) if os.path.isdir(self.folder) else []
+            for name in names:
+                if name.endswith(FILE_SUFFIX):
+                    stat = os.stat(os.path.join(self.folder, name))
+                    entries.append((stat.st_mtime, stat.st_size, name))
+            self.files = OrderedDict((name, size) for mtime, size, name in sorted(entries))
+            self.size = sum(self.files.values())
+        return self.files
+
+    def Used(self, name, size):
+        #Move a file that has just been read or written to the most recently used end
+        files = self.Files()
+        self.size += size - files.pop(name, 0)
+        files[name] = size
+
+    def Evict(self):
+        #Delete the least recently used files until the folder fits in the limit
+        files = self.Files()
+        while self.size > self.diskLimit and files:
+            name, size = files.popitem(last=False)
+            self.size -= size
+            try:
+                os.remove(os.path.join(self.folder, name))
+            except FileNotFoundError:
+                pass
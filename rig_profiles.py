@@ -0,0 +1,144 @@
+# ##### BEGIN GPL LICENSE BLOCK #####
+#
+#  FishSim  -- a script to apply a fish swimming simulation to an armature
+#  by Ian Huish (nerk)
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License
+#  as published by the Free Software Foundation; either version 2
+#  of the License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software Foundation,
+#  Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+# ##### END GPL LICENSE BLOCK #####
+
+
+# version comment: V4.02.0 - Goldfish Version - Blender 4.20 Extensions
+
+# Rig profiles.
+# Each supported rig type maps the bone roles the simulation drives (root,
+# spine, chest, back_fin1, pec_top_l...) to the bone names of its generated
+# Rigify rig.  An armature is matched against the profiles once per armature
+# data block and the result is kept, so copies sharing one armature resolve
+# once, and panels can ask for a rig's capabilities without searching bones.
+# A rig with other bone names can carry its own 'fsim_bones' {role: name}
+# property on its armature data.
+
+#Roles every rig needs, with the bone names tried for each in order
+BODY_BONES = {
+    "root": ("root",),
+    "torso": ("torso",),
+    "spine": ("spine_master", "spine_master.002"),
+    "back_fin1": ("back_fin_masterBk.001", "back_fin.T.Bk_master"),
+    "back_fin2": ("back_fin_masterBk", "back_fin.B.Bk_master"),
+    "back_fin_middle": ("DEF-back_fin.T.001.Bk",),
+    "chest": ("chest",),
+    "side_fin_l": ("side_fin.L",),
+    "side_fin_r": ("side_fin.R",),
+}
+#Roles of the pectoral fins, all or none of which a rig has
+PEC_ROLES = ("pec_top_l", "pec_top_r", "pec_bottom_l", "pec_bottom_r", "pec_palm_l", "pec_palm_r")
+
+
+class RigProfile:
+    """A rig type - candidate bone names by role, and whether it has pectoral fins"""
+    __slots__ = ("name", "bones", "pecs")
+
+    def __init__(self, name, bones):
+        self.name = name
+        self.bones = bones
+        self.pecs = all(role in bones for role in PEC_ROLES)
+
+    def Match(self, armature):
+        #{role: bone name} if the armature data has a bone for every role, else None
+        names = {}
+        for role, candidates in self.bones.items():
+            for name in candidates:
+                if name in armature.bones:
+                    names[role] = name
+                    break
+            else:
+                return None
+        return names
+
+
+#Tried in order, so the profiles with more roles come first
+PROFILES = [
+    RigProfile("Goldfish", dict(BODY_BONES, **{
+        "pec_top_l": ("tpec_master.L",), "pec_top_r": ("tpec_master.R",),
+        "pec_bottom_l": ("bpec_master.L",), "pec_bottom_r": ("bpec_master.R",),
+        "pec_palm_l": ("pec_palm.L",), "pec_palm_r": ("pec_palm.R",)})),
+    RigProfile("ArcherFish", dict(BODY_BONES, **{
+        "pec_top_l": ("t_master.L",), "pec_top_r": ("t_master.R",),
+        "pec_bottom_l": ("b_master.L",), "pec_bottom_r": ("b_master.R",),
+        "pec_palm_l": ("pec_palm.L",), "pec_palm_r": ("pec_palm.R",)})),
+    RigProfile("Shark", dict(BODY_BONES)),
+]
+
+#Resolved armature data blocks - pointer: (bone count, RigProfile, {role: bone name})
+_resolved = {}
+
+
+def AddProfile(profile):
+    """Register another rig type, tried before the built in ones"""
+    PROFILES.insert(0, profile)
+    _resolved.clear()
+
+
+def Forget():
+    _resolved.clear()
+
+
+def Resolve(armature):
+    """(RigProfile, {role: bone name}) of an armature data block, or None if no profile fits"""
+    key = armature.as_pointer()
+    entry = _resolved.get(key)
+    if entry is not None and entry[0] == len(armature.bones):
+        return entry[1], entry[2]
+    _resolved.pop(key, None)
+    profiles = PROFILES
+    custom = armature.get("fsim_bones")
+    if custom is not None:
+        profiles = [RigProfile("Custom", {role: (name,) for role, name in custom.items()})]
+    for profile in profiles:
+        if not all(role in profile.bones for role in BODY_BONES):
+            continue
+        names = profile.Match(armature)
+        if names is not None:
+            _resolved[key] = (len(armature.bones), profile, names)
+            return profile, names
+    return None
+
+
+def Profile(rig):
+    """The RigProfile of an armature object, or None"""
+    if rig is None or rig.type != "ARMATURE":
+        return None
+    entry = Resolve(rig.data)
+    return entry[0] if entry is not None else None
+
+
+def PoseBones(rig):
+    """The pose bones of an armature object by role, or None if it doesn't fit a profile"""
+    for attempt in range(2):
+        entry = Resolve(rig.data)
+        if entry is None:
+            return None
+        bones = {role: rig.pose.bones.get(name) for role, name in entry[1].items()}
+        if None not in bones.values():
+            return bones
+        #Bones renamed since the armature was resolved
+        _resolved.pop(rig.data.as_pointer(), None)
+    return None
+
+
+def Validate(rigs):
+    """Resolve a batch of armature objects before a run, returning the names of those that don't fit any profile"""
+    return [rig.name for rig in rigs if Resolve(rig.data) is None]
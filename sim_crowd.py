@@ -0,0 +1,100 @@
+# ##### BEGIN GPL LICENSE BLOCK #####
+#
+#  FishSim  -- a script to apply a fish swimming simulation to an armature
+#  by Ian Huish (nerk)
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License
+#  as published by the Free Software Foundation; either version 2
+#  of the License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software Foundation,
+#  Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+# ##### END GPL LICENSE BLOCK #####
+
+
+# version comment: V4.02.0 - Goldfish Version - Blender 4.20 Extensions
+
+# Root motion crowd.
+# For very large shoals only the steering and locomotion of each fish are
+# simulated (StepFish/StepSchool with rootOnly), without an armature.  Every
+# frame gives one block of per fish attributes - position, rotation, speed,
+# tail phase, tail amplitude, tail turn offset and hover mode - for Geometry
+# Nodes to instance fish on and drive a procedural swim from, or for the
+# baked gaits of a species to play back on (see gait_cache).
+
+from array import array
+
+try:
+    from . import sim_kernel
+    from . import sim_school
+except ImportError:
+    import sim_kernel
+    import sim_school
+
+#Per fish attributes of each frame block, in order, with their number of components
+ATTRIBUTES = (("position", 3), ("rotation", 3), ("speed", 1), ("tail_phase", 1), ("tail_amplitude", 1),
+              ("tail_turn", 1), ("hover", 1))
+
+
+def BlockSize(count):
+    """Floats in the block of one frame for count fish"""
+    return count * sum(width for name, width in ATTRIBUTES)
+
+
+def ScalarFrames(params, states, trajectories, startFrame, endFrame):
+    #One fish at a time with sim_kernel
+    for nFrame in range(startFrame, endFrame + 1):
+        stepped = False
+        for state, trajectory in zip(states, trajectories):
+            proxy = trajectory.Sample(nFrame) if trajectory is not None else None
+            stepped = sim_kernel.StepFish(state, params, nFrame, startFrame, proxy, state.sOldBackFin, rootOnly=True) is not None or stepped
+        if nFrame == startFrame or stepped:
+            block = array('f')
+            for state in states:
+                block.extend(state.sLocation)
+            for state in states:
+                block.extend(state.sRotation)
+            attributes = [sim_kernel.SwimAttributes(state, params) for state in states]
+            for i in range(len(ATTRIBUTES) - 2):
+                block.extend(values[i] for values in attributes)
+            yield block
+
+
+def VectorFrames(params, states, trajectories, startFrame, endFrame):
+    #The whole crowd together with NumPy
+    np = sim_school.np
+    school = sim_school.SchoolState.FromFish(states)
+    hasProxy = np.array([trajectory is not None for trajectory in trajectories], dtype=bool)
+    matrices = [np.frombuffer(trajectory.matrices, dtype=np.float32).reshape(-1, 16) if trajectory is not None else None for trajectory in trajectories]
+    sizes = [np.frombuffer(trajectory.sizes, dtype=np.float32) if trajectory is not None else None for trajectory in trajectories]
+    identity = np.eye(4).reshape(16)
+    for nFrame in range(startFrame, endFrame + 1):
+        i = nFrame - startFrame
+        frameMatrices = np.array([m[min(i, len(m) - 1)] if m is not None else identity for m in matrices], dtype=float)
+        frameSizes = np.array([s[min(i, len(s) - 1)] if s is not None else 0.0 for s in sizes], dtype=float)
+        rows = sim_school.StepSchool(school, params, nFrame, startFrame, frameMatrices, frameSizes, hasProxy, school.sOldBackFin, rootOnly=True)
+        if nFrame == startFrame or rows is not None:
+            block = np.concatenate((school.sLocation.ravel(), school.sRotation.ravel()) + sim_school.SwimAttributes(school, params)).astype(np.float32)
+            values = array('f')
+            values.frombytes(block.tobytes())
+            yield values
+
+
+def CrowdFrames(params, states, trajectories, startFrame, endFrame, backend='AUTO'):
+    """Simulate a crowd, yielding the attribute block (array of float32, see ATTRIBUTES) of every
+    frame from startFrame to endFrame.
+
+    states are randomised FishStates and trajectories their ProxyTrajectory or None.  The first block
+    holds the start positions.
+    """
+    if sim_school.PickBackend(len(states), backend) == 'VECTOR':
+        return VectorFrames(params, states, trajectories, startFrame, endFrame)
+    return ScalarFrames(params, states, trajectories, startFrame, endFrame)
@@ -0,0 +1,883 @@
+# ##### BEGIN GPL LICENSE BLOCK #####
+#
+#  FishSim  -- a script to apply a fish swimming simulation to an armature
+#  by Ian Huish (nerk)
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License
+#  as published by the Free Software Foundation; either version 2
+#  of the License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software Foundation,
+#  Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+# ##### END GPL LICENSE BLOCK #####
+
+# version comment: V4.02.0 - Goldfish Version - Blender 4.20 Extensions
+
+# The swimming simulation itself, separated from Blender.
+# Nothing in this module may import bpy or mathutils - it's driven by plain
+# parameter and state records and returns plain per frame channel values, so
+# it can be profiled, benchmarked and run outside of Blender.
+
+import hashlib
+import math
+import zlib
+from array import array
+
+
+#Simulation parameters - these mirror the 'p' properties on scene.FSimProps
+PARAM_NAMES = (
+    "pMass", "pDrag", "pPower", "pMaxFreq", "pEffortGain", "pEffortIntegral", "pEffortRamp",
+    "pAngularDrag", "pTurnAssist", "pMaxTailAngle", "pMaxSteeringAngle", "pMaxVerticalAngle",
+    "pMaxTailFinAngle", "pTailFinPhase", "pTailFinStiffness", "pTailFinStubRatio",
+    "pMaxSideFinAngle", "pSideFinPhase", "pChestRatio", "pChestRaise", "pLeanIntoTurn", "pRandom",
+    "pPecEffortGain", "pPecTurnAssist", "pMaxPecFreq", "pMaxPecAngle", "pPecPhase",
+    "pPecStubRatio", "pPecStiffness", "pHTransTime", "pSTransTime", "pPecOffset", "pHoverDist",
+    "pHoverTailFrc", "pHoverMaxForce", "pHoverDerate", "pHoverTilt", "pPecDuration", "pPecDuty",
+    "pPecTransition", "pHoverTwitch", "pHoverTwitchTime", "pPecSynch",
+)
+
+#Per frame output channels of one fish.  Angles are in radians, 'sy' is the y scale of a bone
+BODY_TRACKS = (
+    "loc_x", "loc_y", "loc_z", "rot_x", "rot_y", "rot_z",
+    "root_qw", "root_qx", "root_qy", "root_qz",
+    "spine_z", "chest_z", "chest_x", "torso_y",
+    "back_fin1_sy", "back_fin2_sy", "side_fin_l_x", "side_fin_r_x",
+)
+PEC_TRACKS = (
+    "pec_palm_l_qw", "pec_palm_l_qx", "pec_palm_l_qy", "pec_palm_l_qz",
+    "pec_palm_r_qw", "pec_palm_r_qx", "pec_palm_r_qy", "pec_palm_r_qz",
+    "pec_top_l_sy", "pec_bottom_l_sy", "pec_top_r_sy", "pec_bottom_r_sy",
+)
+
+#Velocity and effort are clamped in the same way as the old FSimProps state properties
+MAX_VELOCITY = 5.0
+
+#SplitMix64 constants for the per fish random streams
+MASK64 = 0xFFFFFFFFFFFFFFFF
+GOLDEN_GAMMA = 0x9E3779B97F4A7C15
+
+
+def FishSeed(sceneSeed, name):
+    """64 bit seed of one fish, from the scene seed and the armature name (or its own seed)"""
+    digest = hashlib.sha1("{}:{}".format(sceneSeed, name).encode()).digest()
+    return int.from_bytes(digest[:8], "little")
+
+
+class SimParams:
+    """Plain copy of the simulation parameters"""
+    __slots__ = PARAM_NAMES + ("pStartAngle",)
+
+    def __init__(self, **kwargs):
+        for name in self.__slots__:
+            setattr(self, name, kwargs.get(name, 0.0))
+
+    @classmethod
+    def FromProps(cls, pFS, startAngle=0.0):
+        #Works for scene.FSimProps, a preset namespace or another SimParams
+        params = cls(**{name: getattr(pFS, name) for name in PARAM_NAMES})
+        params.pStartAngle = startAngle
+        return params
+
+
+class FishState:
+    """Integrator state for one fish"""
+    __slots__ = (
+        "sLocation", "sRotation", "sScale", "sVelocity", "sEffort", "sTailAngleOffset",
+        "sState", "sPecState", "sAngularForceV", "sHoverMode", "sRestFrame", "sRestartFrame",
+        "sRestAmount", "sTwitchFrame", "sTwitchAngle", "sTwitchTarget", "sOldRqdEffort",
+        "sOldBackFin", "sRootQuat", "sGoldfish", "rMaxTailAngle", "rMaxFreq", "sRandom",
+    )
+
+    def __init__(self, location, rotation, scale=(1.0, 1.0, 1.0), goldfish=True, seed=0):
+        self.sLocation = list(location)
+        self.sRotation = list(rotation)
+        self.sScale = list(scale)
+        self.sVelocity = [0.0, 0.0, 0.0]
+        self.sEffort = 1.0
+        self.sTailAngleOffset = 0.0
+        self.sState = 0.0
+        self.sPecState = 0.0
+        self.sAngularForceV = 0.0
+        self.sHoverMode = 1.0 if goldfish else 0.0
+        self.sRestFrame = 0.0
+        self.sRestartFrame = 0.0
+        self.sRestAmount = 0.0
+        self.sTwitchFrame = 0.0
+        self.sTwitchAngle = 0.0
+        self.sTwitchTarget = 0.0
+        self.sOldRqdEffort = 0.0
+        self.sOldBackFin = 0.0
+        self.sRootQuat = [1.0, 0.0, 0.0, 0.0]
+        self.sGoldfish = goldfish
+        self.rMaxTailAngle = 0.0
+        self.rMaxFreq = 0.0
+        self.sRandom = seed & MASK64
+
+    def Random(self):
+        #Next number in [0, 1) from the fish's own stream - integer only, so the same on every machine
+        self.sRandom = (self.sRandom + GOLDEN_GAMMA) & MASK64
+        z = self.sRandom
+        z = ((z ^ (z >> 30)) * 0xBF58476D1CE4E5B9) & MASK64
+        z = ((z ^ (z >> 27)) * 0x94D049BB133111EB) & MASK64
+        z ^= z >> 31
+        return (z >> 11) * (1.0 / 9007199254740992.0)
+
+    def Randomise(self, params):
+        #randomise parameters
+        rFact = params.pRandom
+        self.rMaxTailAngle = params.pMaxTailAngle * (1 + (self.Random() * 2.0 - 1.0) * rFact)
+        self.rMaxFreq = params.pMaxFreq * (1 + (self.Random() * 2.0 - 1.0) * rFact)
+
+
+class ProxyTrajectory:
+    """World matrices (row major, 16 floats per frame) and hover sizes of a target proxy"""
+    __slots__ = ("startFrame", "matrices", "sizes")
+
+    def __init__(self, startFrame, matrices=None, sizes=None):
+        self.startFrame = startFrame
+        self.matrices = matrices if matrices is not None else array('f')
+        self.sizes = sizes if sizes is not None else array('f')
+
+    def __len__(self):
+        return len(self.sizes)
+
+    def Append(self, matrix, size):
+        self.matrices.extend(matrix)
+        self.sizes.append(size)
+
+    def Sample(self, nFrame):
+        #Frames outside the sampled range hold the nearest sample
+        i = min(max(nFrame - self.startFrame, 0), len(self.sizes) - 1)
+        return self.matrices[i * 16:i * 16 + 16], self.sizes[i]
+
+
+class FishBake:
+    """Per frame channel values for one fish, one array per track"""
+    __slots__ = ("startFrame", "tracks")
+
+    def __init__(self, startFrame, goldfish=True):
+        self.startFrame = startFrame
+        names = BODY_TRACKS + PEC_TRACKS if goldfish else BODY_TRACKS
+        self.tracks = {name: array('f') for name in names}
+
+    def __len__(self):
+        return len(self.tracks["loc_x"])
+
+    def Append(self, row):
+        for name, values in self.tracks.items():
+            values.append(row[name])
+
+    def Row(self, i):
+        return {name: values[i] for name, values in self.tracks.items()}
+
+
+#FishState slots that hold more than one float
+VECTOR_SLOTS = {"sLocation": 3, "sRotation": 3, "sScale": 3, "sVelocity": 3, "sRootQuat": 4}
+#Bumped whenever the packed state layout or the simulation itself changes, so old checkpoints are ignored
+CHECKPOINT_VERSION = 3
+
+
+def PackState(state, row):
+    """The whole integrator state and the last row of body channels as one flat float array"""
+    values = array('d')
+    for name in FishState.__slots__:
+        if name in VECTOR_SLOTS:
+            values.extend(getattr(state, name))
+        elif name == "sRandom":
+            #Two 32 bit halves, doubles can't hold all 64 bits
+            values.extend((state.sRandom >> 32, state.sRandom & 0xFFFFFFFF))
+        else:
+            values.append(float(getattr(state, name)))
+    values.extend(row[name] for name in BODY_TRACKS)
+    return values
+
+
+def UnpackState(values):
+    """Inverse of PackState - returns (state, row)"""
+    state = FishState.__new__(FishState)
+    i = 0
+    for name in FishState.__slots__:
+        if name in VECTOR_SLOTS:
+            count = VECTOR_SLOTS[name]
+            setattr(state, name, list(values[i:i + count]))
+            i += count
+        elif name == "sRandom":
+            state.sRandom = (int(values[i]) << 32) | int(values[i + 1])
+            i += 2
+        else:
+            setattr(state, name, values[i])
+            i += 1
+    state.sGoldfish = bool(state.sGoldfish)
+    row = dict(zip(BODY_TRACKS, values[i:i + len(BODY_TRACKS)]))
+    return state, row
+
+
+def RunKey(params, startFrame, *extra):
+    """Hash of everything besides the target that a checkpoint depends on"""
+    text = repr((CHECKPOINT_VERSION, startFrame, [getattr(params, name) for name in params.__slots__], extra))
+    return hashlib.sha1(text.encode()).hexdigest()
+
+
+def ResultKey(params, state, trajectory, startFrame, endFrame, *extra):
+    """Content hash of everything that decides a fish's bake - parameters, start state (including
+    its random stream), the target trajectory and the frame range, plus any rig details in extra"""
+    digest = hashlib.sha1(RunKey(params, startFrame, endFrame, extra).encode())
+    digest.update(PackState(state, InitialRow(state)).tobytes())
+    if trajectory is not None:
+        digest.update(trajectory.matrices.tobytes())
+        digest.update(trajectory.sizes.tobytes())
+    return digest.hexdigest()
+
+
+class Checkpoints:
+    """Packed integrator state of one fish every 'every' frames, so a run can be extended or resumed.
+
+    Each checkpoint ends with a CRC of the target trajectory up to its frame, so a checkpoint is
+    only used while the target is unchanged up to that point.
+    """
+    __slots__ = ("every", "trajectory", "frames", "digest", "digestFrame")
+
+    def __init__(self, every, trajectory, frames=None):
+        self.every = every
+        self.trajectory = trajectory
+        self.frames = dict(frames) if frames is not None else {}
+        self.digest = (0, 0)
+        self.digestFrame = trajectory.startFrame - 1 if trajectory is not None else 0
+
+    def Digest(self, nFrame):
+        #CRC of the target samples up to nFrame.  The matrices and sizes each have a running CRC, carried
+        #on from the last frame asked for or started again for an earlier one, so it only depends on nFrame
+        trajectory = self.trajectory
+        if trajectory is None:
+            return 0
+        if nFrame < self.digestFrame:
+            self.digest = (0, 0)
+            self.digestFrame = trajectory.startFrame - 1
+        first = self.digestFrame - trajectory.startFrame + 1
+        last = min(nFrame - trajectory.startFrame + 1, len(trajectory))
+        if last > first:
+            self.digest = (zlib.crc32(trajectory.matrices[first * 16:last * 16].tobytes(), self.digest[0]),
+                           zlib.crc32(trajectory.sizes[first:last].tobytes(), self.digest[1]))
+            self.digestFrame = nFrame
+        return zlib.crc32(self.digest[1].to_bytes(4, "little"), self.digest[0])
+
+    def Save(self, nFrame, state, row):
+        if self.every > 0 and nFrame % self.every == 0:
+            values = PackState(state, row)
+            values.append(self.Digest(nFrame))
+            self.frames[nFrame] = values
+
+    def Valid(self, startFrame, endFrame):
+        """Frames strictly between startFrame and endFrame whose checkpoint still matches the target"""
+        valid = []
+        for nFrame in sorted(self.frames):
+            if nFrame <= startFrame or nFrame >= endFrame:
+                continue
+            if self.frames[nFrame][-1] != self.Digest(nFrame):
+                break
+            valid.append(nFrame)
+        return valid
+
+    def Restore(self, nFrame):
+        """(state, row) saved at nFrame.  Later checkpoints are dropped, they will be saved again"""
+        for later in [f for f in self.frames if f > nFrame]:
+            del self.frames[later]
+        return UnpackState(self.frames[nFrame][:-1])
+
+
+#Small vector, matrix and quaternion helpers.  Matrices are row major 3x3 nested lists,
+#quaternions are (w, x, y, z), eulers are XYZ order as used by Blender objects
+
+def EulerToMatrix(eul):
+    cx, cy, cz = math.cos(eul[0]), math.cos(eul[1]), math.cos(eul[2])
+    sx, sy, sz = math.sin(eul[0]), math.sin(eul[1]), math.sin(eul[2])
+    return [
+        [cy * cz, sy * sx * cz - cx * sz, sy * cx * cz + sx * sz],
+        [cy * sz, sy * sx * sz + cx * cz, sy * cx * sz - sx * cz],
+        [-sy, cy * sx, cy * cx],
+    ]
+
+
+def EulerToQuat(eul):
+    ci, cj, ch = math.cos(eul[0] * 0.5), math.cos(eul[1] * 0.5), math.cos(eul[2] * 0.5)
+    si, sj, sh = math.sin(eul[0] * 0.5), math.sin(eul[1] * 0.5), math.sin(eul[2] * 0.5)
+    cc, cs, sc, ss = ci * ch, ci * sh, si * ch, si * sh
+    return [cj * cc + sj * ss, cj * sc - sj * cs, cj * ss + sj * cc, cj * cs - sj * sc]
+
+
+def AxisAngleQuat(axis, angle):
+    s = math.sin(angle * 0.5)
+    return [math.cos(angle * 0.5), axis[0] * s, axis[1] * s, axis[2] * s]
+
+
+def QuatMul(a, b):
+    return [
+        a[0] * b[0] - a[1] * b[1] - a[2] * b[2] - a[3] * b[3],
+        a[0] * b[1] + a[1] * b[0] + a[2] * b[3] - a[3] * b[2],
+        a[0] * b[2] + a[2] * b[0] + a[3] * b[1] - a[1] * b[3],
+        a[0] * b[3] + a[3] * b[0] + a[1] * b[2] - a[2] * b[1],
+    ]
+
+
+def QuatSlerp(a, b, t):
+    #Same as mathutils Quaternion.slerp - rotate around the shortest angle
+    cosom = a[0] * b[0] + a[1] * b[1] + a[2] * b[2] + a[3] * b[3]
+    if cosom < 0.0:
+        cosom = -cosom
+        a = [-a[0], -a[1], -a[2], -a[3]]
+    if (1.0 - cosom) > 0.0001:
+        omega = math.acos(min(cosom, 1.0))
+        sinom = math.sin(omega)
+        sc1 = math.sin((1.0 - t) * omega) / sinom
+        sc2 = math.sin(t * omega) / sinom
+    else:
+        sc1 = 1.0 - t
+        sc2 = t
+    return [sc1 * a[i] + sc2 * b[i] for i in range(4)]
+
+
+def QuatToMatrix(q):
+    w, x, y, z = q
+    return [
+        [1 - 2 * (y * y + z * z), 2 * (x * y - w * z), 2 * (x * z + w * y)],
+        [2 * (x * y + w * z), 1 - 2 * (x * x + z * z), 2 * (y * z - w * x)],
+        [2 * (x * z - w * y), 2 * (y * z + w * x), 1 - 2 * (x * x + y * y)],
+    ]
+
+
+def MatrixToQuat(m):
+    #Normalise the axes (columns) first to drop any scale, like Matrix.to_quaternion()
+    cols = []
+    for c in range(3):
+        ln = math.sqrt(m[0][c] ** 2 + m[1][c] ** 2 + m[2][c] ** 2) or 1.0
+        cols.append((m[0][c] / ln, m[1][c] / ln, m[2][c] / ln))
+    m00, m10, m20 = cols[0]
+    m01, m11, m21 = cols[1]
+    m02, m12, m22 = cols[2]
+    trace = m00 + m11 + m22
+    if trace > 0.0:
+        s = 2.0 * math.sqrt(1.0 + trace)
+        q = [0.25 * s, (m21 - m12) / s, (m02 - m20) / s, (m10 - m01) / s]
+    elif m00 > m11 and m00 > m22:
+        s = 2.0 * math.sqrt(1.0 + m00 - m11 - m22)
+        q = [(m21 - m12) / s, 0.25 * s, (m01 + m10) / s, (m02 + m20) / s]
+    elif m11 > m22:
+        s = 2.0 * math.sqrt(1.0 + m11 - m00 - m22)
+        q = [(m02 - m20) / s, (m01 + m10) / s, 0.25 * s, (m12 + m21) / s]
+    else:
+        s = 2.0 * math.sqrt(1.0 + m22 - m00 - m11)
+        q = [(m10 - m01) / s, (m02 + m20) / s, (m12 + m21) / s, 0.25 * s]
+    ln = math.sqrt(sum(v * v for v in q))
+    return [v / ln for v in q]
+
+
+def CompatibleEuler(eul, oldrot):
+    #Wrap each axis by 360 degrees to get as close as possible to the old rotation
+    eul = list(eul)
+    for i in range(3):
+        deul = eul[i] - oldrot[i]
+        if deul > math.pi:
+            eul[i] -= math.floor((deul / (2.0 * math.pi)) + 0.5) * 2.0 * math.pi
+        elif deul < -math.pi:
+            eul[i] += math.floor((-deul / (2.0 * math.pi)) + 0.5) * 2.0 * math.pi
+    return eul
+
+
+def QuatToEulerCompat(q, oldrot):
+    #Same as mathutils Quaternion.to_euler('XYZ', compatible) - pick the closest of both solutions
+    m = QuatToMatrix(q)
+    cy = math.hypot(m[0][0], m[1][0])
+    if cy > 16.0 * 1.1920929e-07:
+        eul1 = [math.atan2(m[2][1], m[2][2]), math.atan2(-m[2][0], cy), math.atan2(m[1][0], m[0][0])]
+        eul2 = [math.atan2(-m[2][1], -m[2][2]), math.atan2(-m[2][0], -cy), math.atan2(-m[1][0], -m[0][0])]
+    else:
+        eul1 = [math.atan2(-m[1][2], m[1][1]), math.atan2(-m[2][0], cy), 0.0]
+        eul2 = list(eul1)
+    eul1 = CompatibleEuler(eul1, oldrot)
+    eul2 = CompatibleEuler(eul2, oldrot)
+    d1 = sum(math.fabs(eul1[i] - oldrot[i]) for i in range(3))
+    d2 = sum(math.fabs(eul2[i] - oldrot[i]) for i in range(3))
+    return eul1 if d1 <= d2 else eul2
+
+
+def MatVec(m, v):
+    return [m[r][0] * v[0] + m[r][1] * v[1] + m[r][2] * v[2] for r in range(3)]
+
+
+def MatTVec(m, v):
+    return [m[0][c] * v[0] + m[1][c] * v[1] + m[2][c] * v[2] for c in range(3)]
+
+
+def AngleSigned2D(v1, v2, fallback):
+    #Same as mathutils Vector.angle_signed for 2D vectors
+    if (v1[0] == 0.0 and v1[1] == 0.0) or (v2[0] == 0.0 and v2[1] == 0.0):
+        return fallback
+    return math.atan2(v1[1] * v2[0] - v1[0] * v2[1], v1[0] * v2[0] + v1[1] * v2[1])
+
+
+def ClampVelocity(v):
+    return min(MAX_VELOCITY, max(-MAX_VELOCITY, v))
+
+
+def RigToWorld(state, v):
+    #Equivalent of 'v @ TargetRig.matrix_world.inverted()' - local direction to world
+    rot = EulerToMatrix(state.sRotation)
+    return MatVec(rot, [v[i] / state.sScale[i] for i in range(3)])
+
+
+def WorldToRig(state, v):
+    #Equivalent of 'v @ TargetRig.matrix_world' - world direction to (scaled) local
+    rot = EulerToMatrix(state.sRotation)
+    local = MatTVec(rot, v)
+    return [local[i] * state.sScale[i] for i in range(3)]
+
+
+def ProxyQuat(matrix):
+    return MatrixToQuat([matrix[0:3], matrix[4:7], matrix[8:11]])
+
+
+#The simulation
+
+def Target(state, params, proxy):
+    """Set Effort and Direction to try and reach the target"""
+    RigDirn = RigToWorld(state, (0.0, -1.0, 0.0))
+
+    #distance to target
+    if proxy is not None:
+        matrix, size = proxy
+        TargetDirn = [matrix[3] - state.sLocation[0], matrix[7] - state.sLocation[1], matrix[11] - state.sLocation[2]]
+    else:
+        TargetDirn = [0.0, -10.0, 0.0]
+    DifDot = sum(TargetDirn[i] * RigDirn[i] for i in range(3))
+
+    #horizontal angle to target - limit max turning effort at 90 deg
+    AngleToTarget = math.degrees(AngleSigned2D(RigDirn[:2], TargetDirn[:2], math.pi))
+    DirectionEffort = max(-1.0, min(1.0, AngleToTarget / 90.0))
+
+    #vertical angle to target - limit max turning effort at 20 deg
+    RigDirn2DV = ((RigDirn[1] ** 2 + RigDirn[0] ** 2) ** 0.5, RigDirn[2])
+    TargetDirn2DV = ((TargetDirn[1] ** 2 + TargetDirn[0] ** 2) ** 0.5, TargetDirn[2])
+    AngleToTargetV = math.degrees(AngleSigned2D(RigDirn2DV, TargetDirn2DV, math.pi))
+    DirectionEffortV = max(-1.0, min(1.0, AngleToTargetV / 20.0))
+
+    #Hover Mode Detection (Close to target and slow)
+    TargetDist = math.sqrt(sum(v * v for v in TargetDirn))
+    if not state.sGoldfish:
+        state.sHoverMode = 0.0
+    elif proxy is not None and TargetDist < (size * params.pHoverDist):
+        state.sHoverMode = min(1.0, state.sHoverMode + params.pSTransTime / 25.0)
+    else:
+        state.sHoverMode = max(0.0, state.sHoverMode - params.pHTransTime / 25.0)
+
+    #Return normalised required effort, turning factor, and ascending factor
+    return DifDot, DirectionEffort, DirectionEffortV
+
+
+def ObjectMovment(state, params, ForwardForce, AngularForce, AngularForceV):
+    """Handle the object movement for swimming"""
+    vel = state.sVelocity
+    vel[0] = ClampVelocity(vel[0] - (params.pDrag * vel[0] * math.fabs(vel[0])) / params.pMass)
+    vel[1] = ClampVelocity(vel[1] + (-ForwardForce + -params.pDrag * vel[1] * math.fabs(vel[1])) / params.pMass)
+    vel[2] = ClampVelocity(vel[2] - (params.pDrag * vel[2] * math.fabs(vel[2])) / params.pMass)
+    move = RigToWorld(state, vel)
+    for i in range(3):
+        state.sLocation[i] += move[i]
+
+    #Let's be simplistic - just rotate object based on angluar force
+    state.sRotation[2] += math.radians(AngularForce)
+    state.sRotation[0] += math.radians(AngularForceV)
+
+    #No forward/backward tilt while swimming
+    state.sRootQuat = [1.0, 0.0, 0.0, 0.0]
+
+
+def ObjectMovmentHover(state, params, proxy):
+    """Handle the object movement for hovering"""
+    matrix, size = proxy
+    offset = [matrix[3] - state.sLocation[0], matrix[7] - state.sLocation[1], matrix[11] - state.sLocation[2]]
+    RigForce = [state.sHoverMode * params.pPecEffortGain * v for v in WorldToRig(state, offset)]
+
+    #Limit the force available
+    xHoverMaxForce = params.pHoverMaxForce * (1 - state.sRestAmount * 0.6)
+    RigForce[1] = min(max(RigForce[1], -xHoverMaxForce), xHoverMaxForce * params.pHoverDerate)
+    RigForce[2] = min(max(RigForce[2], -xHoverMaxForce * params.pHoverDerate), xHoverMaxForce * params.pHoverDerate)
+    RigForce[0] = min(max(RigForce[0], -xHoverMaxForce * params.pHoverDerate), xHoverMaxForce * params.pHoverDerate)
+
+    #Calculate velocity - movement uses the orientation from the start of the frame
+    vel = state.sVelocity
+    for i in range(3):
+        vel[i] = ClampVelocity(vel[i] + (RigForce[i] - params.pDrag * vel[i] * math.fabs(vel[i])) / params.pMass)
+    move = RigToWorld(state, vel)
+    for i in range(3):
+        state.sLocation[i] += move[i]
+
+    #Rotate model direction to match target
+    xTargetQuat = QuatMul(ProxyQuat(matrix), AxisAngleQuat((0.0, 0.0, 1.0), math.radians(params.pStartAngle)))
+    xRigQuat = EulerToQuat(state.sRotation)
+    xRigQuat = QuatSlerp(xRigQuat, xTargetQuat, params.pPecTurnAssist / 100.0)
+    state.sRotation = QuatToEulerCompat(xRigQuat, state.sRotation)
+
+    #Forward/Backward Tilt based on force
+    if RigForce[1] < 0:
+        rf = RigForce[1] * params.pHoverDerate
+    else:
+        rf = RigForce[1]
+    TiltAngle = math.radians(params.pHoverTilt * rf / (params.pHoverMaxForce * params.pHoverDerate))
+    state.sRootQuat = QuatSlerp(state.sRootQuat, AxisAngleQuat((1.0, 0.0, 0.0), TiltAngle), 0.03)
+
+
+def PecSimulation(state, params, nFrame, row):
+    """Pectoral fin oscillation, rest periods and hover blending"""
+    #Update State and main angle
+    state.sPecState = state.sPecState + 360.0 / params.pMaxPecFreq
+    xPecAngle = math.sin(math.radians(state.sPecState)) * math.radians(params.pMaxPecAngle)
+    yPecAngle = math.sin(math.radians(state.sPecState + 90.0)) * math.radians(params.pMaxPecAngle * 2)
+
+    #Rest Period Calculations
+    if nFrame >= state.sRestartFrame:
+        state.sRestAmount = max(0.0, state.sRestAmount - params.pPecTransition)
+        if state.sRestAmount < 0.1:
+            state.sRestFrame = nFrame + params.pPecDuration
+            state.sRestartFrame = state.sRestFrame + params.pPecDuty * params.pPecDuration
+
+    if (nFrame >= state.sRestFrame and nFrame < state.sRestartFrame and state.sRestAmount < 1.0):
+        state.sRestAmount = min(1.0, state.sRestAmount + params.pPecTransition)
+
+    #Add the same side fin wobble to the pec fins to stop them looking boring when not flapping
+    SideFinRot = math.radians(math.sin(math.radians(state.sState + params.pSideFinPhase)) * params.pMaxSideFinAngle)
+    SideQuat = AxisAngleQuat((1.0, 0.0, 0.0), SideFinRot)
+    RestQuat = AxisAngleQuat((1.0, 0.0, 0.0), math.radians(params.pPecOffset))
+
+    #Slerp between oscillating angle and rest angle depending on hover status and reset periods
+    # xRestAmount = 1 means no flapping due to either resting or not hovering
+    xRestAmount = (1.0 - (1.0 - state.sRestAmount) * state.sHoverMode)
+    xAng = QuatMul(AxisAngleQuat((0.0, 1.0, 0.0), yPecAngle), AxisAngleQuat((1.0, 0.0, 0.0), -xPecAngle))
+    PalmL = QuatMul(QuatSlerp(xAng, RestQuat, xRestAmount), SideQuat)
+
+    #Tip deflection based on phase offset
+    xMaxPecScale = params.pMaxPecAngle * (1.0 / params.pPecStiffness) * 0.2 / 30.0
+    Pec_scale = 1.0 + math.sin(math.radians(state.sPecState - params.pPecPhase)) * xMaxPecScale * (1.0 - xRestAmount)
+
+    #If fins are opposing
+    if not params.pPecSynch:
+        xAng = QuatMul(AxisAngleQuat((0.0, 1.0, 0.0), yPecAngle), AxisAngleQuat((1.0, 0.0, 0.0), xPecAngle))
+        Pec_scaleR = 1 / Pec_scale
+    else:
+        xAng = QuatMul(AxisAngleQuat((0.0, 1.0, 0.0), -yPecAngle), AxisAngleQuat((1.0, 0.0, 0.0), -xPecAngle))
+        Pec_scaleR = Pec_scale
+    PalmR = QuatMul(QuatSlerp(xAng, RestQuat, xRestAmount), SideQuat)
+
+    row["pec_palm_l_qw"], row["pec_palm_l_qx"], row["pec_palm_l_qy"], row["pec_palm_l_qz"] = PalmL
+    row["pec_palm_r_qw"], row["pec_palm_r_qx"], row["pec_palm_r_qy"], row["pec_palm_r_qz"] = PalmR
+    row["pec_top_l_sy"] = Pec_scale
+    row["pec_bottom_l_sy"] = 1 - (1 - Pec_scale) * params.pPecStubRatio
+    row["pec_top_r_sy"] = Pec_scaleR
+    row["pec_bottom_r_sy"] = 1 - (1 - Pec_scaleR) * params.pPecStubRatio
+
+
+def InitialRow(state):
+    """Channel values keyed on the start frame - the rig where it is, and the bones at rest"""
+    row = dict.fromkeys(BODY_TRACKS + PEC_TRACKS, 0.0)
+    row["loc_x"], row["loc_y"], row["loc_z"] = state.sLocation
+    row["rot_x"], row["rot_y"], row["rot_z"] = state.sRotation
+    row["root_qw"], row["root_qx"], row["root_qy"], row["root_qz"] = state.sRootQuat
+    for name in ("back_fin1_sy", "back_fin2_sy", "pec_top_l_sy", "pec_bottom_l_sy", "pec_top_r_sy", "pec_bottom_r_sy"):
+        row[name] = 1.0
+    row["pec_palm_l_qw"] = row["pec_palm_r_qw"] = 1.0
+    return row
+
+
+#Bones that can swing the middle of the tail fin, innermost first, with the local axis each one turns on
+TAIL_JOINTS = ("chest", "spine", "torso", "root")
+TAIL_AXES = {"chest": 2, "spine": 2, "torso": 1}
+
+
+class TailGeometry:
+    """Rest pose geometry of the tail fin and the bones that move it, in armature space.
+
+    pivots holds the rest head of each joint, bases its rest orientation (3x3 row major), and
+    gains how much of each joint's rotation reaches the fin - 1.0 for a plain parent chain,
+    less where the rig spreads a control's rotation along the spine.
+    """
+    __slots__ = ("point", "pivots", "bases", "gains")
+
+    def __init__(self, point, pivots, bases, gains=None):
+        self.point = list(point)
+        self.pivots = {joint: list(pivots[joint]) for joint in TAIL_JOINTS}
+        self.bases = {joint: [list(r) for r in bases[joint]] for joint in TAIL_JOINTS}
+        self.gains = dict(gains) if gains is not None else dict.fromkeys(TAIL_JOINTS, 1.0)
+
+
+def JointQuat(joint, row, gain=1.0):
+    #Local rotation of a tail joint as set from a row of channel values
+    if joint == "spine":
+        return AxisAngleQuat((0.0, 0.0, 1.0), row["spine_z"] * gain)
+    if joint == "chest":
+        return QuatMul(AxisAngleQuat((0.0, 0.0, 1.0), row["chest_z"] * gain), AxisAngleQuat((1.0, 0.0, 0.0), row["chest_x"] * gain))
+    if joint == "torso":
+        return AxisAngleQuat((0.0, 1.0, 0.0), row["torso_y"] * gain)
+    return [row["root_qw"], row["root_qx"], row["root_qy"], row["root_qz"]]
+
+
+def TailFinPosition(tail, row):
+    """Armature space position of the middle of the tail fin for a row of channel values"""
+    p = tail.point
+    for joint in TAIL_JOINTS:
+        pivot = tail.pivots[joint]
+        basis = tail.bases[joint]
+        local = MatTVec(basis, [p[i] - pivot[i] for i in range(3)])
+        moved = MatVec(basis, MatVec(QuatToMatrix(JointQuat(joint, row, tail.gains[joint])), local))
+        p = [pivot[i] + moved[i] for i in range(3)]
+    return p
+
+
+def TailFinX(tail, row):
+    return TailFinPosition(tail, row)[0]
+
+
+def CalibrateGain(tail, joint, probe, measured):
+    """Gain of one joint, given the fin x measured with only that joint rotated by probe radians"""
+    #Rotating the rest point about the joint axis moves x as a*cos(phi) + b*sin(phi) + c
+    basis = tail.bases[joint]
+    k = [basis[r][TAIL_AXES[joint]] for r in range(3)]
+    v = [tail.point[i] - tail.pivots[joint][i] for i in range(3)]
+    kv = k[0] * v[0] + k[1] * v[1] + k[2] * v[2]
+    a = v[0] - k[0] * kv
+    b = k[1] * v[2] - k[2] * v[1]
+    c = k[0] * kv
+    radius = math.hypot(a, b)
+    if radius < 1e-6 or probe == 0.0:
+        return 0.0
+    ratio = max(-1.0, min(1.0, (measured - tail.pivots[joint][0] - c) / radius))
+    base = math.atan2(b, a)
+    spread = math.acos(ratio)
+    #Of the two angles that give this x, take the smaller one turning the same way as the probe
+    phis = [base + spread, base - spread]
+    phis = [math.atan2(math.sin(phi), math.cos(phi)) for phi in phis]
+    phis.sort(key=lambda phi: (phi * probe < 0.0, math.fabs(phi)))
+    return phis[0] / probe
+
+
+def SwimRow(row, params, sState, xTailAngle, ampFraction, sTailAngleOffset, sHoverMode):
+    """Spine, chest, tail fin and side fin channels for a tail phase (sState, degrees), tail angle
+    (radians), fraction of the fish's full tail amplitude, tail offset (degrees) and hover mode"""
+    row["spine_z"] = xTailAngle
+    row["chest_z"] = -xTailAngle * params.pChestRatio
+    row["chest_x"] = -math.fabs(math.radians(sTailAngleOffset)) * params.pChestRaise * (1.0 - sHoverMode)
+    row["torso_y"] = -math.radians(sTailAngleOffset) * params.pLeanIntoTurn * (1.0 - sHoverMode)
+
+    #Tailfin bending based on phase offset
+    pMaxTailScale = params.pMaxTailFinAngle * (1.0 / params.pTailFinStiffness) * 0.2 / 30.0
+    Back_fin1_scale = 1.0 + math.sin(math.radians(sState + params.pTailFinPhase)) * pMaxTailScale * ampFraction
+    row["back_fin1_sy"] = Back_fin1_scale
+    row["back_fin2_sy"] = 1 - (1 - Back_fin1_scale) * params.pTailFinStubRatio
+
+    SideFinRot = math.sin(math.radians(sState + params.pSideFinPhase)) * params.pMaxSideFinAngle
+    row["side_fin_l_x"] = math.radians(-SideFinRot)
+    row["side_fin_r_x"] = math.radians(SideFinRot)
+
+
+def StepFish(state, params, nFrame, startFrame, proxy, back_fin_x=0.0, rootOnly=False):
+    """Advance one fish by one frame.
+
+    proxy is a (world matrix, hover size) pair for the target at nFrame, or None.
+    back_fin_x is the lateral position of the middle of the tail fin from the previous frame.
+    With rootOnly, only steering and locomotion are worked out - no pec fins, and only the root
+    motion tracks in the row.
+    Returns the channel values for nFrame, or None on the start frame, which only primes the state.
+    """
+    #Get the effort and direction change to head toward the target
+    RqdEffort, RqdDirection, RqdDirectionV = Target(state, params, proxy)
+    if nFrame == startFrame:
+        state.sOldRqdEffort = RqdEffort
+        state.sOldBackFin = back_fin_x
+        return None
+    state.sOldRqdEffort = RqdEffort
+    state.sEffort = params.pEffortGain * RqdEffort * params.pEffortRamp + state.sEffort * (1.0 - params.pEffortRamp)
+    state.sEffort = max(0.0, min(state.sEffort, 1.0))
+
+    row = {}
+
+    #Pec fin simulation
+    if state.sGoldfish and not rootOnly:
+        PecSimulation(state, params, nFrame, row)
+
+    #Convert effort into tail frequency and amplitude (Fades to a low value if in hover mode)
+    xFreq = state.rMaxFreq * ((1 - state.sHoverMode) * (1.0 / (state.sEffort + 0.01)) + state.sHoverMode * 2.0)
+    xTailAmp = state.rMaxTailAngle * ((1 - state.sHoverMode) * state.sEffort + state.sHoverMode * params.pHoverTailFrc)
+
+    #Convert direction into Tail Offset angle (hover turning is currently disabled)
+    xSwimTailAngleOffset = RqdDirection * params.pMaxSteeringAngle
+    xHoverTailAngleOffset = 0.0
+    state.sTailAngleOffset = (state.sTailAngleOffset * (1 - params.pEffortRamp)
+                              + params.pEffortRamp * max(0, (1.0 - state.sHoverMode * 2.0)) * xSwimTailAngleOffset
+                              + params.pEffortRamp * state.sHoverMode * xHoverTailAngleOffset)
+
+    #Hover 'Twitch' calculations (Make the fish do some random twisting during hover mode)
+    if state.sHoverMode < 0.5:
+        #Not hovering so reset
+        state.sTwitchTarget = 0.0
+        state.sTwitchFrame = 0.0
+    elif nFrame >= state.sTwitchFrame:
+        #set new twitch frame
+        state.sTwitchFrame = nFrame + params.pHoverTwitchTime * (state.Random() - 0.5)
+        #Only twitch while not resting
+        if state.sTwitchFrame < state.sRestartFrame and state.sTwitchFrame > state.sRestFrame:
+            state.sTwitchFrame = state.sRestartFrame + 5
+        #set a new twitch target angle
+        state.sTwitchTarget = params.pHoverTwitch * 2.0 * (state.Random() - 0.5)
+    state.sTwitchAngle = state.sTwitchAngle * 0.9 + 0.1 * state.sTwitchTarget
+
+    #Spine Movement
+    state.sState = state.sState + 360.0 / xFreq
+    xTailAngle = math.sin(math.radians(state.sState)) * math.radians(xTailAmp) + math.radians(state.sTailAngleOffset) + math.radians(state.sTwitchAngle)
+
+    #Tail Movment - the fin position lags a frame behind the pose set here
+    back_fin_dif = back_fin_x - state.sOldBackFin
+    state.sOldBackFin = back_fin_x
+
+    if not rootOnly:
+        SwimRow(row, params, state.sState, xTailAngle, xTailAmp / state.rMaxTailAngle, state.sTailAngleOffset, state.sHoverMode)
+
+    #Do Object movment with Forward force and Angular force
+    ForwardForce = math.fabs(math.cos(math.radians(state.sState))) * math.radians(xTailAmp) * 15.0 * params.pPower / params.pMaxFreq
+
+    #Angular force due to 'swish'
+    AngularForce = back_fin_dif / params.pAngularDrag
+
+    #Angular force due to rudder effect
+    AngularForce += xTailAngle * state.sVelocity[1] / params.pAngularDrag
+
+    #Fake Angular force to make turning more effective
+    AngularForce += -(state.sTailAngleOffset / params.pMaxSteeringAngle) * params.pTurnAssist
+
+    #Angular force for vertical movement
+    state.sAngularForceV = state.sAngularForceV * (1 - params.pEffortRamp) + RqdDirectionV * params.pMaxVerticalAngle
+
+    if state.sHoverMode < 0.1 or proxy is None:
+        ObjectMovment(state, params, ForwardForce, AngularForce, state.sAngularForceV)
+    else:
+        ObjectMovmentHover(state, params, proxy)
+
+    row["loc_x"], row["loc_y"], row["loc_z"] = state.sLocation
+    row["rot_x"], row["rot_y"], row["rot_z"] = state.sRotation
+    row["root_qw"], row["root_qx"], row["root_qy"], row["root_qz"] = state.sRootQuat
+    return row
+
+
+def StepRoot(state, params, nFrame, startFrame, proxy):
+    """StepFish with rootOnly and without the tail 'swish', for a fish only its root motion is kept of.
+    The other tracks of the row are left at rest, as in InitialRow"""
+    row = StepFish(state, params, nFrame, startFrame, proxy, state.sOldBackFin, rootOnly=True)
+    if row is None:
+        return None
+    full = InitialRow(state)
+    full.update(row)
+    return full
+
+
+def SwimAttributes(state, params):
+    """Speed, tail phase (radians from 0 to 2pi), tail amplitude and tail turn offset (radians) and
+    hover mode of a fish, after a step"""
+    speed = math.sqrt(sum(v * v for v in state.sVelocity))
+    phase = math.radians(state.sState % 360.0)
+    amplitude = math.radians(state.rMaxTailAngle * ((1 - state.sHoverMode) * state.sEffort + state.sHoverMode * params.pHoverTailFrc))
+    return speed, phase, amplitude, math.radians(state.sTailAngleOffset), state.sHoverMode
+
+
+def SimulateFish(params, state, trajectory, startFrame, endFrame, tail=None, bake=None, row=None, firstFrame=None, checkpoints=None,
+                 rootOnly=False):
+    """Step one fish from startFrame to endFrame and return its FishBake.
+
+    trajectory is a ProxyTrajectory (or None for a fish without a target).
+    tail is the TailGeometry of the rig, or None to leave out the tail 'swish'.
+    To carry on from a checkpoint, pass the restored state and row, an empty bake starting after
+    the checkpoint, and that same frame as firstFrame.
+    With rootOnly the fish is stepped with StepRoot, and no checkpoints are saved since a full
+    simulation can't carry on from them.
+    """
+    if firstFrame is None:
+        firstFrame = startFrame
+    if bake is None:
+        bake = FishBake(startFrame, state.sGoldfish)
+        row = InitialRow(state)
+        bake.Append(row)
+    for nFrame in range(firstFrame, endFrame + 1):
+        proxy = trajectory.Sample(nFrame) if trajectory is not None else None
+        if rootOnly:
+            newRow = StepRoot(state, params, nFrame, startFrame, proxy)
+        else:
+            back_fin_x = TailFinX(tail, row) if tail is not None else state.sOldBackFin
+            newRow = StepFish(state, params, nFrame, startFrame, proxy, back_fin_x)
+        if newRow is not None:
+            row = newRow
+            bake.Append(row)
+            if checkpoints is not None and not rootOnly:
+                checkpoints.Save(nFrame, state, row)
+    return bake
+
+
+#Bone tracks a follower copies from its leader.  Angles are scaled by the follower's amplitude,
+#scales ('sy') have their stretch from 1 scaled, and the pec palm quaternions are copied as they are
+FOLLOW_ANGLES = ("spine_z", "chest_z", "chest_x", "torso_y", "side_fin_l_x", "side_fin_r_x")
+FOLLOW_SCALES = ("back_fin1_sy", "back_fin2_sy", "pec_top_l_sy", "pec_bottom_l_sy", "pec_top_r_sy", "pec_bottom_r_sy")
+#Fraction of the remaining heading error a follower turns through each frame
+FOLLOW_TURN = 0.1
+
+
+def FollowLeader(state, leader, trajectory, startFrame, endFrame, maxOffset, jitter):
+    """Derived bake of a follower - the bone channels of the leader's bake, up to maxOffset frames
+    behind and with up to +-jitter of amplitude variation from the follower's own random stream,
+    and root motion heading for its own target at the leader's speed."""
+    offset = int(state.Random() * (maxOffset + 1))
+    amplitude = 1.0 + jitter * (state.Random() * 2.0 - 1.0)
+    bake = FishBake(startFrame, state.sGoldfish)
+    bake.Append(InitialRow(state))
+    lead = leader.tracks
+    #A goldfish following a shark keeps its pec fins at rest
+    rest = InitialRow(state)
+    names = [name for name in bake.tracks if name in lead and name not in FOLLOW_ANGLES + FOLLOW_SCALES]
+    angles = [name for name in FOLLOW_ANGLES if name in lead]
+    scales = [name for name in FOLLOW_SCALES if name in lead and name in bake.tracks]
+    for nFrame in range(startFrame + 1, endFrame + 1):
+        j = min(max(nFrame - startFrame - offset, 0), len(leader) - 1)
+        row = dict(rest)
+        for name in names:
+            row[name] = lead[name][j]
+        for name in angles:
+            row[name] = lead[name][j] * amplitude
+        for name in scales:
+            row[name] = 1.0 + (lead[name][j] - 1.0) * amplitude
+
+        #Turn toward the target, then move forward (-Y) as far as the leader did, without overshooting
+        if j > 0:
+            speed = math.sqrt(sum((lead[name][j] - lead[name][j - 1]) ** 2 for name in ("loc_x", "loc_y", "loc_z")))
+        else:
+            speed = 0.0
+        if trajectory is not None:
+            matrix, size = trajectory.Sample(nFrame)
+            dirn = [matrix[3] - state.sLocation[0], matrix[7] - state.sLocation[1], matrix[11] - state.sLocation[2]]
+            dist = math.sqrt(sum(v * v for v in dirn))
+            if dist > 1e-6:
+                heading = math.atan2(dirn[0], -dirn[1])
+                pitch = -math.atan2(dirn[2], math.hypot(dirn[0], dirn[1]))
+                turn = math.remainder(heading - state.sRotation[2], 2.0 * math.pi)
+                state.sRotation[2] += turn * FOLLOW_TURN
+                state.sRotation[0] += (pitch - state.sRotation[0]) * FOLLOW_TURN
+            speed = min(speed, dist)
+        move = MatVec(EulerToMatrix(state.sRotation), (0.0, -speed, 0.0))
+        for i in range(3):
+            state.sLocation[i] += move[i]
+
+        row["loc_x"], row["loc_y"], row["loc_z"] = state.sLocation
+        row["rot_x"], row["rot_y"], row["rot_z"] = state.sRotation
+        bake.Append(row)
+    return bake
@@ -0,0 +1,110 @@
+# ##### BEGIN GPL LICENSE BLOCK #####
+#
+#  FishSim  -- a script to apply a fish swimming simulation to an armature
+#  by Ian Huish (nerk)
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License
+#  as published by the Free Software Foundation; either version 2
+#  of the License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software Foundation,
+#  Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+# ##### END GPL LICENSE BLOCK #####
+
+
+# version comment: V4.02.0 - Goldfish Version - Blender 4.20 Extensions
+
+# Camera level of detail.
+# Each fish gets a tier from where its target takes it relative to the
+# scene camera over the shot: the closest it comes while inside the camera
+# frustum.  Near fish are keyed in full, further ones only on the body bones
+# and on sparser frames, and fish that stay far away or never come into
+# view keep only their root motion.  Those are also simulated without their
+# bones: no pec fins, fin bending or tail 'swish', so they steer a little
+# differently from a full simulation, and moving the camera so a fish
+# changes to or from that tier changes where it swims.
+
+import math
+
+LOD_FULL = 0
+LOD_REDUCED = 1
+LOD_ROOT = 2
+TIER_NAMES = ("full", "reduced", "root motion")
+
+#Bone roles keyed in each tier, None for all of them.  Reduced drops the pec fins and fin bending
+TIER_ROLES = (None, ("root", "spine", "chest", "torso"), ())
+
+#Frames between the positions tested against the camera
+SAMPLE_EVERY = 5
+
+
+class CameraFrame:
+    """Half the width and height of the camera frame - at unit distance in front of a perspective
+    camera, or the whole frame of an orthographic one"""
+    __slots__ = ("halfX", "halfY", "ortho")
+
+    def __init__(self, halfX, halfY, ortho=False):
+        self.halfX = halfX
+        self.halfY = halfY
+        self.ortho = ortho
+
+
+def ToCamera(matrix, point):
+    #World point into camera space from a row major world matrix.  The camera looks down -Z
+    offset = [point[0] - matrix[3], point[1] - matrix[7], point[2] - matrix[11]]
+    local = []
+    for col in range(3):
+        axis = (matrix[col], matrix[4 + col], matrix[8 + col])
+        length = math.sqrt(sum(v * v for v in axis)) or 1.0
+        local.append(sum(axis[i] * offset[i] for i in range(3)) / length)
+    return local
+
+
+def Visible(frame, local, radius):
+    """True if a sphere of radius around a camera space point is at least partly in the frame"""
+    if frame.ortho:
+        return math.fabs(local[0]) <= frame.halfX + radius and math.fabs(local[1]) <= frame.halfY + radius
+    depth = -local[2]
+    if depth <= -radius:
+        return False
+    #Slack for the sphere against the slanted sides of the frustum
+    return (math.fabs(local[0]) <= depth * frame.halfX + radius * math.sqrt(1.0 + frame.halfX * frame.halfX)
+            and math.fabs(local[1]) <= depth * frame.halfY + radius * math.sqrt(1.0 + frame.halfY * frame.halfY))
+
+
+def Positions(trajectory, location, startFrame, endFrame):
+    """(frame, position) pairs a fish is tested at - its start location, then its target every SAMPLE_EVERY frames"""
+    points = [(startFrame, location)]
+    if trajectory is not None:
+        for nFrame in list(range(startFrame, endFrame + 1, SAMPLE_EVERY)) + [endFrame]:
+            matrix, size = trajectory.Sample(nFrame)
+            points.append((nFrame, (matrix[3], matrix[7], matrix[11])))
+    return points
+
+
+def ChooseTier(camera, frame, points, radius, near, far):
+    """Tier of a fish from the closest it comes to the camera while in view.
+
+    camera is the ProxyTrajectory of the camera, points the (frame, position) pairs of the fish.
+    An orthographic camera shows everything in view at the same size, so those fish are full.
+    """
+    closest = None
+    for nFrame, point in points:
+        matrix, size = camera.Sample(nFrame)
+        local = ToCamera(matrix, point)
+        if Visible(frame, local, radius):
+            distance = 0.0 if frame.ortho else math.sqrt(sum(v * v for v in local))
+            closest = distance if closest is None else min(closest, distance)
+    if closest is None or closest > far:
+        return LOD_ROOT
+    if closest > near:
+        return LOD_REDUCED
+    return LOD_FULL
@@ -0,0 +1,123 @@
+# ##### BEGIN GPL LICENSE BLOCK #####
+#
+#  FishSim  -- a script to apply a fish swimming simulation to an armature
+#  by Ian Huish (nerk)
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License
+#  as published by the Free Software Foundation; either version 2
+#  of the License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software Foundation,
+#  Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+# ##### END GPL LICENSE BLOCK #####
+
+# version comment: V4.02.0 - Goldfish Version - Blender 4.20 Extensions
+
+# Process pool for simulating the armatures of a school in parallel.
+# Each fish is packed into a job of plain values (parameters, state,
+# target trajectory, tail geometry), stepped with sim_kernel in a worker
+# process, and comes back as its final state and channel arrays.  Blender
+# itself only writes the curves.
+# The add-on package can't be imported without bpy, so the workers run a
+# top level copy of this module from the add-on folder.
+
+import contextlib
+import importlib
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import multiprocessing
+
+try:
+    from . import sim_kernel
+except ImportError:
+    import sim_kernel
+
+#Errors that mean the pool can't be used, so the armatures are simulated in Blender instead
+POOL_ERRORS = (OSError, ImportError, BrokenProcessPool)
+
+
+def PackJob(params, state, trajectory, startFrame, endFrame, tail, bake, row, firstFrame, every, rootOnly=False):
+    """Everything a worker needs to simulate one fish, as plain picklable values"""
+    job = {
+        "params": {name: getattr(params, name) for name in params.__slots__},
+        "state": {name: getattr(state, name) for name in state.__slots__},
+        "trajectory": None,
+        "tail": None,
+        "startFrame": startFrame,
+        "endFrame": endFrame,
+        "bakeStart": bake.startFrame,
+        "bakeRows": [bake.Row(i) for i in range(len(bake))],
+        "row": row,
+        "firstFrame": firstFrame,
+        "every": every,
+        "rootOnly": rootOnly,
+    }
+    if trajectory is not None:
+        job["trajectory"] = (trajectory.startFrame, trajectory.matrices, trajectory.sizes)
+    if tail is not None:
+        job["tail"] = (tail.point, tail.pivots, tail.bases, tail.gains)
+    return job
+
+
+def StateFromValues(values):
+    #A FishState from the {slot: value} dict of PackJob and SimulateJob
+    state = sim_kernel.FishState(values["sLocation"], values["sRotation"])
+    for name, value in values.items():
+        setattr(state, name, value)
+    return state
+
+
+def SimulateJob(job):
+    """Worker entry point - returns the final state values, track arrays and checkpoints of one fish"""
+    params = sim_kernel.SimParams(**job["params"])
+    state = StateFromValues(job["state"])
+    trajectory = sim_kernel.ProxyTrajectory(*job["trajectory"]) if job["trajectory"] is not None else None
+    tail = sim_kernel.TailGeometry(*job["tail"]) if job["tail"] is not None else None
+    bake = sim_kernel.FishBake(job["bakeStart"], state.sGoldfish)
+    for row in job["bakeRows"]:
+        bake.Append(row)
+    checkpoints = sim_kernel.Checkpoints(job["every"], trajectory)
+    sim_kernel.SimulateFish(params, state, trajectory, job["startFrame"], job["endFrame"], tail,
+                            bake=bake, row=job["row"], firstFrame=job["firstFrame"], checkpoints=checkpoints,
+                            rootOnly=job["rootOnly"])
+    return {name: getattr(state, name) for name in state.__slots__}, bake.tracks, checkpoints.frames
+
+
+@contextlib.contextmanager
+def WorkerModule():
+    #This file imported again as a top level module, which the worker processes can import too.  The
+    #add-on folder is only on sys.path, and its top level modules only in sys.modules, while the pool runs
+    folder = os.path.dirname(os.path.abspath(__file__))
+    added = folder not in sys.path
+    if added:
+        sys.path.append(folder)
+    before = set(sys.modules)
+    try:
+        yield importlib.import_module("sim_pool")
+    finally:
+        if added:
+            sys.path.remove(folder)
+        for name in set(sys.modules) - before:
+            if os.path.dirname(os.path.abspath(getattr(sys.modules[name], "__file__", None) or "")) == folder:
+                del sys.modules[name]
+
+
+def SimulatePool(jobs, workers):
+    """Simulate the jobs over a pool of worker processes, returning the results in job order.  Nothing is
+    returned until every job has finished, so a broken pool raises before any result is used"""
+    if workers <= 1 or len(jobs) <= 1:
+        return [SimulateJob(job) for job in jobs]
+    context = multiprocessing.get_context('spawn')
+    with WorkerModule() as module:
+        with ProcessPoolExecutor(max_workers=min(workers, len(jobs)), mp_context=context) as pool:
+            return list(pool.map(module.SimulateJob, jobs))
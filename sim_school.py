@@ -0,0 +1,460 @@
+# ##### BEGIN GPL LICENSE BLOCK #####
+#
+#  FishSim  -- a script to apply a fish swimming simulation to an armature
+#  by Ian Huish (nerk)
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License
+#  as published by the Free Software Foundation; either version 2
+#  of the License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software Foundation,
+#  Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+# ##### END GPL LICENSE BLOCK #####
+
+# version comment: V4.02.0 - Goldfish Version - Blender 4.20 Extensions
+
+# Vectorised school stepper.
+# Every fish of a school is advanced in lock-step with NumPy, one array
+# element per fish (struct of arrays).  It follows sim_kernel.StepFish
+# line for line, with the per fish branches turned into masks.
+
+import math
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+try:
+    from . import sim_kernel
+except ImportError:
+    import sim_kernel
+
+#Smallest school that is worth the NumPy overhead
+VECTOR_MIN_FISH = 24
+
+
+def PickBackend(count, setting='AUTO'):
+    """Choose 'SCALAR' or 'VECTOR' stepping for a school of count fish"""
+    if np is None or setting == 'SCALAR':
+        return 'SCALAR'
+    if setting == 'VECTOR':
+        return 'VECTOR'
+    return 'VECTOR' if count >= VECTOR_MIN_FISH else 'SCALAR'
+
+
+#Batched versions of the sim_kernel helpers - arrays have the fish as first axis
+
+def EulerToMatrix(eul):
+    cx, cy, cz = np.cos(eul[:, 0]), np.cos(eul[:, 1]), np.cos(eul[:, 2])
+    sx, sy, sz = np.sin(eul[:, 0]), np.sin(eul[:, 1]), np.sin(eul[:, 2])
+    m = np.empty((len(eul), 3, 3))
+    m[:, 0, 0] = cy * cz
+    m[:, 0, 1] = sy * sx * cz - cx * sz
+    m[:, 0, 2] = sy * cx * cz + sx * sz
+    m[:, 1, 0] = cy * sz
+    m[:, 1, 1] = sy * sx * sz + cx * cz
+    m[:, 1, 2] = sy * cx * sz - sx * cz
+    m[:, 2, 0] = -sy
+    m[:, 2, 1] = cy * sx
+    m[:, 2, 2] = cy * cx
+    return m
+
+
+def EulerToQuat(eul):
+    ci, cj, ch = np.cos(eul[:, 0] * 0.5), np.cos(eul[:, 1] * 0.5), np.cos(eul[:, 2] * 0.5)
+    si, sj, sh = np.sin(eul[:, 0] * 0.5), np.sin(eul[:, 1] * 0.5), np.sin(eul[:, 2] * 0.5)
+    cc, cs, sc, ss = ci * ch, ci * sh, si * ch, si * sh
+    return np.stack((cj * cc + sj * ss, cj * sc - sj * cs, cj * ss + sj * cc, cj * cs - sj * sc), axis=1)
+
+
+def AxisAngleQuat(axis, angle):
+    q = np.zeros((len(angle), 4))
+    q[:, 0] = np.cos(angle * 0.5)
+    q[:, axis + 1] = np.sin(angle * 0.5)
+    return q
+
+
+def QuatMul(a, b):
+    return np.stack((
+        a[:, 0] * b[:, 0] - a[:, 1] * b[:, 1] - a[:, 2] * b[:, 2] - a[:, 3] * b[:, 3],
+        a[:, 0] * b[:, 1] + a[:, 1] * b[:, 0] + a[:, 2] * b[:, 3] - a[:, 3] * b[:, 2],
+        a[:, 0] * b[:, 2] + a[:, 2] * b[:, 0] + a[:, 3] * b[:, 1] - a[:, 1] * b[:, 3],
+        a[:, 0] * b[:, 3] + a[:, 3] * b[:, 0] + a[:, 1] * b[:, 2] - a[:, 2] * b[:, 1],
+    ), axis=1)
+
+
+def QuatSlerp(a, b, t):
+    cosom = np.sum(a * b, axis=1)
+    flip = cosom < 0.0
+    cosom = np.where(flip, -cosom, cosom)
+    a = np.where(flip[:, None], -a, a)
+    t = np.broadcast_to(t, cosom.shape)
+    far = (1.0 - cosom) > 0.0001
+    omega = np.arccos(np.minimum(cosom, 1.0))
+    sinom = np.where(far, np.sin(omega), 1.0)
+    sc1 = np.where(far, np.sin((1.0 - t) * omega) / sinom, 1.0 - t)
+    sc2 = np.where(far, np.sin(t * omega) / sinom, t)
+    return sc1[:, None] * a + sc2[:, None] * b
+
+
+def QuatToMatrix(q):
+    w, x, y, z = q[:, 0], q[:, 1], q[:, 2], q[:, 3]
+    m = np.empty((len(q), 3, 3))
+    m[:, 0, 0] = 1 - 2 * (y * y + z * z)
+    m[:, 0, 1] = 2 * (x * y - w * z)
+    m[:, 0, 2] = 2 * (x * z + w * y)
+    m[:, 1, 0] = 2 * (x * y + w * z)
+    m[:, 1, 1] = 1 - 2 * (x * x + z * z)
+    m[:, 1, 2] = 2 * (y * z - w * x)
+    m[:, 2, 0] = 2 * (x * z - w * y)
+    m[:, 2, 1] = 2 * (y * z + w * x)
+    m[:, 2, 2] = 1 - 2 * (x * x + y * y)
+    return m
+
+
+def MatrixToQuat(m):
+    #Normalise the axes (columns) first to drop any scale
+    ln = np.linalg.norm(m, axis=1)
+    m = m / np.where(ln > 0.0, ln, 1.0)[:, None, :]
+    m00, m11, m22 = m[:, 0, 0], m[:, 1, 1], m[:, 2, 2]
+    trace = m00 + m11 + m22
+    with np.errstate(invalid='ignore', divide='ignore'):
+        s0 = 2.0 * np.sqrt(np.maximum(1.0 + trace, 1e-12))
+        s1 = 2.0 * np.sqrt(np.maximum(1.0 + m00 - m11 - m22, 1e-12))
+        s2 = 2.0 * np.sqrt(np.maximum(1.0 + m11 - m00 - m22, 1e-12))
+        s3 = 2.0 * np.sqrt(np.maximum(1.0 + m22 - m00 - m11, 1e-12))
+        q0 = np.stack((0.25 * s0, (m[:, 2, 1] - m[:, 1, 2]) / s0, (m[:, 0, 2] - m[:, 2, 0]) / s0, (m[:, 1, 0] - m[:, 0, 1]) / s0), axis=1)
+        q1 = np.stack(((m[:, 2, 1] - m[:, 1, 2]) / s1, 0.25 * s1, (m[:, 0, 1] + m[:, 1, 0]) / s1, (m[:, 0, 2] + m[:, 2, 0]) / s1), axis=1)
+        q2 = np.stack(((m[:, 0, 2] - m[:, 2, 0]) / s2, (m[:, 0, 1] + m[:, 1, 0]) / s2, 0.25 * s2, (m[:, 1, 2] + m[:, 2, 1]) / s2), axis=1)
+        q3 = np.stack(((m[:, 1, 0] - m[:, 0, 1]) / s3, (m[:, 0, 2] + m[:, 2, 0]) / s3, (m[:, 1, 2] + m[:, 2, 1]) / s3, 0.25 * s3), axis=1)
+    q = np.where((trace > 0.0)[:, None], q0,
+        np.where(((m00 > m11) & (m00 > m22))[:, None], q1,
+        np.where((m11 > m22)[:, None], q2, q3)))
+    return q / np.linalg.norm(q, axis=1)[:, None]
+
+
+def CompatibleEuler(eul, oldrot):
+    deul = eul - oldrot
+    wrap = np.floor(np.abs(deul) / (2.0 * math.pi) + 0.5) * 2.0 * math.pi
+    return np.where(deul > math.pi, eul - wrap, np.where(deul < -math.pi, eul + wrap, eul))
+
+
+def QuatToEulerCompat(q, oldrot):
+    m = QuatToMatrix(q)
+    cy = np.hypot(m[:, 0, 0], m[:, 1, 0])
+    eul1 = np.stack((np.arctan2(m[:, 2, 1], m[:, 2, 2]), np.arctan2(-m[:, 2, 0], cy), np.arctan2(m[:, 1, 0], m[:, 0, 0])), axis=1)
+    eul2 = np.stack((np.arctan2(-m[:, 2, 1], -m[:, 2, 2]), np.arctan2(-m[:, 2, 0], -cy), np.arctan2(-m[:, 1, 0], -m[:, 0, 0])), axis=1)
+    degen = cy <= 16.0 * 1.1920929e-07
+    eulD = np.stack((np.arctan2(-m[:, 1, 2], m[:, 1, 1]), np.arctan2(-m[:, 2, 0], cy), np.zeros(len(q))), axis=1)
+    eul1 = CompatibleEuler(np.where(degen[:, None], eulD, eul1), oldrot)
+    eul2 = CompatibleEuler(np.where(degen[:, None], eulD, eul2), oldrot)
+    d1 = np.sum(np.abs(eul1 - oldrot), axis=1)
+    d2 = np.sum(np.abs(eul2 - oldrot), axis=1)
+    return np.where((d1 <= d2)[:, None], eul1, eul2)
+
+
+def AngleSigned2D(v1, v2, fallback):
+    zero = ((v1[:, 0] == 0.0) & (v1[:, 1] == 0.0)) | ((v2[:, 0] == 0.0) & (v2[:, 1] == 0.0))
+    angle = np.arctan2(v1[:, 1] * v2[:, 0] - v1[:, 0] * v2[:, 1], v1[:, 0] * v2[:, 0] + v1[:, 1] * v2[:, 1])
+    return np.where(zero, fallback, angle)
+
+
+#SchoolState slots that aren't float arrays
+SLOT_TYPES = {"sGoldfish": bool, "sRandom": np.uint64 if np is not None else None}
+
+
+def Random(school, mask):
+    """Next number of each fish's stream where mask is set, 0.0 elsewhere - the same as FishState.Random"""
+    with np.errstate(over='ignore'):
+        advanced = school.sRandom + np.uint64(sim_kernel.GOLDEN_GAMMA)
+        z = (advanced ^ (advanced >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+        z = (z ^ (z >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+        z = z ^ (z >> np.uint64(31))
+    school.sRandom = np.where(mask, advanced, school.sRandom)
+    return np.where(mask, (z >> np.uint64(11)).astype(float) * (1.0 / 9007199254740992.0), 0.0)
+
+
+class SchoolState:
+    """Integrator state of a whole school, one array element per fish"""
+    __slots__ = sim_kernel.FishState.__slots__
+
+    @classmethod
+    def FromFish(cls, states):
+        school = cls()
+        for name in cls.__slots__:
+            values = [getattr(s, name) for s in states]
+            setattr(school, name, np.array(values, dtype=SLOT_TYPES.get(name, float)))
+        return school
+
+    def ToFish(self, states):
+        #Copy the arrays back into the per fish records
+        for i, s in enumerate(states):
+            for name in self.__slots__:
+                value = getattr(self, name)[i]
+                if name == "sGoldfish":
+                    value = bool(value)
+                elif name == "sRandom":
+                    value = int(value)
+                elif value.ndim:
+                    value = [float(v) for v in value]
+                else:
+                    value = float(value)
+                setattr(s, name, value)
+
+    def __len__(self):
+        return len(self.sEffort)
+
+
+def RigToWorld(school, rot, v):
+    return np.einsum('nij,nj->ni', rot, v / school.sScale)
+
+
+def WorldToRig(school, rot, v):
+    return np.einsum('nji,nj->ni', rot, v) * school.sScale
+
+
+def Target(school, params, matrices, sizes, hasProxy):
+    rot = EulerToMatrix(school.sRotation)
+    RigDirn = RigToWorld(school, rot, np.broadcast_to(np.array((0.0, -1.0, 0.0)), school.sLocation.shape))
+
+    #distance to target
+    TargetDirn = np.where(hasProxy[:, None], matrices[:, (3, 7, 11)] - school.sLocation, np.array((0.0, -10.0, 0.0)))
+    DifDot = np.sum(TargetDirn * RigDirn, axis=1)
+
+    #horizontal angle to target - limit max turning effort at 90 deg
+    AngleToTarget = np.degrees(AngleSigned2D(RigDirn[:, :2], TargetDirn[:, :2], math.pi))
+    DirectionEffort = np.clip(AngleToTarget / 90.0, -1.0, 1.0)
+
+    #vertical angle to target - limit max turning effort at 20 deg
+    RigDirn2DV = np.stack((np.hypot(RigDirn[:, 1], RigDirn[:, 0]), RigDirn[:, 2]), axis=1)
+    TargetDirn2DV = np.stack((np.hypot(TargetDirn[:, 1], TargetDirn[:, 0]), TargetDirn[:, 2]), axis=1)
+    AngleToTargetV = np.degrees(AngleSigned2D(RigDirn2DV, TargetDirn2DV, math.pi))
+    DirectionEffortV = np.clip(AngleToTargetV / 20.0, -1.0, 1.0)
+
+    #Hover Mode Detection (Close to target and slow)
+    close = hasProxy & (np.linalg.norm(TargetDirn, axis=1) < sizes * params.pHoverDist)
+    hover = np.where(close, np.minimum(1.0, school.sHoverMode + params.pSTransTime / 25.0),
+                     np.maximum(0.0, school.sHoverMode - params.pHTransTime / 25.0))
+    school.sHoverMode = np.where(school.sGoldfish, hover, 0.0)
+
+    return DifDot, DirectionEffort, DirectionEffortV, rot
+
+
+def PecSimulation(school, params, nFrame, rows):
+    gold = school.sGoldfish
+    count = len(school)
+    pecState = school.sPecState + 360.0 / params.pMaxPecFreq
+    xPecAngle = np.sin(np.radians(pecState)) * math.radians(params.pMaxPecAngle)
+    yPecAngle = np.sin(np.radians(pecState + 90.0)) * math.radians(params.pMaxPecAngle * 2)
+
+    #Rest Period Calculations
+    restAmount, restFrame, restartFrame = school.sRestAmount, school.sRestFrame, school.sRestartFrame
+    restart = nFrame >= restartFrame
+    restAmount = np.where(restart, np.maximum(0.0, restAmount - params.pPecTransition), restAmount)
+    newRest = restart & (restAmount < 0.1)
+    restFrame = np.where(newRest, nFrame + params.pPecDuration, restFrame)
+    restartFrame = np.where(newRest, restFrame + params.pPecDuty * params.pPecDuration, restartFrame)
+    resting = (nFrame >= restFrame) & (nFrame < restartFrame) & (restAmount < 1.0)
+    restAmount = np.where(resting, np.minimum(1.0, restAmount + params.pPecTransition), restAmount)
+
+    #Only goldfish rigs have pec fins
+    school.sPecState = np.where(gold, pecState, school.sPecState)
+    school.sRestAmount = np.where(gold, restAmount, school.sRestAmount)
+    school.sRestFrame = np.where(gold, restFrame, school.sRestFrame)
+    school.sRestartFrame = np.where(gold, restartFrame, school.sRestartFrame)
+
+    SideFinRot = np.radians(np.sin(np.radians(school.sState + params.pSideFinPhase)) * params.pMaxSideFinAngle)
+    SideQuat = AxisAngleQuat(0, SideFinRot)
+    RestQuat = AxisAngleQuat(0, np.full(count, math.radians(params.pPecOffset)))
+
+    xRestAmount = (1.0 - (1.0 - school.sRestAmount) * school.sHoverMode)
+    xAng = QuatMul(AxisAngleQuat(1, yPecAngle), AxisAngleQuat(0, -xPecAngle))
+    PalmL = QuatMul(QuatSlerp(xAng, RestQuat, xRestAmount), SideQuat)
+
+    xMaxPecScale = params.pMaxPecAngle * (1.0 / params.pPecStiffness) * 0.2 / 30.0
+    Pec_scale = 1.0 + np.sin(np.radians(school.sPecState - params.pPecPhase)) * xMaxPecScale * (1.0 - xRestAmount)
+
+    if not params.pPecSynch:
+        xAng = QuatMul(AxisAngleQuat(1, yPecAngle), AxisAngleQuat(0, xPecAngle))
+        Pec_scaleR = 1 / Pec_scale
+    else:
+        xAng = QuatMul(AxisAngleQuat(1, -yPecAngle), AxisAngleQuat(0, -xPecAngle))
+        Pec_scaleR = Pec_scale
+    PalmR = QuatMul(QuatSlerp(xAng, RestQuat, xRestAmount), SideQuat)
+
+    for i, comp in enumerate(("qw", "qx", "qy", "qz")):
+        rows["pec_palm_l_" + comp] = PalmL[:, i]
+        rows["pec_palm_r_" + comp] = PalmR[:, i]
+    rows["pec_top_l_sy"] = Pec_scale
+    rows["pec_bottom_l_sy"] = 1 - (1 - Pec_scale) * params.pPecStubRatio
+    rows["pec_top_r_sy"] = Pec_scaleR
+    rows["pec_bottom_r_sy"] = 1 - (1 - Pec_scaleR) * params.pPecStubRatio
+
+
+def SwimAttributes(school, params):
+    """(N,) arrays of speed, tail phase, tail amplitude, tail turn offset and hover mode, as in sim_kernel.SwimAttributes"""
+    speed = np.linalg.norm(school.sVelocity, axis=1)
+    phase = np.radians(np.mod(school.sState, 360.0))
+    hover = school.sHoverMode
+    amplitude = np.radians(school.rMaxTailAngle * ((1 - hover) * school.sEffort + hover * params.pHoverTailFrc))
+    return speed, phase, amplitude, np.radians(school.sTailAngleOffset), hover
+
+
+class SchoolTail:
+    """sim_kernel.TailGeometry of every fish of a school, stacked"""
+    __slots__ = ("point", "pivots", "bases", "gains")
+
+    @classmethod
+    def FromFish(cls, tails):
+        tail = cls()
+        tail.point = np.array([t.point for t in tails], dtype=float)
+        tail.pivots = {joint: np.array([t.pivots[joint] for t in tails], dtype=float) for joint in sim_kernel.TAIL_JOINTS}
+        tail.bases = {joint: np.array([t.bases[joint] for t in tails], dtype=float) for joint in sim_kernel.TAIL_JOINTS}
+        tail.gains = {joint: np.array([t.gains[joint] for t in tails], dtype=float) for joint in sim_kernel.TAIL_JOINTS}
+        return tail
+
+
+def JointQuat(joint, rows, gain):
+    if joint == "spine":
+        return AxisAngleQuat(2, rows["spine_z"] * gain)
+    if joint == "chest":
+        return QuatMul(AxisAngleQuat(2, rows["chest_z"] * gain), AxisAngleQuat(0, rows["chest_x"] * gain))
+    if joint == "torso":
+        return AxisAngleQuat(1, rows["torso_y"] * gain)
+    return np.stack((rows["root_qw"], rows["root_qx"], rows["root_qy"], rows["root_qz"]), axis=1)
+
+
+def TailFinX(tail, rows):
+    """Lateral position of the middle of every tail fin for (N,) arrays of channel values"""
+    p = tail.point
+    for joint in sim_kernel.TAIL_JOINTS:
+        pivot = tail.pivots[joint]
+        basis = tail.bases[joint]
+        local = np.einsum('nji,nj->ni', basis, p - pivot)
+        local = np.einsum('nij,nj->ni', QuatToMatrix(JointQuat(joint, rows, tail.gains[joint])), local)
+        p = pivot + np.einsum('nij,nj->ni', basis, local)
+    return p[:, 0]
+
+
+def StepSchool(school, params, nFrame, startFrame, matrices, sizes, hasProxy, back_fin_x, rootOnly=False):
+    """Advance every fish of the school by one frame.
+
+    matrices is an (N, 16) array of row major target world matrices, sizes and hasProxy are (N,).
+    With rootOnly, only steering and locomotion are worked out, as in sim_kernel.StepFish.
+    Returns a dict of (N,) arrays, one per sim_kernel track, or None on the start frame.
+    """
+    count = len(school)
+    RqdEffort, RqdDirection, RqdDirectionV, rot = Target(school, params, matrices, sizes, hasProxy)
+    if nFrame == startFrame:
+        school.sOldRqdEffort = RqdEffort
+        school.sOldBackFin = np.array(back_fin_x, dtype=float)
+        return None
+    school.sOldRqdEffort = RqdEffort
+    effort = params.pEffortGain * RqdEffort * params.pEffortRamp + school.sEffort * (1.0 - params.pEffortRamp)
+    school.sEffort = np.clip(effort, 0.0, 1.0)
+
+    rows = {}
+    if not rootOnly:
+        PecSimulation(school, params, nFrame, rows)
+
+    hover = school.sHoverMode
+    xFreq = school.rMaxFreq * ((1 - hover) * (1.0 / (school.sEffort + 0.01)) + hover * 2.0)
+    xTailAmp = school.rMaxTailAngle * ((1 - hover) * school.sEffort + hover * params.pHoverTailFrc)
+
+    xSwimTailAngleOffset = RqdDirection * params.pMaxSteeringAngle
+    school.sTailAngleOffset = (school.sTailAngleOffset * (1 - params.pEffortRamp)
+                               + params.pEffortRamp * np.maximum(0, (1.0 - hover * 2.0)) * xSwimTailAngleOffset)
+
+    #Hover 'Twitch' calculations
+    calm = hover < 0.5
+    school.sTwitchTarget = np.where(calm, 0.0, school.sTwitchTarget)
+    school.sTwitchFrame = np.where(calm, 0.0, school.sTwitchFrame)
+    twitch = ~calm & (nFrame >= school.sTwitchFrame)
+    if twitch.any():
+        r1 = np.where(twitch, Random(school, twitch) - 0.5, 0.0)
+        r2 = np.where(twitch, Random(school, twitch) - 0.5, 0.0)
+        newFrame = nFrame + params.pHoverTwitchTime * r1
+        newFrame = np.where((newFrame < school.sRestartFrame) & (newFrame > school.sRestFrame), school.sRestartFrame + 5, newFrame)
+        school.sTwitchFrame = np.where(twitch, newFrame, school.sTwitchFrame)
+        school.sTwitchTarget = np.where(twitch, params.pHoverTwitch * 2.0 * r2, school.sTwitchTarget)
+    school.sTwitchAngle = school.sTwitchAngle * 0.9 + 0.1 * school.sTwitchTarget
+
+    #Spine Movement
+    school.sState = school.sState + 360.0 / xFreq
+    xTailAngle = np.sin(np.radians(school.sState)) * np.radians(xTailAmp) + np.radians(school.sTailAngleOffset) + np.radians(school.sTwitchAngle)
+
+    back_fin_x = np.asarray(back_fin_x, dtype=float)
+    back_fin_dif = back_fin_x - school.sOldBackFin
+    school.sOldBackFin = back_fin_x
+
+    if not rootOnly:
+        rows["spine_z"] = xTailAngle
+        rows["chest_z"] = -xTailAngle * params.pChestRatio
+        rows["chest_x"] = -np.abs(np.radians(school.sTailAngleOffset)) * params.pChestRaise * (1.0 - hover)
+        rows["torso_y"] = -np.radians(school.sTailAngleOffset) * params.pLeanIntoTurn * (1.0 - hover)
+
+        pMaxTailScale = params.pMaxTailFinAngle * (1.0 / params.pTailFinStiffness) * 0.2 / 30.0
+        Back_fin1_scale = 1.0 + np.sin(np.radians(school.sState + params.pTailFinPhase)) * pMaxTailScale * (xTailAmp / school.rMaxTailAngle)
+        rows["back_fin1_sy"] = Back_fin1_scale
+        rows["back_fin2_sy"] = 1 - (1 - Back_fin1_scale) * params.pTailFinStubRatio
+
+        SideFinRot = np.sin(np.radians(school.sState + params.pSideFinPhase)) * params.pMaxSideFinAngle
+        rows["side_fin_l_x"] = np.radians(-SideFinRot)
+        rows["side_fin_r_x"] = np.radians(SideFinRot)
+
+    ForwardForce = np.abs(np.cos(np.radians(school.sState))) * np.radians(xTailAmp) * 15.0 * params.pPower / params.pMaxFreq
+    AngularForce = back_fin_dif / params.pAngularDrag
+    AngularForce = AngularForce + xTailAngle * school.sVelocity[:, 1] / params.pAngularDrag
+    AngularForce = AngularForce - (school.sTailAngleOffset / params.pMaxSteeringAngle) * params.pTurnAssist
+    school.sAngularForceV = school.sAngularForceV * (1 - params.pEffortRamp) + RqdDirectionV * params.pMaxVerticalAngle
+
+    #Object movement - work out both swimming and hovering, then pick per fish
+    swim = (hover < 0.1) | ~hasProxy
+    vel = school.sVelocity
+    drag = params.pDrag * vel * np.abs(vel)
+
+    swimForce = np.zeros((count, 3))
+    swimForce[:, 1] = -ForwardForce
+
+    offset = matrices[:, (3, 7, 11)] - school.sLocation
+    RigForce = (hover * params.pPecEffortGain)[:, None] * WorldToRig(school, rot, offset)
+    xHoverMaxForce = params.pHoverMaxForce * (1 - school.sRestAmount * 0.6)
+    xDerated = xHoverMaxForce * params.pHoverDerate
+    RigForce[:, 1] = np.minimum(np.maximum(RigForce[:, 1], -xHoverMaxForce), xDerated)
+    RigForce[:, 2] = np.minimum(np.maximum(RigForce[:, 2], -xDerated), xDerated)
+    RigForce[:, 0] = np.minimum(np.maximum(RigForce[:, 0], -xDerated), xDerated)
+
+    force = np.where(swim[:, None], swimForce, RigForce)
+    school.sVelocity = np.clip(vel + (force - drag) / params.pMass, -sim_kernel.MAX_VELOCITY, sim_kernel.MAX_VELOCITY)
+    school.sLocation = school.sLocation + RigToWorld(school, rot, school.sVelocity)
+
+    swimRot = school.sRotation + np.stack((np.radians(school.sAngularForceV), np.zeros(count), np.radians(AngularForce)), axis=1)
+    swimRoot = np.broadcast_to(np.array((1.0, 0.0, 0.0, 0.0)), (count, 4))
+    if swim.all():
+        school.sRotation = swimRot
+        school.sRootQuat = np.array(swimRoot)
+    else:
+        xTargetQuat = QuatMul(MatrixToQuat(matrices.reshape(count, 4, 4)[:, :3, :3]),
+                              AxisAngleQuat(2, np.full(count, math.radians(params.pStartAngle))))
+        xRigQuat = QuatSlerp(EulerToQuat(school.sRotation), xTargetQuat, params.pPecTurnAssist / 100.0)
+        hoverRot = QuatToEulerCompat(xRigQuat, school.sRotation)
+        rf = np.where(RigForce[:, 1] < 0, RigForce[:, 1] * params.pHoverDerate, RigForce[:, 1])
+        with np.errstate(invalid='ignore', divide='ignore'):
+            TiltAngle = np.radians(params.pHoverTilt * rf / (params.pHoverMaxForce * params.pHoverDerate))
+        hoverRoot = QuatSlerp(school.sRootQuat, AxisAngleQuat(0, TiltAngle), 0.03)
+        school.sRotation = np.where(swim[:, None], swimRot, hoverRot)
+        school.sRootQuat = np.where(swim[:, None], swimRoot, hoverRoot)
+
+    rows["loc_x"], rows["loc_y"], rows["loc_z"] = school.sLocation.T
+    rows["rot_x"], rows["rot_y"], rows["rot_z"] = school.sRotation.T
+    rows["root_qw"], rows["root_qx"], rows["root_qy"], rows["root_qz"] = school.sRootQuat.T
+    return rows
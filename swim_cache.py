@@ -0,0 +1,254 @@
+# ##### BEGIN GPL LICENSE BLOCK #####
+#
+#  FishSim  -- a script to apply a fish swimming simulation to an armature
+#  by Ian Huish (nerk)
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License
+#  as published by the Free Software Foundation; either version 2
+#  of the License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software Foundation,
+#  Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+# ##### END GPL LICENSE BLOCK #####
+
+
+# version comment: V4.02.0 - Goldfish Version - Blender 4.20 Extensions
+
+# Baked swim cache.
+# Instead of F-Curves, the per frame channels of a fish can be written to a
+# binary file next to the .blend, one row of float32 (or float16) values per
+# frame, so a single frame is one contiguous slice.  The file is memory
+# mapped and a frame_change_pre handler applies only the current frame's
+# row to the rig, so a render node only reads the frames it renders.
+
+import json
+import mmap
+import os
+import struct
+
+import bpy
+import mathutils
+from bpy.app.handlers import persistent
+
+MAGIC = b"FSIMSWIM"
+VERSION = 1
+FILE_SUFFIX = ".fsimswim"
+#Magic, then the length of the JSON header that follows
+PREAMBLE = struct.Struct("<8sI")
+
+#Open caches by absolute path - (modification time, SwimCache)
+_open = {}
+
+
+class SwimCache:
+    """A memory mapped swim cache file"""
+
+    def __init__(self, path):
+        self.file = open(path, "rb")
+        try:
+            self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+            magic, length = PREAMBLE.unpack_from(self.map, 0)
+            if magic != MAGIC:
+                raise ValueError("not a swim cache")
+            header = json.loads(self.map[PREAMBLE.size:PREAMBLE.size + length])
+            if header["version"] != VERSION:
+                raise ValueError("unsupported swim cache version")
+        except (ValueError, struct.error):
+            self.Close()
+            raise
+        self.startFrame = header["startFrame"]
+        self.count = header["count"]
+        self.tracks = header["tracks"]
+        self.bones = header["bones"]
+        self.euler = header["euler"]
+        self.offset = header["offset"]
+        self.row = struct.Struct("<{}{}".format(len(self.tracks), header["format"]))
+
+    def Row(self, nFrame):
+        #Channel values of one frame, frames outside the range hold the nearest one
+        i = min(max(int(nFrame) - self.startFrame, 0), self.count - 1)
+        return dict(zip(self.tracks, self.row.unpack_from(self.map, self.offset + i * self.row.size)))
+
+    def Close(self):
+        if getattr(self, "map", None) is not None:
+            self.map.close()
+            self.map = None
+        self.file.close()
+
+
+def Write(path, bake, bones, euler=False, half=False):
+    """Write the bake of a fish to a swim cache file.  bones maps the roles to pose bones"""
+    Close(path)
+    tracks = list(bake.tracks)
+    count = len(bake)
+    fmt = "e" if half else "f"
+    header = {
+        "version": VERSION,
+        "format": fmt,
+        "startFrame": bake.startFrame,
+        "count": count,
+        "tracks": tracks,
+        "bones": {role: bone.name for role, bone in bones.items()},
+        "euler": euler,
+        "offset": 0,
+    }
+    #The rows start on an 8 byte boundary after the header, which holds its own offset
+    text = json.dumps(header)
+    offset = PREAMBLE.size + len(text) + 16
+    offset += -offset % 8
+    header["offset"] = offset
+    text = json.dumps(header).encode()
+    row = struct.Struct("<{}{}".format(len(tracks), fmt))
+    columns = [bake.tracks[name] for name in tracks]
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temp = path + ".tmp"
+    with open(temp, "wb") as f:
+        f.write(PREAMBLE.pack(MAGIC, len(text)))
+        f.write(text)
+        f.write(bytes(offset - PREAMBLE.size - len(text)))
+        for i in range(count):
+            f.write(row.pack(*(values[i] for values in columns)))
+    os.replace(temp, path)
+
+
+def Open(path):
+    """The SwimCache of a file, reopened when the file changes, or None if it can't be read"""
+    try:
+        mtime = os.stat(path).st_mtime
+    except OSError:
+        Close(path)
+        return None
+    entry = _open.get(path)
+    if entry is not None and entry[0] == mtime:
+        return entry[1]
+    Close(path)
+    try:
+        cache = SwimCache(path)
+    except (OSError, ValueError) as err:
+        print("FishSim swim cache not read:", path, err)
+        return None
+    _open[path] = (mtime, cache)
+    return cache
+
+
+def Close(path=None):
+    """Unmap one cache file, or all of them"""
+    for key in ([path] if path is not None else list(_open)):
+        entry = _open.pop(key, None)
+        if entry is not None:
+            entry[1].Close()
+
+
+class CacheUsers:
+    """Names of the objects of one type carrying a cache file property, so the frame handlers don't
+    search every object in the file on each frame.  The file is searched again after a load, when the
+    number of objects changes, or when a known object has gone or lost its property"""
+
+    def __init__(self, prop, objType):
+        self.prop = prop
+        self.objType = objType
+        self.names = set()
+        self.count = None
+
+    def Add(self, obj):
+        self.names.add(obj.name)
+
+    def Forget(self):
+        self.names.clear()
+        self.count = None
+
+    def Objects(self, scene):
+        #(object, cache path) of the users in the scene
+        if self.count != len(bpy.data.objects):
+            self.count = len(bpy.data.objects)
+            self.names = {obj.name for obj in bpy.data.objects if obj.type == self.objType and obj.get(self.prop)}
+        several = len(bpy.data.scenes) > 1
+        for name in list(self.names):
+            obj = bpy.data.objects.get(name)
+            path = obj.get(self.prop) if obj is not None and obj.type == self.objType else None
+            if not path:
+                #Renamed, deleted or no longer cached
+                self.names.discard(name)
+                self.count = None
+                continue
+            if several and scene not in obj.users_scene:
+                continue
+            yield obj, path
+
+
+_users = CacheUsers("fsim_swim_cache", "ARMATURE")
+
+
+def Track(rig):
+    """Note a rig that has just been given a swim cache file"""
+    _users.Add(rig)
+
+
+def ApplyPose(rig, bones, row, euler=False):
+    """Set the rig and its bones to one frame of channel values.  With euler, the single axis bones
+    are in XYZ rotation mode (see keyframe_writer.SetRotationModes)"""
+    rig.location = (row["loc_x"], row["loc_y"], row["loc_z"])
+    rig.rotation_euler = (row["rot_x"], row["rot_y"], row["rot_z"])
+    bones["root"].rotation_quaternion = (row["root_qw"], row["root_qx"], row["root_qy"], row["root_qz"])
+    if euler:
+        bones["spine"].rotation_euler[2] = row["spine_z"]
+        bones["chest"].rotation_euler = (row["chest_x"], 0.0, row["chest_z"])
+        bones["torso"].rotation_euler[1] = row["torso_y"]
+        bones["side_fin_l"].rotation_euler[0] = row["side_fin_l_x"]
+        bones["side_fin_r"].rotation_euler[0] = row["side_fin_r_x"]
+    else:
+        bones["spine"].rotation_quaternion = mathutils.Quaternion((0.0, 0.0, 1.0), row["spine_z"])
+        bones["chest"].rotation_quaternion = mathutils.Quaternion((0.0, 0.0, 1.0), row["chest_z"]) @ mathutils.Quaternion((1.0, 0.0, 0.0), row["chest_x"])
+        bones["torso"].rotation_quaternion = mathutils.Quaternion((0.0, 1.0, 0.0), row["torso_y"])
+        bones["side_fin_l"].rotation_quaternion = mathutils.Quaternion((1.0, 0.0, 0.0), row["side_fin_l_x"])
+        bones["side_fin_r"].rotation_quaternion = mathutils.Quaternion((1.0, 0.0, 0.0), row["side_fin_r_x"])
+    bones["back_fin1"].scale[1] = row["back_fin1_sy"]
+    bones["back_fin2"].scale[1] = row["back_fin2_sy"]
+    if "pec_palm_l" in bones and "pec_top_l_sy" in row:
+        bones["pec_palm_l"].rotation_quaternion = (row["pec_palm_l_qw"], row["pec_palm_l_qx"], row["pec_palm_l_qy"], row["pec_palm_l_qz"])
+        bones["pec_palm_r"].rotation_quaternion = (row["pec_palm_r_qw"], row["pec_palm_r_qx"], row["pec_palm_r_qy"], row["pec_palm_r_qz"])
+        bones["pec_top_l"].scale[1] = row["pec_top_l_sy"]
+        bones["pec_bottom_l"].scale[1] = row["pec_bottom_l_sy"]
+        bones["pec_top_r"].scale[1] = row["pec_top_r_sy"]
+        bones["pec_bottom_r"].scale[1] = row["pec_bottom_r_sy"]
+
+
+@persistent
+def FrameChangePre(scene, depsgraph=None):
+    #Pose every rig with an 'fsim_swim_cache' file for the new frame
+    for obj, path in _users.Objects(scene):
+        cache = Open(bpy.path.abspath(path))
+        if cache is None:
+            continue
+        bones = {role: obj.pose.bones.get(name) for role, name in cache.bones.items()}
+        if None in bones.values():
+            continue
+        ApplyPose(obj, bones, cache.Row(scene.frame_current), cache.euler)
+
+
+@persistent
+def LoadPre(*args):
+    Close()
+    _users.Forget()
+
+
+def register():
+    bpy.app.handlers.frame_change_pre.append(FrameChangePre)
+    bpy.app.handlers.load_pre.append(LoadPre)
+
+
+def unregister():
+    for handlers, handler in ((bpy.app.handlers.frame_change_pre, FrameChangePre), (bpy.app.handlers.load_pre, LoadPre)):
+        if handler in handlers:
+            handlers.remove(handler)
+    Close()
+    _users.Forget()
@@ -0,0 +1,232 @@
+# ##### BEGIN GPL LICENSE BLOCK #####
+#
+#  FishSim  -- a script to apply a fish swimming simulation to an armature
+#  by Ian Huish (nerk)
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License
+#  as published by the Free Software Foundation; either version 2
+#  of the License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software Foundation,
+#  Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+# ##### END GPL LICENSE BLOCK #####
+
+
+# version comment: V4.02.0 - Goldfish Version - Blender 4.20 Extensions
+
+# Steady cruise detection.
+# While a fish cruises at a steady effort the tail oscillator repeats the
+# same bone pattern every tail beat.  These stretches are found in a
+# finished bake, so the tail, chest and fin bones can be played back from
+# one short cyclic action per gait on the NLA with a repeat count, instead
+# of a key on every frame.  Root motion and the lean into turns stay as keys.
+# With NumPy the period search and template matching work on whole tracks
+# at once; without it they fall back to plain Python loops.
+
+import math
+from array import array
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+try:
+    from . import sim_kernel
+except ImportError:
+    import sim_kernel
+
+#Bones driven by the tail oscillator, and the tracks that have to repeat for them to be cycled
+CYCLE_ROLES = ("spine", "chest", "back_fin1", "back_fin2", "side_fin_l", "side_fin_r")
+CYCLE_TRACKS = ("spine_z", "chest_z", "chest_x", "back_fin1_sy", "back_fin2_sy", "side_fin_l_x", "side_fin_r_x")
+
+
+class SwimCycle:
+    """One periodic stretch of a bake - 'repeats' beats of 'period' frames from bake index 'start',
+    played from gait 'gait'"""
+    __slots__ = ("start", "period", "repeats", "gait")
+
+    def __init__(self, start, period, repeats, gait):
+        self.start = start
+        self.period = period
+        self.repeats = repeats
+        self.gait = gait
+
+    def End(self):
+        #Bake index (not necessarily whole) of the end of the last beat
+        return self.start + self.period * self.repeats
+
+
+def Sample(values, t):
+    #Linear interpolation of a per frame array at a fractional index
+    i = min(int(t), len(values) - 2)
+    f = t - i
+    return values[i] * (1.0 - f) + values[i + 1] * f
+
+
+def Period(values, start, minPeriod, maxPeriod, tolerance):
+    """Length in frames of the first repeat of values from start, to a fraction of a frame, or None.
+
+    The period is the first lag whose mean squared difference is a local minimum within tolerance,
+    refined with a parabola through its neighbours.
+    """
+    errors = {}
+
+    def Error(lag):
+        if lag not in errors:
+            if start + 2 * lag > len(values):
+                errors[lag] = None
+            else:
+                errors[lag] = sum((values[start + i] - values[start + i + lag]) ** 2 for i in range(lag)) / lag
+        return errors[lag]
+
+    limit = tolerance * tolerance
+    for lag in range(max(minPeriod, 2), maxPeriod + 1):
+        before, error, after = Error(lag - 1), Error(lag), Error(lag + 1)
+        if after is None:
+            return None
+        if error <= limit and error <= before and error <= after:
+            curve = before - 2.0 * error + after
+            offset = 0.5 * (before - after) / curve if curve > 0.0 else 0.0
+            return lag + max(-0.5, min(0.5, offset))
+    return None
+
+
+def Periods(values, minPeriod, maxPeriod, tolerance):
+    """Period from every start index of values, as Period gives it, worked out with NumPy.
+
+    The mean squared difference at each lag comes from running sums of the squared differences,
+    so every start and lag is found in one pass per lag.
+    """
+    v = np.frombuffer(values, dtype=np.float32).astype(float) if isinstance(values, array) else np.asarray(values, dtype=float)
+    count = len(v)
+    lags = np.arange(max(minPeriod, 2) - 1, maxPeriod + 2)
+    errors = np.full((count, len(lags)), np.nan)
+    for k, lag in enumerate(lags):
+        if 2 * lag > count:
+            break
+        sums = np.concatenate(([0.0], np.cumsum((v[:count - lag] - v[lag:]) ** 2)))
+        starts = np.arange(count - 2 * lag + 1)
+        errors[starts, k] = (sums[starts + lag] - sums[starts]) / lag
+
+    #The first local minimum within tolerance.  Comparisons with NaN (past the end) are False, and
+    #the lags that fit are contiguous from the shortest, so no later lag can be picked by mistake
+    before, error, after = errors[:, :-2], errors[:, 1:-1], errors[:, 2:]
+    with np.errstate(invalid='ignore'):
+        hit = (error <= tolerance * tolerance) & (error <= before) & (error <= after)
+    found = hit.any(axis=1)
+    rows = np.nonzero(found)[0]
+    first = np.argmax(hit[rows], axis=1)
+    b, e, a = before[rows, first], error[rows, first], after[rows, first]
+    curve = b - 2.0 * e + a
+    with np.errstate(invalid='ignore', divide='ignore'):
+        offset = np.where(curve > 0.0, 0.5 * (b - a) / curve, 0.0)
+    periods = [None] * count
+    for row, period in zip(rows.tolist(), (lags[1:-1][first] + np.clip(offset, -0.5, 0.5)).tolist()):
+        periods[row] = period
+    return periods
+
+
+def Template(bake, start, period, keys):
+    """One beat of every track of a bake from start, resampled to keys + 1 evenly spaced keys.
+    The last key repeats the first so the cycle closes."""
+    template = sim_kernel.FishBake(0, "pec_top_l_sy" in bake.tracks)
+    for name, values in bake.tracks.items():
+        beat = template.tracks[name]
+        beat.extend(Sample(values, start + k * period / keys) for k in range(keys))
+        beat.append(beat[0])
+    return template
+
+
+def Matching(bake, template, start, period, tolerance):
+    """Number of frames from start whose cycle tracks stay within tolerance of the template"""
+    keys = len(template) - 1
+    tracks = [(bake.tracks[name], template.tracks[name]) for name in CYCLE_TRACKS]
+    count = len(bake)
+    if np is not None:
+        #Sample the template at every frame at once, as Sample does, and find the first frame off it
+        u = np.fmod(np.arange(count - start, dtype=float), period) * keys / period
+        index = np.minimum(u.astype(int), keys - 1)
+        f = u - index
+        off = np.zeros(count - start, dtype=bool)
+        for values, beat in tracks:
+            v = np.frombuffer(values, dtype=np.float32)[start:].astype(float)
+            b = np.frombuffer(beat, dtype=np.float32).astype(float)
+            off |= np.abs(v - (b[index] * (1.0 - f) + b[index + 1] * f)) > tolerance
+        return int(np.argmax(off)) if off.any() else count - start
+    for i in range(start, count):
+        u = math.fmod(i - start, period) * keys / period
+        for values, beat in tracks:
+            if math.fabs(values[i] - Sample(beat, u)) > tolerance:
+                return i - start
+    return count - start
+
+
+def FindCycles(bake, tolerance, minRepeats=3, minPeriod=4, maxPeriod=120):
+    """Find the steady cruising stretches of a bake.
+
+    Returns the gaits (one FishBake template per distinct beat) and the SwimCycles, in frame order.
+    Stretches shorter than minRepeats beats, or with hardly any tail movement, are left as keys.
+    """
+    spine = bake.tracks["spine_z"]
+    count = len(bake)
+    gaits = []
+    cycles = []
+    periods = Periods(spine, minPeriod, maxPeriod, tolerance) if np is not None else None
+    start = 1
+    while start + minRepeats * minPeriod < count:
+        period = periods[start] if periods is not None else Period(spine, start, minPeriod, maxPeriod, tolerance)
+        if period is None:
+            start += 1
+            continue
+        beat = spine[start:start + int(period) + 1]
+        if max(beat) - min(beat) <= 4.0 * tolerance:
+            start += int(period)
+            continue
+
+        #Reuse an earlier gait with the same beat if it fits, otherwise start a new one
+        keys = int(math.ceil(period))
+        best, bestLength = None, 0
+        for n, gait in enumerate(gaits):
+            if len(gait) == keys + 1:
+                length = Matching(bake, gait, start, period, tolerance)
+                if length > bestLength:
+                    best, bestLength = n, length
+        if (bestLength - 1) / period < minRepeats:
+            template = Template(bake, start, period, keys)
+            length = Matching(bake, template, start, period, tolerance)
+            if length > bestLength:
+                best, bestLength = None, length
+
+        repeats = int((bestLength - 1) / period)
+        if repeats < minRepeats:
+            start += max(1, int(period / 4))
+            continue
+        if best is None:
+            best = len(gaits)
+            gaits.append(template)
+        cycles.append(SwimCycle(start, period, repeats, best))
+        start = int(cycles[-1].End()) + 1
+    return gaits, cycles
+
+
+def KeySpans(cycles, count):
+    """(first, last) bake index ranges still keyed outside the cycles, including the frames at their ends"""
+    spans = []
+    first = 0
+    for cycle in cycles:
+        last = int(cycle.start)
+        if last >= first:
+            spans.append((first, last))
+        first = int(math.ceil(cycle.End()))
+    if first < count:
+        spans.append((first, count - 1))
+    return spans
@@ -0,0 +1,152 @@
+# ##### BEGIN GPL LICENSE BLOCK #####
+#
+#  FishSim  -- a script to apply a fish swimming simulation to an armature
+#  by Ian Huish (nerk)
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License
+#  as published by the Free Software Foundation; either version 2
+#  of the License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software Foundation,
+#  Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+# ##### END GPL LICENSE BLOCK #####
+
+# version comment: V4.02.0 - Goldfish Version - Blender 4.20 Extensions
+
+# Swim gaits.
+# A species is posed through one tail beat of each of a few representative
+# gaits - cruising, turning either way and hovering - and the deformed mesh
+# at each phase is kept as vertex offsets from rest (see gait_cache).  A
+# crowd fish's body is then rebuilt from those offsets without an armature:
+# the two phases either side of its tail phase are interpolated, and the
+# gaits blended by its tail turn offset and hover mode.
+
+import math
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+try:
+    from . import sim_kernel
+except ImportError:
+    import sim_kernel
+
+#Baked gaits, in order - a positive tail offset turns the fish to the right
+GAITS = ("cruise", "turn_left", "turn_right", "hover")
+#Phases sampled over one tail beat
+PHASES = 16
+#Crowd fish posed together, bounding the size of the temporary arrays
+CHUNK = 64
+
+
+def GaitSettings(params, gait):
+    """(tail offset in degrees, hover mode) of one of GAITS"""
+    if gait == "turn_left":
+        return -params.pMaxSteeringAngle, 0.0
+    if gait == "turn_right":
+        return params.pMaxSteeringAngle, 0.0
+    return 0.0, 1.0 if gait == "hover" else 0.0
+
+
+def Amplitude(params, gait):
+    """Tail amplitude (radians) a gait is baked at - full effort, or the hover fraction of it"""
+    hover = GaitSettings(params, gait)[1]
+    return math.radians(params.pMaxTailAngle * ((1 - hover) + hover * params.pHoverTailFrc))
+
+
+def GaitRow(params, initial, gait, phase):
+    """Channel values of a fish at tail phase (radians) through a gait, with the rig and any
+    pec fins as in initial (see sim_kernel.InitialRow)"""
+    offset, hover = GaitSettings(params, gait)
+    ampFraction = (1 - hover) + hover * params.pHoverTailFrc
+    xTailAngle = math.sin(phase) * math.radians(params.pMaxTailAngle * ampFraction) + math.radians(offset)
+    row = dict(initial)
+    sim_kernel.SwimRow(row, params, math.degrees(phase), xTailAngle, ampFraction, offset, hover)
+    return row
+
+
+def EulerMatrices(rotation):
+    """(N, 3, 3) rotation matrices of (N, 3) XYZ eulers, as sim_kernel.EulerToMatrix"""
+    cx, cy, cz = np.cos(rotation).T
+    sx, sy, sz = np.sin(rotation).T
+    return np.stack((
+        np.stack((cy * cz, sy * sx * cz - cx * sz, sy * cx * cz + sx * sz), axis=1),
+        np.stack((cy * sz, sy * sx * sz + cx * cz, sy * cx * sz - sx * cz), axis=1),
+        np.stack((-sy, cy * sx, cy * cx), axis=1),
+    ), axis=1)
+
+
+def Weights(turn, hover, turnRef):
+    """(len(GAITS), N) blend weights from tail turn offsets (radians) and hover modes"""
+    steer = np.clip(turn / turnRef, -1.0, 1.0) if turnRef > 0.0 else np.zeros_like(turn)
+    moving = 1.0 - hover
+    return np.stack((moving * (1.0 - np.abs(steer)), moving * np.maximum(-steer, 0.0), moving * np.maximum(steer, 0.0), hover))
+
+
+class Gaits:
+    """The baked gaits of a species.
+
+    rest is the (V, 3) rest position of every vertex in fish space (the rig's location and rotation,
+    but not its scale, taken out), offsets the (len(GAITS), phases, V, 3) offsets from rest, amplitudes
+    the tail amplitude of each gait and turn the tail offset of the turning gaits (radians).
+    """
+    __slots__ = ("rest", "mean", "swing", "amplitudes", "turn")
+
+    def __init__(self, rest, offsets, amplitudes, turn):
+        self.rest = np.asarray(rest, dtype=np.float32).reshape(-1, 3)
+        offsets = np.asarray(offsets, dtype=np.float32).reshape(len(GAITS), -1, len(self.rest), 3)
+        #The steady bend of a gait stays put, only the swing about it follows the tail amplitude
+        self.mean = offsets.mean(axis=1)
+        self.swing = offsets - self.mean[:, None]
+        self.amplitudes = np.asarray(amplitudes, dtype=np.float32)
+        self.turn = float(turn)
+
+    @property
+    def vertices(self):
+        return len(self.rest)
+
+    @property
+    def phases(self):
+        return self.swing.shape[1]
+
+    def Pose(self, phase, amplitude, turn, hover):
+        """(N, V, 3) fish space vertex positions of N fish from their swim attributes"""
+        weights = Weights(turn, hover, self.turn).astype(np.float32)
+        scale = amplitude / np.maximum(weights.T @ self.amplitudes, 1e-6)
+        f = np.mod(phase, 2.0 * math.pi) * (self.phases / (2.0 * math.pi))
+        i0 = np.floor(f).astype(int) % self.phases
+        i1 = (i0 + 1) % self.phases
+        t = (f - np.floor(f)).astype(np.float32)
+        local = np.repeat(self.rest[None], len(phase), axis=0)
+        for g in range(len(GAITS)):
+            w = weights[g]
+            if not w.any():
+                continue
+            local += w[:, None, None] * self.mean[g]
+            local += (w * scale * (1.0 - t))[:, None, None] * self.swing[g, i0]
+            local += (w * scale * t)[:, None, None] * self.swing[g, i1]
+        return local
+
+    def Frame(self, values):
+        """Flat float32 world positions of every vertex of a crowd, fish after fish, from one frame of
+        crowd attributes (see sim_crowd.ATTRIBUTES)"""
+        position = np.asarray(values["position"], dtype=np.float32).reshape(-1, 3)
+        rotation = np.asarray(values["rotation"], dtype=np.float32).reshape(-1, 3)
+        attributes = [np.asarray(values[name], dtype=np.float32) for name in ("tail_phase", "tail_amplitude", "tail_turn", "hover")]
+        out = np.empty((len(position), self.vertices, 3), dtype=np.float32)
+        for start in range(0, len(position), CHUNK):
+            end = start + CHUNK
+            local = self.Pose(*(a[start:end] for a in attributes))
+            matrices = EulerMatrices(rotation[start:end]).astype(np.float32)
+            out[start:end] = np.einsum("nij,nvj->nvi", matrices, local) + position[start:end, None, :]
+        return out.ravel()
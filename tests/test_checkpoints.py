@@ -0,0 +1,64 @@
+# Checkpoints must still validate after a run that validated them without resuming,
+# and after resuming below the last valid checkpoint.
+
+import math
+import os
+import sys
+import types
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import sim_kernel
+
+PROPS = dict(
+    pMass=30.0, pDrag=8.0, pPower=1.0, pMaxFreq=15.0, pEffortGain=0.5, pEffortIntegral=0.5, pEffortRamp=0.2,
+    pAngularDrag=1.0, pTurnAssist=3.0, pMaxTailAngle=15.0, pMaxSteeringAngle=15.0, pMaxVerticalAngle=0.1,
+    pMaxTailFinAngle=15.0, pTailFinPhase=90.0, pTailFinStiffness=1.0, pTailFinStubRatio=0.3, pMaxSideFinAngle=5.0,
+    pSideFinPhase=90.0, pChestRatio=0.5, pChestRaise=1.0, pLeanIntoTurn=1.0, pRandom=0.25, pPecEffortGain=0.25,
+    pPecTurnAssist=1.0, pMaxPecFreq=15.0, pMaxPecAngle=20.0, pPecPhase=90.0, pPecStubRatio=0.7, pPecStiffness=0.7,
+    pHTransTime=0.5, pSTransTime=0.2, pPecOffset=20.0, pHoverDist=1.0, pHoverTailFrc=0.2, pHoverMaxForce=0.2,
+    pHoverDerate=0.2, pHoverTilt=4.0, pPecDuration=50.0, pPecDuty=0.8, pPecTransition=0.05, pHoverTwitch=4.0,
+    pHoverTwitchTime=40.0, pPecSynch=False)
+START, END, EVERY = 1, 250, 25
+
+
+def Trajectory():
+    trajectory = sim_kernel.ProxyTrajectory(START)
+    for f in range(END - START + 1):
+        a = f * 0.01
+        trajectory.Append([1, 0, 0, 10 * math.cos(a), 0, 1, 0, 10 * math.sin(a), 0, 0, 1, 0.002 * f, 0, 0, 0, 1], 1.5)
+    return trajectory
+
+
+def Run(params, checkpoints, trajectory):
+    state = sim_kernel.FishState((10.0, 0.0, 0.0), (0.0, 0.0, 0.0), (1.0, 1.0, 1.0), False)
+    state.Randomise(params)
+    checkpoints.frames.clear()
+    return sim_kernel.SimulateFish(params, state, trajectory, START, END, checkpoints=checkpoints)
+
+
+class CheckpointsTest(unittest.TestCase):
+
+    def test_validate_across_runs(self):
+        params = sim_kernel.SimParams.FromProps(types.SimpleNamespace(**PROPS), 0.0)
+        trajectory = Trajectory()
+        checkpoints = sim_kernel.Checkpoints(EVERY, trajectory)
+        expected = list(range(EVERY, END, EVERY))
+
+        Run(params, checkpoints, trajectory)
+        self.assertEqual(checkpoints.Valid(START, END), expected)
+
+        #Validated but not resumed - the whole run is simulated again
+        Run(params, checkpoints, trajectory)
+        self.assertEqual(checkpoints.Valid(START, END), expected)
+
+        #Resumed below the last valid checkpoint
+        state, row = checkpoints.Restore(100)
+        bake = sim_kernel.FishBake(101, state.sGoldfish)
+        sim_kernel.SimulateFish(params, state, trajectory, START, END, bake=bake, row=row, firstFrame=101, checkpoints=checkpoints)
+        self.assertEqual(checkpoints.Valid(START, END), expected)
+
+
+if __name__ == "__main__":
+    unittest.main()
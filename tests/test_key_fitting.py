@@ -0,0 +1,75 @@
+# Fitted keys must reproduce the samples they were fitted to, as Blender evaluates the Bezier curve.
+
+import math
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import key_fitting
+
+
+def Bezier(co, left, right, frame):
+    """Value of the Bezier curve through the keys at frame, solving for the curve parameter by bisection"""
+    keys = len(co) // 2
+    n = max(i for i in range(keys - 1) if co[2 * i] <= frame) if keys > 1 else 0
+    if keys == 1:
+        return co[1]
+    p0, p1 = (co[2 * n], co[2 * n + 1]), (right[2 * n], right[2 * n + 1])
+    p2, p3 = (left[2 * n + 2], left[2 * n + 3]), (co[2 * n + 2], co[2 * n + 3])
+
+    def Point(t, axis):
+        u = 1 - t
+        return u * u * u * p0[axis] + 3 * u * u * t * p1[axis] + 3 * u * t * t * p2[axis] + t * t * t * p3[axis]
+
+    lo, hi = 0.0, 1.0
+    for i in range(60):
+        mid = (lo + hi) * 0.5
+        if Point(mid, 0) < frame:
+            lo = mid
+        else:
+            hi = mid
+    return Point((lo + hi) * 0.5, 1)
+
+
+class KeyFittingTest(unittest.TestCase):
+
+    def test_constant(self):
+        #A channel that stays within the tolerance is one flat key
+        frames = list(range(1, 51))
+        values = [0.5 + 0.0001 * math.sin(f) for f in frames]
+        self.assertEqual(key_fitting.FitKeys(frames, values, 0.001), ([0], [0.0]))
+        self.assertEqual(key_fitting.FitKeys([], [], 0.001), ([], []))
+
+    def test_sine_within_tolerance(self):
+        frames = list(range(1, 201))
+        values = [math.sin(f * 0.1) for f in frames]
+        for tolerance in (0.01, 0.001, 0.0001):
+            co, left, right = key_fitting.FitCurve(frames, values, tolerance)
+            self.assertLess(len(co) // 2, len(frames) // 2)
+            for frame, value in zip(frames, values):
+                self.assertLess(math.fabs(Bezier(co, left, right, frame) - value), tolerance + 1e-5)
+
+    def test_end_slopes(self):
+        #The end keys take the slope of their one neighbouring sample
+        frames = list(range(10, 60))
+        values = [0.02 * (f - 10) ** 2 for f in frames]
+        keys, slopes = key_fitting.FitKeys(frames, values, 0.01)
+        self.assertEqual((keys[0], keys[-1]), (0, len(values) - 1))
+        self.assertAlmostEqual(slopes[0], values[1] - values[0])
+        self.assertAlmostEqual(slopes[-1], values[-1] - values[-2])
+
+    def test_sparse_frames(self):
+        #Every second frame, ending on an odd gap, as keyed with a level of detail step of 2
+        frames = list(range(1, 250, 2)) + [250]
+        values = [math.sin(f * 0.09) + 0.3 * math.sin(f * 0.023) for f in frames]
+        tolerance = 0.002
+        co, left, right = key_fitting.FitCurve(frames, values, tolerance)
+        self.assertLess(len(co) // 2, len(frames) // 2)
+        for frame, value in zip(frames, values):
+            self.assertLess(math.fabs(Bezier(co, left, right, frame) - value), tolerance + 1e-5)
+
+
+if __name__ == "__main__":
+    unittest.main()
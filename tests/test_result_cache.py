@@ -0,0 +1,62 @@
+# The cache folder must stay within its size limit, dropping the least recently used results first.
+
+import os
+import sys
+import tempfile
+import unittest
+from array import array
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import result_cache
+import sim_kernel
+
+
+def Result(frames):
+    state = sim_kernel.FishState((1.0, 2.0, 3.0), (0.0, 0.0, 0.5), (1.0, 1.0, 1.0), False)
+    bake = sim_kernel.FishBake(1, False)
+    for i in range(frames):
+        bake.Append(sim_kernel.InitialRow(state))
+    return result_cache.CachedResult(bake, array('d', [0.5, 1.5]), {10: array('d', [2.5])})
+
+
+def FolderSize(folder):
+    return sum(os.path.getsize(os.path.join(folder, name)) for name in os.listdir(folder))
+
+
+class ResultCacheTest(unittest.TestCase):
+
+    def tearDown(self):
+        result_cache.Forget()
+
+    def test_eviction(self):
+        with tempfile.TemporaryDirectory() as folder:
+            #Room for three results
+            probe = result_cache.ResultCache(folder, 1 << 30)
+            probe.Put("probe", Result(50))
+            limit = 3 * FolderSize(folder) + 10
+            os.remove(probe.Path("probe"))
+
+            cache = result_cache.ResultCache(folder, limit)
+            for n in range(3):
+                cache.Put("key{}".format(n), Result(50))
+            #Reading the oldest makes it the most recently used
+            result_cache.Forget()
+            self.assertIsNotNone(cache.Get("key0"))
+            cache.Put("key3", Result(50))
+
+            self.assertEqual(sorted(os.listdir(folder)), ["key0.fsim", "key2.fsim", "key3.fsim"])
+            self.assertEqual(cache.size, FolderSize(folder))
+            self.assertLessEqual(cache.size, limit)
+
+            #A new cache on the same folder lists what is there
+            reopened = result_cache.ResultCache(folder, limit)
+            self.assertEqual(sorted(reopened.Files()), ["key0.fsim", "key2.fsim", "key3.fsim"])
+            self.assertEqual(reopened.size, cache.size)
+            loaded = reopened.Get("key2")
+            self.assertEqual(list(loaded.bake.tracks["loc_x"]), [1.0] * 50)
+            self.assertEqual(list(loaded.checkpoints[10]), [2.5])
+
+
+if __name__ == "__main__":
+    unittest.main()
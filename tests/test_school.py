@@ -0,0 +1,77 @@
+# The NumPy school stepper must follow sim_kernel.StepFish, fish for fish and frame for frame.
+
+import copy
+import math
+import os
+import sys
+import types
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import sim_kernel
+import sim_school
+from test_checkpoints import PROPS
+
+START, END = 1, 100
+IDENTITY = [[1.0, 0.0, 0.0], [0.0, 1.0, 0.0], [0.0, 0.0, 1.0]]
+
+
+def Tail():
+    #A straight tail along -y, each joint a unit further back
+    pivots = {"root": (0.0, 0.0, 0.0), "torso": (0.0, -1.0, 0.0), "chest": (0.0, -2.0, 0.0), "spine": (0.0, -3.0, 0.0)}
+    return sim_kernel.TailGeometry((0.0, -4.0, 0.0), pivots, dict.fromkeys(sim_kernel.TAIL_JOINTS, IDENTITY))
+
+
+def Trajectory(i):
+    #Circles of different sizes, speeds and climbs
+    trajectory = sim_kernel.ProxyTrajectory(START)
+    radius = 6.0 + i
+    for f in range(END - START + 1):
+        a = f * (0.01 + 0.004 * i)
+        trajectory.Append([1, 0, 0, radius * math.cos(a), 0, 1, 0, radius * math.sin(a), 0, 0, 1, 0.01 * f * (i - 2), 0, 0, 0, 1],
+                          1.0 + 0.5 * i)
+    return trajectory
+
+
+@unittest.skipIf(sim_school.np is None, "NumPy is not installed")
+class SchoolTest(unittest.TestCase):
+
+    def test_matches_kernel(self):
+        np = sim_school.np
+        params = sim_kernel.SimParams.FromProps(types.SimpleNamespace(**PROPS), 0.0)
+        #Goldfish, which start out hovering and run the pec fins
+        states = []
+        for i in range(6):
+            state = sim_kernel.FishState((5.0 + i, 0.0, 0.2 * i), (0.0, 0.0, 0.3 * i), (1.0, 1.0, 1.0), True, 1000 + i)
+            state.Randomise(params)
+            states.append(state)
+        tails = [Tail() for state in states]
+        trajectories = [Trajectory(i) for i in range(len(states))]
+
+        school = sim_school.SchoolState.FromFish(copy.deepcopy(states))
+        schoolTail = sim_school.SchoolTail.FromFish(tails)
+        first = [sim_kernel.InitialRow(state) for state in states]
+        schoolRows = {name: np.array([row[name] for row in first]) for name in first[0]}
+        rows = first
+        hasProxy = np.ones(len(states), dtype=bool)
+
+        for nFrame in range(START, END + 1):
+            proxies = [trajectory.Sample(nFrame) for trajectory in trajectories]
+            newRows = [sim_kernel.StepFish(state, params, nFrame, START, proxy, sim_kernel.TailFinX(tail, row))
+                       for state, proxy, tail, row in zip(states, proxies, tails, rows)]
+            matrices = np.array([proxy[0] for proxy in proxies], dtype=float)
+            sizes = np.array([proxy[1] for proxy in proxies], dtype=float)
+            newSchoolRows = sim_school.StepSchool(school, params, nFrame, START, matrices, sizes, hasProxy,
+                                                  sim_school.TailFinX(schoolTail, schoolRows))
+            if nFrame == START:
+                self.assertIsNone(newSchoolRows)
+                continue
+            for i, row in enumerate(newRows):
+                for name, value in row.items():
+                    self.assertAlmostEqual(float(newSchoolRows[name][i]), value, places=9, msg="{} of fish {} on frame {}".format(name, i, nFrame))
+            rows, schoolRows = newRows, newSchoolRows
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,72 @@
+# Swim cycles must be found in a bake that beats steadily for a stretch, with the right period and span.
+
+import math
+import os
+import random
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import sim_kernel
+import swim_cycles
+
+COUNT, FIRST, LAST = 300, 60, 240
+PERIOD = 12.4
+TOLERANCE = 0.01
+
+
+def Bake():
+    #Steady beats from FIRST to LAST with noise well inside the tolerance, a wandering tail either side
+    rand = random.Random(7)
+    bake = sim_kernel.FishBake(1, False)
+    wander = 0.0
+    for i in range(COUNT):
+        wander += rand.uniform(-0.05, 0.05)
+        row = {}
+        for n, name in enumerate(bake.tracks):
+            if FIRST <= i <= LAST:
+                value = 0.05 * math.sin(2.0 * math.pi * (i - FIRST) / PERIOD + n)
+            else:
+                value = 0.3 * math.sin(0.002 * i * i + n) + wander
+            row[name] = value + rand.uniform(-0.1, 0.1) * TOLERANCE
+        bake.Append(row)
+    return bake
+
+
+class SwimCyclesTest(unittest.TestCase):
+
+    def test_period(self):
+        spine = Bake().tracks["spine_z"]
+        for start in (FIRST, FIRST + 17, LAST - 3 * int(PERIOD)):
+            self.assertAlmostEqual(swim_cycles.Period(spine, start, 4, 120, TOLERANCE), PERIOD, delta=0.1)
+        self.assertIsNone(swim_cycles.Period(spine, 5, 4, 120, TOLERANCE))
+
+    @unittest.skipIf(swim_cycles.np is None, "NumPy is not installed")
+    def test_periods_match_period(self):
+        spine = Bake().tracks["spine_z"]
+        periods = swim_cycles.Periods(spine, 4, 120, TOLERANCE)
+        for start in range(0, COUNT, 3):
+            expected = swim_cycles.Period(spine, start, 4, 120, TOLERANCE)
+            if expected is None:
+                self.assertIsNone(periods[start])
+            else:
+                self.assertAlmostEqual(periods[start], expected, places=4)
+
+    def test_find_cycles(self):
+        bake = Bake()
+        gaits, cycles = swim_cycles.FindCycles(bake, TOLERANCE)
+        self.assertEqual(len(gaits), 1)
+        self.assertEqual(len(cycles), 1)
+        cycle = cycles[0]
+        self.assertAlmostEqual(cycle.period, PERIOD, delta=0.1)
+        #The cycle covers the steady stretch but for less than a beat at either end
+        self.assertGreaterEqual(cycle.start, FIRST)
+        self.assertLess(cycle.start, FIRST + PERIOD)
+        self.assertLessEqual(cycle.End(), LAST + 1)
+        self.assertGreater(cycle.End(), LAST - PERIOD)
+        self.assertEqual(swim_cycles.KeySpans(cycles, COUNT), [(0, cycle.start), (math.ceil(cycle.End()), COUNT - 1)])
+
+
+if __name__ == "__main__":
+    unittest.main()
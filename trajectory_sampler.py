@@ -0,0 +1,128 @@
+# ##### BEGIN GPL LICENSE BLOCK #####
+#
+#  FishSim  -- a script to apply a fish swimming simulation to an armature
+#  by Ian Huish (nerk)
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License
+#  as published by the Free Software Foundation; either version 2
+#  of the License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software Foundation,
+#  Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+# ##### END GPL LICENSE BLOCK #####
+
+# version comment: V4.02.0 - Goldfish Version - Blender 4.20 Extensions
+
+# Target proxy trajectory sampler.
+# Extracts the world matrix of every target proxy over the whole simulation
+# range before the simulation starts.  Proxies animated only by their own
+# F-Curves are evaluated directly; anything else (parents, constraints,
+# drivers, NLA, delta transforms, path follow...) is sampled in one shared
+# sweep of the timeline, so the scene is evaluated once per frame however
+# many proxies there are.
+
+import mathutils
+
+from . import sim_kernel
+
+TRANSFORM_PATHS = ("location", "rotation_euler", "rotation_quaternion", "rotation_axis_angle", "scale")
+
+
+def RotationPath(obj):
+    if obj.rotation_mode == 'QUATERNION':
+        return "rotation_quaternion"
+    if obj.rotation_mode == 'AXIS_ANGLE':
+        return "rotation_axis_angle"
+    return "rotation_euler"
+
+
+def HasDeltaTransform(obj):
+    return (any(obj.delta_location) or any(obj.delta_rotation_euler)
+            or tuple(obj.delta_rotation_quaternion) != (1.0, 0.0, 0.0, 0.0)
+            or tuple(obj.delta_scale) != (1.0, 1.0, 1.0))
+
+
+def DirectCurves(obj):
+    """Return {(data_path, index): fcurve} if the proxy transform only depends on its own action, else None"""
+    if obj.parent is not None or len(obj.constraints) > 0 or HasDeltaTransform(obj):
+        return None
+    ad = obj.animation_data
+    if ad is None:
+        return {}
+    if len(ad.nla_tracks) > 0 or ad.action_influence < 1.0:
+        return None
+    for driver in ad.drivers:
+        if driver.data_path in TRANSFORM_PATHS or driver.data_path.startswith("delta_"):
+            return None
+    curves = {}
+    if ad.action is not None:
+        for fcurve in ad.action.fcurves:
+            #Animated delta transforms are only picked up by evaluating the scene
+            if fcurve.data_path.startswith("delta_") and not fcurve.mute:
+                return None
+            if fcurve.data_path in TRANSFORM_PATHS and not fcurve.mute:
+                curves[(fcurve.data_path, fcurve.array_index)] = fcurve
+    return curves
+
+
+def EvaluateDirect(obj, curves, startFrame, endFrame):
+    #Build the world matrix from the F-Curves on every frame, without touching the scene
+    trajectory = sim_kernel.ProxyTrajectory(startFrame)
+    rotPath = RotationPath(obj)
+    statics = {"location": obj.location, "scale": obj.scale, rotPath: getattr(obj, rotPath)}
+    scaleY = obj.scale[1]
+    extentY = obj.dimensions[1] / scaleY if scaleY != 0.0 else obj.dimensions[1]
+
+    def Channel(path, frame):
+        values = []
+        for index, value in enumerate(statics[path]):
+            fcurve = curves.get((path, index))
+            values.append(fcurve.evaluate(frame) if fcurve is not None else value)
+        return values
+
+    for frame in range(startFrame, endFrame + 1):
+        loc = Channel("location", frame)
+        rot = Channel(rotPath, frame)
+        scale = Channel("scale", frame)
+        if rotPath == "rotation_quaternion":
+            rot = mathutils.Quaternion(rot).normalized()
+        elif rotPath == "rotation_axis_angle":
+            rot = mathutils.Quaternion(rot[1:], rot[0])
+        else:
+            rot = mathutils.Euler(rot, obj.rotation_mode)
+        matrix = mathutils.Matrix.LocRotScale(loc, rot, scale)
+        trajectory.Append([v for row in matrix for v in row], abs(extentY * scale[1]))
+    return trajectory
+
+
+def SampleTrajectories(scene, proxies, startFrame, endFrame):
+    """Return {proxy name: ProxyTrajectory} for every proxy over startFrame..endFrame"""
+    trajectories = {}
+    swept = []
+    for obj in proxies:
+        if obj is None or obj.name in trajectories:
+            continue
+        curves = DirectCurves(obj)
+        if curves is None:
+            swept.append(obj)
+            trajectories[obj.name] = sim_kernel.ProxyTrajectory(startFrame)
+        else:
+            trajectories[obj.name] = EvaluateDirect(obj, curves, startFrame, endFrame)
+
+    #One shared timeline sweep for everything that needs the full scene evaluation
+    if swept:
+        oldFrame = scene.frame_current
+        for frame in range(startFrame, endFrame + 1):
+            scene.frame_set(frame)
+            for obj in swept:
+                trajectories[obj.name].Append([v for row in obj.matrix_world for v in row], obj.dimensions[1])
+        scene.frame_set(oldFrame)
+    return trajectories